@@ -0,0 +1,60 @@
+"""Times sibreg.bin.preprocess_data.find_clusters and recurcive_append on simulated kinship graphs.
+
+The graph is made of many small families like a biobank kinship graph, where each family is a random tree, plus a few
+large clusters of distant relatives. recurcive_append is timed by adding an element to the closure of the nodes of the largest cluster.
+
+Run it from the root of the repository:
+    python benchmarks/benchmark_clusters.py --nodes 2000000 --edges 3000000
+"""
+import argparse
+import time
+import numpy as np
+from sibreg.bin.preprocess_data import find_clusters, recurcive_append
+
+def simulate_graph(number_of_nodes, number_of_edges, large_cluster_size, seed):
+    """Simulates the edges of a kinship graph.
+
+    Returns:
+        numpy.array
+            A two-dimensional array where each row is the two nodes of an edge.
+    """
+    rng = np.random.RandomState(seed)
+    #each node except the first one of a family is connected to a random earlier node of its family
+    family_starts = np.sort(rng.choice(np.arange(1, number_of_nodes), number_of_nodes//4, replace=False))
+    family_of_node = np.searchsorted(family_starts, np.arange(number_of_nodes), side="right")
+    first_node = np.concatenate(([0], family_starts))[family_of_node]
+    nodes = np.arange(number_of_nodes)
+    has_parent = nodes > first_node
+    parents = first_node[has_parent] + (rng.random_sample(np.sum(has_parent))*(nodes[has_parent]-first_node[has_parent])).astype(int)
+    edges = [np.column_stack((nodes[has_parent], parents))]
+    #the remaining edges join random nodes of the large cluster
+    remaining = max(0, number_of_edges - edges[0].shape[0])
+    large_cluster = rng.choice(number_of_nodes, min(large_cluster_size, number_of_nodes), replace=False)
+    edges.append(rng.choice(large_cluster, (remaining, 2)))
+    return np.concatenate(edges)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--nodes', type=int, default=2000000, help="Number of individuals")
+    parser.add_argument('--edges', type=int, default=3000000, help="Number of relationships")
+    parser.add_argument('--large_cluster', type=int, default=100000, help="Number of individuals in the large cluster of distant relatives")
+    parser.add_argument('--repeats', type=int, default=3, help="Number of times find_clusters is timed. The best time is reported")
+    parser.add_argument('--seed', type=int, default=0, help="Seed of the simulation")
+    args = parser.parse_args()
+    edges = simulate_graph(args.nodes, args.edges, args.large_cluster, args.seed)
+    timings = []
+    for repeat in range(args.repeats):
+        start_time = time.time()
+        clusters = find_clusters(args.nodes, edges)
+        timings.append(time.time()-start_time)
+    print("nodes: {} edges: {} clusters: {}".format(args.nodes, edges.shape[0], np.unique(clusters).shape[0]))
+    print("find_clusters best of {}: {:.3f}s, {:.1f} million edges per second".format(args.repeats, min(timings), edges.shape[0]/min(timings)/1e6))
+    largest_cluster = np.argmax(np.bincount(clusters))
+    in_largest_cluster = clusters[edges[:, 0]] == largest_cluster
+    graph = {node:set() for node in np.unique(edges[in_largest_cluster]).tolist()}
+    for node1, node2 in edges[in_largest_cluster].tolist():
+        graph[node1].add(node2)
+        graph[node2].add(node1)
+    start_time = time.time()
+    recurcive_append(graph, edges[in_largest_cluster][0, 0].item(), edges[in_largest_cluster][0, 1].item())
+    print("recurcive_append over a cluster of {} nodes: {:.3f}s".format(len(graph), time.time()-start_time))
@@ -0,0 +1,90 @@
+"""Times sibreg.bin.impute_from_sibs.impute on a simulated cohort.
+
+Genotypes are random and the rows of the individuals are shuffled, like a real bed file where members of a family are
+far apart. The chromosome of each sib pair is split into random IBD segments. A fraction of the families have one genotyped parent.
+
+Run it from the root of the repository after compiling the cython code:
+    python benchmarks/benchmark_impute.py --fams 20000 --snps 5000 --threads 4
+"""
+import argparse
+import logging
+import time
+import numpy as np
+import pandas as pd
+from sibreg.bin.impute_from_sibs import impute, build_ibd_index, MISSING_GENOTYPE
+
+def simulate_cohort(number_of_fams, number_of_snps, max_sibs, single_parent_fraction, missing_rate, segments_per_pair, seed):
+    """Simulates sibships, genotypes, IBD segments and SNP positions in the format impute expects.
+
+    Returns:
+        tuple(pandas.Dataframe, dict, numpy.array, dict, numpy.array)
+            sibships, iid_to_bed_index, gts, ibd and pos respectively.
+    """
+    rng = np.random.RandomState(seed)
+    sib_counts = rng.randint(2, max_sibs+1, number_of_fams)
+    single_parent = rng.random_sample(number_of_fams) < single_parent_fraction
+    iids = []
+    fams = []
+    parents = []
+    for fam in range(number_of_fams):
+        sibs = ["{}_{}".format(fam, sib) for sib in range(sib_counts[fam])]
+        fams.append([iid.encode("ASCII") for iid in sibs])
+        iids += sibs
+        parents.append("{}_P".format(fam))
+        if single_parent[fam]:
+            iids.append(parents[-1])
+    bed_order = rng.permutation(len(iids))
+    iid_to_bed_index = {iid.encode("ASCII"):int(index) for iid, index in zip(iids, bed_order)}
+    freqs = rng.uniform(0.05, 0.5, number_of_snps)
+    gts = np.empty((len(iids), number_of_snps), dtype=np.int8)
+    #genotypes are simulated in blocks of individuals to keep the memory usage low
+    for block_start in range(0, len(iids), 1000):
+        block = gts[block_start:block_start+1000]
+        block[:] = rng.binomial(2, freqs, block.shape)
+        block[rng.random_sample(block.shape) < missing_rate] = MISSING_GENOTYPE
+    pos = np.sort(rng.choice(100*number_of_snps, number_of_snps, replace=False)).astype(int)
+    ibd = {}
+    for fam in fams:
+        for i in range(1, len(fam)):
+            for j in range(i):
+                #the chromosome is split into consecutive segments with the IBD0, IBD1 and IBD2 proportions of full sibs
+                #and like KING, IBD0 segments are not listed
+                bounds = np.unique(np.concatenate(([0, 100*number_of_snps], rng.randint(0, 100*number_of_snps, segments_per_pair-1))))
+                states = rng.choice(3, bounds.shape[0]-1, p=[0.25, 0.5, 0.25])
+                pair_segments = np.column_stack((bounds[:-1], bounds[1:]-1, states))
+                ibd[(fam[i].decode("ASCII"), fam[j].decode("ASCII"))] = pair_segments[states > 0].ravel().tolist()
+    sibships = pd.DataFrame({"FID":["F{}".format(fam).encode("ASCII") for fam in range(number_of_fams)],
+                             "FATHER_ID":[parent.encode("ASCII") for parent in parents],
+                             "MOTHER_ID":[b"0"]*number_of_fams,
+                             "IID":fams,
+                             "sib_count":sib_counts,
+                             "has_father":single_parent,
+                             "has_mother":False,
+                             "single_parent":single_parent,
+                             })
+    return sibships, iid_to_bed_index, gts, ibd, pos
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--fams', type=int, default=20000, help="Number of families")
+    parser.add_argument('--snps', type=int, default=5000, help="Number of SNPs")
+    parser.add_argument('--max_sibs', type=int, default=4, help="Maximum number of sibs in a family")
+    parser.add_argument('--single_parent', type=float, default=0.2, help="Fraction of the families with one genotyped parent")
+    parser.add_argument('--missing', type=float, default=0.01, help="Fraction of the missing genotypes")
+    parser.add_argument('--segments', type=int, default=20, help="Number of IBD segments of each sib pair")
+    parser.add_argument('--threads', type=int, default=1, help="Number of the threads used by impute")
+    parser.add_argument('--snp_tile_size', type=int, default=1024, help="Number of SNPs in each tile imputed for a family at once")
+    parser.add_argument('--repeats', type=int, default=3, help="Number of times impute is timed. The best time is reported")
+    parser.add_argument('--seed', type=int, default=0, help="Seed of the simulation")
+    parser.add_argument('--single_parent_branches', action='store_true', default=False, help="Impute the families with one genotyped parent with the reference branches instead of the per-SNP tables, to compare the two")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.ERROR)
+    sibships, iid_to_bed_index, gts, ibd, pos = simulate_cohort(args.fams, args.snps, args.max_sibs, args.single_parent, args.missing, args.segments, args.seed)
+    ibd = build_ibd_index(sibships["IID"].values.tolist(), ibd)
+    timings = []
+    for repeat in range(args.repeats):
+        start_time = time.time()
+        impute(sibships.copy(), iid_to_bed_index, gts, ibd, pos, {}, "bench", threads=args.threads, snp_tile_size=args.snp_tile_size, single_parent_tables=not args.single_parent_branches)
+        timings.append(time.time()-start_time)
+    print("families: {} snps: {} threads: {} snp_tile_size: {} single parent: {}".format(args.fams, args.snps, args.threads, args.snp_tile_size, "branches" if args.single_parent_branches else "tables"))
+    print("best of {}: {:.3f}s, {:.1f} million family-SNPs per second".format(args.repeats, min(timings), args.fams*args.snps/min(timings)/1e6))
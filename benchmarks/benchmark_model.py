@@ -0,0 +1,58 @@
+"""Times fitting the variance components of sibreg.sibreg.model with L-BFGS-B on a simulated cohort.
+
+The phenotype has a family random effect and the covariates are an intercept and random normal columns. The optimisation
+evaluates the likelihood on the preprocessed model, and is compared to evaluating it on a model rebuilt from y, X and labels
+at every evaluation. sibreg.sibreg.model.fit_snps is then timed on random genotypes with the fitted variance parameters.
+
+Run it from the root of the repository:
+    python benchmarks/benchmark_model.py --fams 200000 --covariates 3 --rebuild
+"""
+import argparse
+import time
+import numpy as np
+from scipy.optimize import fmin_l_bfgs_b
+from sibreg.sibreg import model, lik_and_grad
+
+def simulate_cohort(number_of_fams, max_sibs, number_of_covariates, sigma2, tau, seed):
+    """Simulates the phenotypes, covariates and family labels of a cohort.
+
+    Returns:
+        tuple(numpy.array, numpy.array, numpy.array)
+            y, X and labels respectively.
+    """
+    rng = np.random.RandomState(seed)
+    labels = np.repeat(np.arange(number_of_fams), rng.randint(1, max_sibs+1, number_of_fams))
+    n = labels.shape[0]
+    X = np.hstack((np.ones((n, 1)), rng.randn(n, number_of_covariates)))
+    family_effects = np.sqrt(sigma2/tau)*rng.randn(number_of_fams)
+    y = X.dot(rng.randn(number_of_covariates+1))+family_effects[labels]+np.sqrt(sigma2)*rng.randn(n)
+    return y, X, labels
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--fams', type=int, default=200000, help="Number of families")
+    parser.add_argument('--max_sibs', type=int, default=3, help="Maximum number of individuals in a family")
+    parser.add_argument('--covariates', type=int, default=3, help="Number of covariates besides the intercept")
+    parser.add_argument('--rebuild', action='store_true', default=False, help="Also times the optimisation that rebuilds the model at each evaluation")
+    parser.add_argument('--snps', type=int, default=200, help="Number of SNPs fitted by fit_snps. Each SNP takes 16 bytes per individual")
+    parser.add_argument('--seed', type=int, default=0, help="Seed of the simulation")
+    args = parser.parse_args()
+    y, X, labels = simulate_cohort(args.fams, args.max_sibs, args.covariates, 1., 0.5, args.seed)
+    init_params = np.array([np.var(y)/2, 1.])
+    start_time = time.time()
+    fitted_model = model(y, X, labels)
+    print("families: {} individuals: {} model construction: {:.3f}s".format(args.fams, y.shape[0], time.time()-start_time))
+    start_time = time.time()
+    optim = fitted_model.optimize_model(init_params)
+    consumed_time = time.time()-start_time
+    print("optimize_model: {:.3f}s, {} iterations, {:.1f} iterations per second, {:.1f} evaluations per second".format(consumed_time, optim['iterations'], optim['iterations']/consumed_time, optim['evaluations']/consumed_time))
+    if args.rebuild:
+        start_time = time.time()
+        optimized = fmin_l_bfgs_b(func=lik_and_grad, x0=init_params, args=(y, X, labels), bounds=[(0.00001, None), (0.00001, None)])
+        consumed_time = time.time()-start_time
+        print("rebuilding the model: {:.3f}s, {:.1f} iterations per second".format(consumed_time, optimized[2]['nit']/consumed_time))
+    G = np.random.RandomState(args.seed).binomial(2, 0.3, (y.shape[0], 2, args.snps)).astype(np.float64)
+    start_time = time.time()
+    fitted_model.fit_snps(G, optim['tau'], optim['sigma2'])
+    consumed_time = time.time()-start_time
+    print("fit_snps: {:.3f}s, {:.1f} SNPs per second".format(consumed_time, args.snps/consumed_time))
@@ -0,0 +1,78 @@
+"""Converts the IBD segments output by KING to a binary cache that impute_runner.py can memory-map.
+
+Parsing the KING segments table takes long for large cohorts. This script does it once and writes the segments of each chromosome,
+grouped by pair of individuals and with SNP ids replaced by their locations, to a cache directory. The address of this directory can be
+given to impute_runner.py instead of the IBD file.
+
+Args:
+    IBD : str
+        Address of a file containing IBD statuses for all SNPs.
+        This is a '\t seperated CSV with these columns: "chr", "ID1", "ID2", "IBDType", "StartSNP", "StopSNP".
+        Each line states an IBD segment between a pair on individuals. This can be generated using King software
+
+    genotypes_address : str
+        Address of genotypes in .bed format. If there is a ~ in the address, ~ is replaced by the chromosome numbers in the range of [from_chr, to_chr) for each chromosome.
+        Only the bim files of the genotypes are read.
+
+    output_address : str
+        Address of the cache directory.
+
+    --bim : str, optional
+        Address of a bim file containing positions of SNPs if the address is different from Bim file of genotypes. It can contain ~ as well.
+
+    --from_chr : int, optional
+        Which chromosome (<=). Should be used with to_chr parameter.
+
+    --to_chr : int, optional
+        Which chromosome (<). Should be used with from_chr parameter.
+
+Results:
+    npy files
+        For each chromosome i, the files output_address/chr{i}.pair_ids.npy, output_address/chr{i}.pair_segment_offsets.npy and output_address/chr{i}.segments.npy.
+        Take a look at sibreg.bin.preprocess_data.write_ibd_cache for more information.
+"""
+import logging
+import argparse
+import pandas as pd
+from sibreg.bin.preprocess_data import write_ibd_cache
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(module)s - %(funcName)s: %(message)s')
+    parser = argparse.ArgumentParser()
+    parser.add_argument('ibd',
+                        type=str,
+                        help='IBD file')
+    parser.add_argument('genotypes_address',
+                        type=str,
+                        help='Address of genotypes in .bed format. If there is a ~ in the address, ~ is replaced by the chromosome numbers in the range of [from_chr, to_chr) for each chromosome.')
+    parser.add_argument('output_address',
+                        type=str,
+                        help='Address of the cache directory')
+    parser.add_argument('--bim',
+                        type=str,
+                        default = None,
+                        help='Address of a bim file containing positions of SNPs if the address is different from Bim file of genotypes')
+    parser.add_argument('--from_chr',
+                        type=int,
+                        default = 1,
+                        help='Which chromosome (<=). Should be used with to_chr parameter.')
+    parser.add_argument('--to_chr',
+                        type=int,
+                        default = 2,
+                        help='Which chromosome (<). Should be used with from_chr parameter.')
+    args=parser.parse_args()
+    logging.info("Loading ibd ...")
+    ibd_pd = pd.read_csv(args.ibd, sep = "\t")
+    logging.info("ibd loaded.")
+    if args.bim is None:
+        bim_address = args.genotypes_address+".bim"
+    else:
+        bim_address = args.bim
+    if "~" in bim_address:
+        bim_addresses = [bim_address.replace("~", str(chromosome)) for chromosome in range(args.from_chr, args.to_chr)]
+    else:
+        bim_addresses = [bim_address]
+    for bim_address in bim_addresses:
+        bim = pd.read_csv(bim_address, sep = "\t", header=None, names=["Chr", "id", "morgans", "coordinate", "allele1", "allele2"])
+        write_ibd_cache(ibd_pd, bim, args.output_address)
+    logging.info("ibd cache written to " + args.output_address)
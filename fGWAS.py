@@ -207,7 +207,7 @@ if __name__ == '__main__':
         ValueError('No SNPs in common between imputed and observed genotypes')
     # Read imputed parental genotypes
     print('Reading imputed parental genotypes')
-    imp_gts = np.array(par_gts_f['imputed_par_gts'][imp_indices,:])
+    imp_gts = sibreg.read_imputed_par_gts(par_gts_f['imputed_par_gts'], (imp_indices, slice(None)))
     imp_gts = imp_gts[:,in_obs_sid]
     fams = fams[imp_indices]
     # Read observed genotypes
@@ -255,17 +255,12 @@ if __name__ == '__main__':
     print('Family variance estimate: '+str(round(sigma2/tau,4)))
     print('Residual variance estimate: ' + str(round(sigma2,4)))
     ##### Transform ######
-    #### Get inverse square root of Sigma ###
     print('Transforming genotypes and phenotypes')
-    L = null_model.sigma_inv_root(tau,sigma2)
     #### Transform genotype and phenotype ###
     # Mean normalise
     y = y - np.mean(y)
-    for label in L.keys():
-        label_indices = null_model.label_indices[label]
-        y[label_indices] = np.dot(L[label],y[label_indices])
-        for i in range(G.shape[2]):
-            G[:,label_indices,i] = np.dot(G[:,label_indices,i],L[label].T)
+    y = null_model.whiten(y,tau,sigma2)
+    G = null_model.whiten(G,tau,sigma2,axis=1)
     ### Fit models for SNPs ###
     print('Estimating SNP effects')
     XTX = np.einsum('...ij,...ik', G, G)
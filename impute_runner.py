@@ -19,6 +19,7 @@ Args:
             Address of a file containing IBD statuses for all SNPs.
         This is a '\t seperated CSV with these columns: "chr", "ID1", "ID2", "IBDType", "StartSNP", "StopSNP".
         Each line states an IBD segment between a pair on individuals. This can be generated using King software
+        It can also be the address of a cache directory written by create_ibd_cache.py, which is read much faster.
 
     genotypes_address : str
         Address of genotypes in .bed format. If there is a ~ in the address, ~ is replaced by the chromosome numbers in the range of [from_chr, to_chr) for each chromosome(from_chr and to_chr are two optional parameters for this script).
@@ -69,6 +70,45 @@ Args:
     --output_compression_opts': int, optional
         Additional settings for the optional compression algorithm. Take a look at the create_dataset function of h5py library for more information.
 
+    --max_memory: int, optional
+        If specified, genotypes of each chromosome are read and imputed in slices of SNPs, and the results are written to the output as each slice is done.
+        The size of the slices is chosen so that the genotypes, the imputed genotypes and their encodings held at once take at most this many megabytes.
+        The pedigree, the sibships and the IBD segments are not counted. Take a look at get_chunk_size.
+
+    --output_chunk_layout: str, optional
+        Chunk layout of the imputed genotypes in the output. 'snp' chunks hold many families and few SNPs and are fast to read for a subset of SNPs, like fGWAS and fPGS do.
+        'fam' chunks hold few families and many SNPs and are fast to read for a subset of families. With 'auto', the default, h5py chooses the chunks.
+        With gzip compression and 'snp' or 'fam' chunks, the chunks are compressed in parallel with --threads threads.
+
+    --output_chunk_kb: int, optional
+        Size of the chunks of the imputed genotypes in the output in kilobytes. The default is 1024.
+
+    --output_encoding: str, optional
+        Encoding of the imputed genotypes in the output. 'float16', the default, or 'uint8', which stores each imputed genotype as a dosage in [0, 2]
+        quantised to 255 levels, with 255 for missing values. The scale and the missing value code are stored as attributes of 'imputed_par_gts'.
+        sibreg.sibreg.read_imputed_par_gts decodes both encodings.
+
+    --snp_tile_size: int, optional
+        Threads are scheduled over families and tiles of this many SNPs. Smaller tiles keep more threads busy when there are few families. The default is 1024.
+
+    --shared_data: optional
+        The sibships and the IBD segment index of each chromosome are built once before the process pool is started. The index is written to memory-mapped files
+        that are shared read-only by the processes, so the IBD table is not sent to and transformed by each of them. The pedigree and the sibships are handed to
+        the processes once when they start, rather than with each chromosome, and with the fork start method they are inherited without being copied.
+        The memory-mapped files are removed when the imputation ends or fails.
+
+    --resume: optional
+        Resumes a previous run. Chromosomes whose output already exists are skipped, and with --max_memory the slices of SNPs recorded in the
+        manifest of the previous run are not imputed again. Outputs are written to a temporary file and renamed when complete, so an existing output is always complete.
+
+    --genome_output: str, optional
+        If specified, the outputs of all the chromosomes are merged into one whole genome HDF5 file at this address(without '.hdf5').
+        The file has the pedigree, families and parental status once, a group with the imputed genotypes, positions and bim of each chromosome
+        and a SNP index for reading regions. Take a look at merge_imputation_outputs.
+
+    --remove_chromosome_outputs
+        With --genome_output, removes the outputs of the chromosomes after they are merged. They are kept by default.
+
 Results:
     HDF5 files
         For each chromosome i, an HDF5 file is created at outprefix{i}. This file contains imputed genotypes, the position of SNPs, columns of resulting bim file, contents of resulting bim file, pedigree table and, family ids
@@ -84,23 +124,352 @@ import h5py
 import random
 import pandas as pd
 import os
+import json
+import shutil
+import tempfile
 from multiprocessing import Pool
+from concurrent.futures import ThreadPoolExecutor
 random.seed(1567924)
 
+def get_chunk_size(max_memory, number_of_individuals, number_of_fams, output_itemsize = 2):
+    """Returns the number of SNPs that can be imputed at once with max_memory megabytes
+
+    For each SNP of a slice, these are held at once:
+        For each individual, the int8 genotypes of the slice that's imputed and of the next slice that's read meanwhile, and the packed bytes and
+        the decoded genotypes of the block of BedGenotypeReader, which is at most as large as the slice.
+        For each family, the float64 imputed genotypes of the slice, which impute returns without a copy, and the encoded genotypes of the slice
+        and of the previous slice that's written meanwhile, with output_itemsize bytes each.
+        The float32 table of sibreg.bin.impute_from_sibs.fill_parent_offsprings_table, and the allele frequency, genotype sum and genotype count of the SNP.
+    The temporaries of sibreg.bin.impute_from_sibs.encode_imputed_gts take a fixed ENCODE_BLOCK_SIZE float64 and bool values, which are taken out of the ceiling.
+
+    Args:
+        max_memory : int
+            Memory ceiling in megabytes.
+
+        number_of_individuals : int
+            Number of individuals whose genotypes are read.
+
+        number_of_fams : int
+            Number of the imputed families.
+
+        output_itemsize : int, optional
+            Bytes of an encoded imputed genotype in the output, 2 for float16 and 1 for uint8.
+
+    Returns:
+        int
+            Number of SNPs in each slice. It's at least one.
+    """
+    bytes_per_snp = number_of_individuals*(1+1+2) + number_of_fams*(8+2*output_itemsize) + PARENT_OFFSPRINGS_TABLE_SIZE*4 + 3*8
+    available_bytes = max_memory*2**20 - ENCODE_BLOCK_SIZE*(8+1)
+    return max(1, available_bytes//bytes_per_snp)
+
+def read_manifest(manifest_address):
+    """Reads the checkpoint manifest of a chunked imputation and returns it, or None if there is no readable manifest
+
+    Args:
+        manifest_address : str
+            Address of the manifest file.
+
+    Returns:
+        dict
+            The manifest. It has keys "number_of_snps", "number_of_fams", "chunk_size", "encoding" and "done", where "done" is the list of the [start, end) slices of SNPs
+            that are imputed and written to the partial output.
+    """
+    if not os.path.exists(manifest_address):
+        return None
+    try:
+        with open(manifest_address) as f:
+            return json.load(f)
+    except ValueError:
+        logging.warning("could not read the manifest " + manifest_address)
+        return None
+
+def write_manifest(manifest_address, manifest):
+    """Writes the checkpoint manifest of a chunked imputation atomically
+
+    The manifest is written to a temporary file that's renamed to manifest_address, so a preempted run never leaves a half written manifest.
+
+    Args:
+        manifest_address : str
+            Address of the manifest file.
+
+        manifest : dict
+            The manifest, take a look at read_manifest.
+    """
+    with open(manifest_address+".tmp", "w") as f:
+        json.dump(manifest, f)
+    os.replace(manifest_address+".tmp", manifest_address)
+
+IBD_INDEX_KEYS = ["fam_pair_offsets", "pair_segment_offsets", "segments", "fam_breakpoint_offsets", "breakpoints"]
+
+def write_ibd_index(ibd_index_address, ibd_index):
+    """Writes the IBD segment index built by sibreg.bin.impute_from_sibs.build_ibd_index so it can be memory-mapped by read_ibd_index
+
+    Args:
+        ibd_index_address : str
+            Address of the index. Each of its arrays is written to ibd_index_address.{name}.npy.
+
+        ibd_index : tuple(numpy.array, numpy.array, numpy.array, numpy.array, numpy.array)
+            Output of sibreg.bin.impute_from_sibs.build_ibd_index.
+    """
+    for key, array in zip(IBD_INDEX_KEYS, ibd_index):
+        np.save(ibd_index_address+"."+key+".npy", array)
+
+def read_ibd_index(ibd_index_address):
+    """Memory-maps the IBD segment index written by write_ibd_index read-only and returns it
+
+    Pages of the index are shared by all the processes that map it.
+
+    Args:
+        ibd_index_address : str
+            Address of the index.
+
+    Returns:
+        tuple(numpy.array, numpy.array, numpy.array, numpy.array, numpy.array)
+            The same as the output of sibreg.bin.impute_from_sibs.build_ibd_index.
+    """
+    return tuple(np.load(ibd_index_address+"."+key+".npy", mmap_mode="r") for key in IBD_INDEX_KEYS)
+
+def prepare_shared_data(pedigree, ibd_pd, bim_addresses, shared_data_dir):
+    """Builds the sibships of the pedigree and the IBD segment index of each chromosome once, so they can be shared by the imputation processes
+
+    Args:
+        pedigree : pd.DataFrame
+            The pedigree table. It contains 'FID', 'IID', 'FATHER_ID' and, 'MOTHER_ID' columns.
+
+        ibd_pd : pd.DataFrame or str
+            IBD segments table in King format, or the address of a cache written by sibreg.bin.preprocess_data.write_ibd_cache.
+
+        bim_addresses : list
+            Addresses of the bim files of the chromosomes(includes '.bim').
+
+        shared_data_dir : str
+            Directory that the IBD segment indices are written to.
+
+    Returns:
+        tuple(tuple(pandas.Dataframe, set), list)
+            The first element is the output of sibreg.bin.preprocess_data.prepare_sibships. The second element is the address of the
+            IBD segment index of each chromosome, to be read with read_ibd_index.
+    """
+    sibships = prepare_sibships(pedigree)
+    fams = sibships[0]["IID"].values.tolist()
+    ibd_index_addresses = []
+    for index, bim_address in enumerate(bim_addresses):
+        logging.info("building the shared ibd index for " + bim_address)
+        bim = pd.read_csv(bim_address, sep = "\t", header=None, names=["Chr", "id", "morgans", "coordinate", "allele1", "allele2"])
+        chromosomes = bim["Chr"].unique().astype(str)
+        if isinstance(ibd_pd, str):
+            ibd = read_ibd_cache(ibd_pd, chromosomes)
+        else:
+            ibd = prepare_ibd(ibd_pd, bim, chromosomes)
+        ibd_index_address = os.path.join(shared_data_dir, "ibd_index"+str(index))
+        write_ibd_index(ibd_index_address, build_ibd_index(fams, ibd))
+        ibd_index_addresses.append(ibd_index_address)
+    return sibships, ibd_index_addresses
+
+def run_chunked_imputation(sibships, iid_to_bed_index, gts_reader, ibd, pos, chromosomes, hdf5_output_dict, output_address, max_memory, threads = None, output_compression = None, output_compression_opts = None, snp_tile_size = 1024, resume = False, output_chunk_layout = "auto", output_chunk_kb = 1024, output_encoding = "float16"):
+    """Reads and imputes the genotypes in slices of SNPs and writes each slice to the output as it's done
+
+    The next slice is read and the previous slice is written while the current one is imputed. Slices are made of whole columns of chunks of the output
+    when the chunks are not larger than the slices, so their chunks can be compressed in parallel. Slices are written to output_address.tmp.hdf5 and recorded in the manifest
+    output_address.manifest.json as they are done. When all the slices are done, the output is renamed to output_address.hdf5.
+
+    Args:
+        sibships, iid_to_bed_index, gts_reader, ibd, pos, chromosomes, hdf5_output_dict
+            Output of sibreg.bin.preprocess_data.prepare_lazy_data.
+
+        output_address : str
+            The result of the imputation is written to output_address.hdf5.
+
+        max_memory : int
+            Memory ceiling for the genotypes and the imputed genotypes held at once, in megabytes.
+
+        threads : int, optional
+            Number of the threads to be used. The default number of the threads is one.
+
+        output_compression: str, optional
+            Optional compression algorithm used in writing the output as an hdf5 file. It can be either gzip or lzf. None means no compression.
+
+        output_compression_opts': int, optional
+            Additional settings for the optional compression algorithm. Take a look at the create_dataset function of h5py library for more information. None means no compression setting.
+
+        snp_tile_size : int, optional
+            Threads are scheduled over families and tiles of this many SNPs.
+
+        resume : bool, optional
+            If True, the slices recorded in the manifest of a previous run with the same slices are not imputed again.
+
+        output_chunk_layout : str, optional
+            Chunk layout of the imputed genotypes in the output, "snp", "fam" or "auto". Take a look at sibreg.bin.impute_from_sibs.get_output_chunk_shape.
+
+        output_chunk_kb : int, optional
+            Size of the chunks of the imputed genotypes in the output in kilobytes.
+
+        output_encoding : str, optional
+            Encoding of the imputed genotypes in the output, "float16" or "uint8". Take a look at sibreg.bin.impute_from_sibs.create_imputed_gts_dataset.
+    """
+    number_of_snps = pos.shape[0]
+    number_of_fams = sibships.shape[0]
+    chunk_size = get_chunk_size(max_memory, gts_reader.iid_count, number_of_fams, np.dtype(output_encoding).itemsize)
+    output_chunks = get_output_chunk_shape(number_of_fams, number_of_snps, output_chunk_layout, output_chunk_kb, np.dtype(output_encoding).itemsize)
+    if output_chunks is not True and output_chunks[1] <= chunk_size:
+        chunk_size = chunk_size//output_chunks[1]*output_chunks[1]
+    chunks = [(chunk_start, min(chunk_start+chunk_size, number_of_snps)) for chunk_start in range(0, number_of_snps, chunk_size)]
+    logging.info("with chromosome " + str(chromosomes)+": " + "imputing "+str(number_of_snps)+" SNPs in "+str(len(chunks))+" slices of "+str(chunk_size)+" SNPs")
+    #the index of ibd segments is built once and used for all the slices
+    if not is_ibd_index(ibd):
+        ibd = build_ibd_index(sibships["IID"].values.tolist(), ibd)
+    partial_address = output_address+".tmp.hdf5"
+    manifest_address = output_address+".manifest.json"
+    manifest = {"number_of_snps":number_of_snps, "number_of_fams":number_of_fams, "chunk_size":chunk_size, "encoding":output_encoding, "done":[]}
+    previous_manifest = read_manifest(manifest_address)
+    if resume and previous_manifest is not None and os.path.exists(partial_address):
+        if all(previous_manifest.get(key) == manifest[key] for key in ["number_of_snps", "number_of_fams", "chunk_size", "encoding"]):
+            manifest["done"] = previous_manifest["done"]
+            logging.info("with chromosome " + str(chromosomes)+": " + "resuming with "+str(len(manifest["done"]))+" slices already done")
+        else:
+            logging.warning("with chromosome " + str(chromosomes)+": " + "the manifest does not match this run, starting over")
+    done = set(tuple(chunk) for chunk in manifest["done"])
+    chunks = [chunk for chunk in chunks if chunk not in done]
+    with h5py.File(partial_address, 'r+' if done else 'w') as f, ThreadPoolExecutor(max_workers=1) as reader, ThreadPoolExecutor(max_workers=1) as writer_thread:
+        if done:
+            imputed_par_gts = f['imputed_par_gts']
+        else:
+            imputed_par_gts = create_imputed_gts_dataset(f, number_of_fams, number_of_snps, output_encoding, output_chunk_layout, output_chunk_kb, output_compression, output_compression_opts)
+            write_output_metadata(f, sibships, pos, hdf5_output_dict)
+            f.flush()
+            write_manifest(manifest_address, manifest)
+        def write_chunk(writer, chunk_start, imputed_chunk):
+            writer.write(chunk_start, imputed_chunk)
+            f.flush()
+        def record_chunk(chunk, written):
+            #the slice is recorded only after it's flushed to the file
+            written.result()
+            manifest["done"].append(list(chunk))
+            write_manifest(manifest_address, manifest)
+        with ParallelChunkWriter(imputed_par_gts, threads) as writer:
+            if chunks:
+                next_gts = reader.submit(read_gts, gts_reader, chunks[0][0], chunks[0][1])
+            pending = None
+            for chunk_index, (chunk_start, chunk_end) in enumerate(chunks):
+                gts = next_gts.result()
+                if chunk_index+1 < len(chunks):
+                    next_gts = reader.submit(read_gts, gts_reader, chunks[chunk_index+1][0], chunks[chunk_index+1][1])
+                logging.info("with chromosome " + str(chromosomes)+": " + "imputing SNPs "+str(chunk_start)+" to "+str(chunk_end))
+                imputed_fids, imputed_chunk = impute(sibships, iid_to_bed_index, gts, ibd, pos[chunk_start:chunk_end], hdf5_output_dict, str(chromosomes), threads = threads, snp_tile_size = snp_tile_size)
+                del gts
+                if pending is not None:
+                    record_chunk(*pending)
+                pending = ((chunk_start, chunk_end), writer_thread.submit(write_chunk, writer, chunk_start, encode_imputed_gts(imputed_chunk, output_encoding)))
+                del imputed_chunk
+            if pending is not None:
+                record_chunk(*pending)
+    os.replace(partial_address, output_address+".hdf5")
+    os.remove(manifest_address)
+
+def merge_imputation_outputs(output_addresses, genome_output_address, remove_outputs = False):
+    """Merges the imputation outputs of the chromosomes into one whole genome HDF5 file
+
+    The pedigree, families and parental status, which are the same in all the outputs, are written once at the root of the file.
+    The imputed genotypes, positions and bim of each chromosome are copied, without being decoded or recompressed, to a group named after its
+    chromosomes, e.g. chr1. A chromosome can only be in one of the outputs.
+    The group snp_index has one row for each SNP, sorted by chromosome and position, in its datasets 'chromosome', 'pos', 'sid', 'group' and 'column'.
+    Numeric chromosomes are sorted by their number and come before the others(e.g. X), which are sorted by name.
+    'group' is the index of the group of the SNP in snp_index/groups and 'column' is its column in the imputed genotypes of that group.
+    sibreg.sibreg.read_imputed_region reads the imputed genotypes of a region with this index.
+
+    Args:
+        output_addresses : list
+            Addresses of the imputation outputs of the chromosomes, without '.hdf5'.
+
+        genome_output_address : str
+            The whole genome output is written to genome_output_address.hdf5.
+
+        remove_outputs : bool
+            If True, the outputs of the chromosomes are removed after the whole genome output is written.
+    """
+    #chromosomes of each output are checked before anything is written
+    output_chromosomes = []
+    for output_address in output_addresses:
+        with h5py.File(output_address+".hdf5", "r") as f:
+            bim_columns = np.array(f["bim_columns"]).astype(str).tolist()
+            output_chromosomes.append(np.unique(np.array(f["bim_values"])[:, bim_columns.index("Chr")].astype(str)).tolist())
+    all_chromosomes = [chromosome for chromosomes in output_chromosomes for chromosome in chromosomes]
+    duplicates = sorted({chromosome for chromosome in all_chromosomes if all_chromosomes.count(chromosome) > 1})
+    if duplicates:
+        raise ValueError("chromosomes " + ", ".join(duplicates) + " are in more than one of the outputs to merge")
+    chromosome_order = sorted(set(all_chromosomes), key = lambda chromosome: (0, int(chromosome), "") if chromosome.isdigit() else (1, 0, chromosome))
+    chromosome_rank = {chromosome:rank for rank, chromosome in enumerate(chromosome_order)}
+    index = {"chromosome":[], "pos":[], "sid":[], "group":[], "column":[]}
+    groups = []
+    with h5py.File(genome_output_address+".tmp.hdf5", "w") as genome_file:
+        for group_index, (output_address, chromosomes) in enumerate(zip(output_addresses, output_chromosomes)):
+            logging.info("merging " + output_address + ".hdf5 into " + genome_output_address + ".hdf5")
+            with h5py.File(output_address+".hdf5", "r") as f:
+                if group_index == 0:
+                    for key in ["pedigree", "families", "parental_status"]:
+                        f.copy(key, genome_file)
+                elif not np.array_equal(f["families"][:], genome_file["families"][:]):
+                    raise ValueError(output_address + ".hdf5 does not have the same families as the other chromosomes")
+                bim_columns = np.array(f["bim_columns"]).astype(str).tolist()
+                bim_values = np.array(f["bim_values"])
+                group = "chr" + "_".join(chromosomes)
+                genome_file.create_group(group)
+                for key in ["imputed_par_gts", "pos", "bim_columns", "bim_values"]:
+                    f.copy(key, genome_file[group])
+                index["chromosome"].append(bim_values[:, bim_columns.index("Chr")])
+                index["sid"].append(bim_values[:, bim_columns.index("id")])
+                index["pos"].append(np.array(f["pos"]))
+                index["group"].append(np.full(bim_values.shape[0], group_index))
+                index["column"].append(np.arange(bim_values.shape[0]))
+                groups.append(group)
+        index = {key:np.concatenate(values) for key, values in index.items()}
+        ranks = np.array([chromosome_rank[chromosome] for chromosome in index["chromosome"].astype(str)])
+        order = np.lexsort((index["pos"], ranks))
+        for key, values in index.items():
+            genome_file["snp_index/"+key] = values[order]
+        genome_file["snp_index/groups"] = np.array(groups, dtype='S')
+    os.replace(genome_output_address+".tmp.hdf5", genome_output_address+".hdf5")
+    if remove_outputs:
+        for output_address in output_addresses:
+            os.remove(output_address+".hdf5")
+
+#data handed to the imputation processes once when they start, take a look at set_shared_data
+SHARED_DATA = {}
+
+def set_shared_data(shared_data):
+    """Sets the data shared by all the chromosomes imputed by this process. It's the initializer of the process pool.
+
+    With the fork start method, the arguments of the initializer are inherited by the processes without being pickled.
+
+    Args:
+        shared_data : dict
+            It can have the keys "pedigree" and "sibships", which run_imputation uses when its input does not have them.
+    """
+    SHARED_DATA.update(shared_data)
+
 def run_imputation(data):
     """Runs the imputation and returns the consumed time
     Args:
         data : dict
             a dictionary with these keys and values:
             Keys:
-                pedigree: pd.Dataframe
-                    The standard pedigree table
+                pedigree: pd.Dataframe, optional
+                    The standard pedigree table. If not specified, the pedigree set by set_shared_data is used.
 
                 bed_address: str
                     Address of the bed file.
 
-                ibd_pd: pd.Dataframe
-                    IBD segments table in King format. Only needs to contain information about this chromosome
+                ibd_pd: pd.Dataframe or str
+                    IBD segments table in King format. Only needs to contain information about this chromosome.
+                    It can also be the address of a cache written by sibreg.bin.preprocess_data.write_ibd_cache.
+
+                sibships: tuple(pandas.Dataframe, set), optional
+                    Output of sibreg.bin.preprocess_data.prepare_sibships for the pedigree. If specified, it's used instead of finding the sibships again.
+                    If not specified, the sibships set by set_shared_data, if any, are used.
+
+                ibd_index_address: str, optional
+                    Address of the IBD segment index of this chromosome written by write_ibd_index. If specified, the index is memory-mapped and ibd_pd is not used.
 
                 output_address: str
                     The address to write the result of imputation on. The default value for output_address is 'parent_imputed_chr'.
@@ -123,13 +492,33 @@ def run_imputation(data):
 
                 output_compression_opts': int, optional
                     Additional settings for the optional compression algorithm. Take a look at the create_dataset function of h5py library for more information. None means no compression setting.
+
+                max_memory: int, optional
+                    If specified, the genotypes are read and imputed in slices of SNPs so that they take at most this many megabytes.
+
+                snp_tile_size: int, optional
+                    Threads are scheduled over families and tiles of this many SNPs. The default is 1024.
+
+                resume: bool, optional
+                    If True, the chromosome is skipped if its output already exists, and a chunked imputation continues from the slices recorded in its manifest.
+
+                output_chunk_layout: str, optional
+                    Chunk layout of the imputed genotypes in the output, "snp", "fam" or "auto". The default is "auto".
+
+                output_chunk_kb: int, optional
+                    Size of the chunks of the imputed genotypes in the output in kilobytes. The default is 1024.
+
+                output_encoding: str, optional
+                    Encoding of the imputed genotypes in the output, "float16" or "uint8". The default is "float16".
     Returns:
         float
             time consumed byt the imputation.
     """
-    pedigree = data["pedigree"]
+    pedigree = data.get("pedigree", SHARED_DATA.get("pedigree"))
     bed_address = data["bed_address"]
-    ibd_pd = data["ibd_pd"]
+    ibd_pd = data.get("ibd_pd")
+    sibships = data.get("sibships", SHARED_DATA.get("sibships"))
+    ibd_index_address = data.get("ibd_index_address")
     output_address = data["output_address"]
     start = data.get("start")
     end = data.get("end")
@@ -137,13 +526,32 @@ def run_imputation(data):
     threads = data.get("threads")
     output_compression = data.get("output_compression")
     output_compression_opts = data.get("output_compression_opts")
+    max_memory = data.get("max_memory")
+    snp_tile_size = data.get("snp_tile_size", 1024)
+    resume = data.get("resume", False)
+    output_chunk_layout = data.get("output_chunk_layout", "auto")
+    output_chunk_kb = data.get("output_chunk_kb", 1024)
+    output_encoding = data.get("output_encoding", "float16")
+    #outputs are only created by renaming complete files, so an existing output is complete
+    if resume and os.path.exists(output_address+".hdf5"):
+        logging.info("skipping " + bed_address + ", " + output_address + ".hdf5 already exists")
+        return 0
     logging.info("processing " + bed_address)
-    sibships, iid_to_bed_index, gts, ibd, pos, chromosomes, hdf5_output_dict = prepare_data(pedigree, bed_address, ibd_pd, start, end, bim)
-    gts = gts.astype(float)
+    if ibd_index_address is not None:
+        ibd_pd = read_ibd_index(ibd_index_address)
+    if max_memory is not None:
+        sibships, iid_to_bed_index, gts_reader, ibd, pos, chromosomes, hdf5_output_dict = prepare_lazy_data(pedigree, bed_address, ibd_pd, start, end, bim, sibships)
+        pos = pos.astype(int)
+        start_time = time.time()
+        run_chunked_imputation(sibships, iid_to_bed_index, gts_reader, ibd, pos, chromosomes, hdf5_output_dict, output_address, max_memory, threads = threads, output_compression=output_compression, output_compression_opts=output_compression_opts, snp_tile_size = snp_tile_size, resume = resume, output_chunk_layout = output_chunk_layout, output_chunk_kb = output_chunk_kb, output_encoding = output_encoding)
+        end_time = time.time()
+        return (end_time-start_time)
+    sibships, iid_to_bed_index, gts, ibd, pos, chromosomes, hdf5_output_dict = prepare_data(pedigree, bed_address, ibd_pd, start, end, bim, sibships)
     pos = pos.astype(int)
     start_time = time.time()
-    imputed_fids, imputed_par_gts = impute(sibships, iid_to_bed_index, gts, ibd, pos, hdf5_output_dict, str(chromosomes), output_address, threads = threads, output_compression=output_compression, output_compression_opts=output_compression_opts)
+    imputed_fids, imputed_par_gts = impute(sibships, iid_to_bed_index, gts, ibd, pos, hdf5_output_dict, str(chromosomes), output_address+".tmp", threads = threads, output_compression=output_compression, output_compression_opts=output_compression_opts, snp_tile_size = snp_tile_size, output_chunk_layout = output_chunk_layout, output_chunk_kb = output_chunk_kb, output_encoding = output_encoding)
     end_time = time.time()
+    os.replace(output_address+".tmp.hdf5", output_address+".hdf5")
     return (end_time-start_time)
 
 #does the imputation and writes the results
@@ -154,7 +562,7 @@ if __name__ == "__main__":
                         action='store_true')    
     parser.add_argument('ibd',
                         type=str,
-                        help='IBD file')
+                        help='IBD file, or a cache directory written by create_ibd_cache.py')
     parser.add_argument('genotypes_address',
                         type=str,help='Address of genotypes in .bed format. If there is a ~ in the address, ~ is replaced by the chromosome numbers in the range of [from_chr, to_chr) for each chromosome(from_chr and to_chr are two optional parameters for this script).')
     parser.add_argument('--from_chr',
@@ -209,6 +617,42 @@ if __name__ == "__main__":
                         type=int,
                         default=None,
                         help='Additional settings for the optional compression algorithm. Take a look at the create_dataset function of h5py library for more information.')
+    parser.add_argument('--max_memory',
+                        type=int,
+                        default=None,
+                        help='If specified, genotypes are read and imputed in slices of SNPs that take at most this many megabytes, and each slice is written to the output as it is done.')
+    parser.add_argument('--output_chunk_layout',
+                        type=str,
+                        default="auto",
+                        choices=["auto", "snp", "fam"],
+                        help="Chunk layout of the imputed genotypes in the output. 'snp' chunks are fast to read for a subset of SNPs, 'fam' chunks for a subset of families.")
+    parser.add_argument('--output_chunk_kb',
+                        type=int,
+                        default=1024,
+                        help='Size of the chunks of the imputed genotypes in the output in kilobytes.')
+    parser.add_argument('--output_encoding',
+                        type=str,
+                        default="float16",
+                        choices=["float16", "uint8"],
+                        help="Encoding of the imputed genotypes in the output. 'uint8' stores quantised dosages with half the size of 'float16'.")
+    parser.add_argument('--snp_tile_size',
+                        type=int,
+                        default=1024,
+                        help='Threads are scheduled over families and tiles of this many SNPs. Smaller tiles keep more threads busy when there are few families.')
+    parser.add_argument('--resume',
+                        action='store_true',
+                        help='Skips the chromosomes whose output already exists and, with --max_memory, the slices of SNPs already done by a previous run.')
+    parser.add_argument('--genome_output',
+                        type=str,
+                        default=None,
+                        help='Merges the outputs of all the chromosomes into one whole genome HDF5 file at this address.')
+    parser.add_argument('--remove_chromosome_outputs',
+                        action='store_true',
+                        default=False,
+                        help='With --genome_output, removes the outputs of the chromosomes after they are merged.')
+    parser.add_argument('--shared_data',
+                        action='store_true',
+                        help='Builds the sibships and the ibd index of each chromosome once and shares them with the processes. The index is shared through memory-mapped files, which are removed at the end.')
 
     args=parser.parse_args()
     #fids starting with _ are reserved for control
@@ -225,9 +669,13 @@ if __name__ == "__main__":
         pedigree = add_control(pedigree)
         logging.info("Control Added.")
     
-    logging.info("Loading ibd ...")
-    ibd_pd = pd.read_csv(args.ibd, sep = "\t")
-    logging.info("ibd loaded.")
+    if os.path.isdir(args.ibd):
+        #segments are memory-mapped from the cache by each process
+        ibd_pd = args.ibd
+    else:
+        logging.info("Loading ibd ...")
+        ibd_pd = pd.read_csv(args.ibd, sep = "\t")
+        logging.info("ibd loaded.")
     if (args.from_chr is not None) and (args.to_chr is not None):
         chromosomes = [str(chromosome) for chromosome in range(args.from_chr, args.to_chr)]
     else:
@@ -237,20 +685,61 @@ if __name__ == "__main__":
         if args.to_chr is None or args.from_chr is None:
             raise Exception("no chromosome range specified for the wildcard ~ in the address") 
 
-    inputs = [{"pedigree": pedigree,
-            "bed_address": args.genotypes_address.replace("~", chromosome),
-            "ibd_pd": ibd_pd, #[ibd_pd["Chr"] == chromosome],
-            "output_address":args.output_address.replace("~", chromosome),
-            "start": args.start,
-            "end": args.end,
-            "bim": args.bim,
-            "threads": args.threads,
-            "output_compression":args.output_compression,
-            "output_compression_opts":args.output_compression_opts,
-                }
-            for chromosome in chromosomes]
-            
-    pool = Pool(args.processes)
-    logging.info("staring process pool")
-    consumed_time = pool.map(run_imputation, inputs)
+    bed_addresses = [args.genotypes_address.replace("~", chromosome) for chromosome in chromosomes]
+    shared_data_dir = None
+    pool = None
+    try:
+        if args.shared_data:
+            shared_data_dir = tempfile.mkdtemp(prefix="impute_shared_data", dir=os.path.dirname(os.path.abspath(args.output_address)))
+            if args.bim is None:
+                bim_addresses = [bed_address+".bim" for bed_address in bed_addresses]
+            else:
+                bim_addresses = [args.bim]*len(bed_addresses)
+            sibships, ibd_index_addresses = prepare_shared_data(pedigree, ibd_pd, bim_addresses, shared_data_dir)
+            #workers only receive the addresses of the memory-mapped indices, and get the pedigree and the sibships once when they start
+            del ibd_pd
+            shared_data = {"pedigree":pedigree, "sibships":sibships}
+            shared_inputs = [{"ibd_index_address":ibd_index_address} for ibd_index_address in ibd_index_addresses]
+        else:
+            shared_data = {}
+            shared_inputs = [{"pedigree":pedigree, "ibd_pd":ibd_pd} for bed_address in bed_addresses]
+
+        inputs = [dict({"bed_address": bed_address,
+                "output_address":args.output_address.replace("~", chromosome),
+                "start": args.start,
+                "end": args.end,
+                "bim": args.bim,
+                "threads": args.threads,
+                "output_compression":args.output_compression,
+                "output_compression_opts":args.output_compression_opts,
+                "max_memory":args.max_memory,
+                "snp_tile_size":args.snp_tile_size,
+                "output_chunk_layout":args.output_chunk_layout,
+                "output_chunk_kb":args.output_chunk_kb,
+                "output_encoding":args.output_encoding,
+                "resume":args.resume,
+                    }, **shared_input)
+                for chromosome, bed_address, shared_input in zip(chromosomes, bed_addresses, shared_inputs)]
+
+        if args.genome_output is not None and args.resume and os.path.exists(args.genome_output+".hdf5"):
+            logging.info(args.genome_output + ".hdf5 already exists, skipping the imputation")
+            inputs = []
+
+        pool = Pool(args.processes, initializer = set_shared_data, initargs = (shared_data,))
+        logging.info("staring process pool")
+        consumed_time = []
+        #chromosomes are logged as they finish
+        for chromosome_time in pool.imap_unordered(run_imputation, inputs):
+            consumed_time.append(chromosome_time)
+            logging.info(str(len(consumed_time))+" of "+str(len(inputs))+" chromosomes done")
+        pool.close()
+    finally:
+        #the workers are stopped, also when a chromosome fails or the run is interrupted, before their memory-mapped files are removed
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        if shared_data_dir is not None:
+            shutil.rmtree(shared_data_dir, ignore_errors = True)
     logging.info("imputation time: "+str(np.sum(consumed_time)))
+    if args.genome_output is not None and inputs:
+        merge_imputation_outputs([data["output_address"] for data in inputs], args.genome_output, remove_outputs = args.remove_chromosome_outputs)
@@ -0,0 +1,4 @@
+"""Contains the constants shared by the preprocessing in python and the imputation in cython.
+"""
+#Genotypes are stored as int8 and missing genotypes are marked with this value
+MISSING_GENOTYPE = -1
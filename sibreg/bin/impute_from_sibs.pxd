@@ -10,24 +10,34 @@ cdef int get_IBD_type(cstring id1,
                       int loc,
                       cmap[cpair[cstring, cstring], vector[int]]& ibd_dict) nogil
 
+cdef int get_IBD_type_from_index(int loc,
+                                 const int[:, :] segments,
+                                 int first,
+                                 int last,
+                                 int* cursor) nogil
+
 cdef float impute_snp_from_offsprings(int snp, 
                                     int[:, :] snp_ibd0,
                                     int[:, :] snp_ibd1,
                                     int[:, :] snp_ibd2,
                                     float f,
-                                    double[:, :] bed,
+                                    signed char[:, :] bed,
                                     int len_snp_ibd0,
                                     int len_snp_ibd1,
                                     int len_snp_ibd2) nogil
 
 
+cdef int parent_offsprings_table_index(int ibd_type, int gp, int gs1, int gs2) nogil
+
+cdef void fill_parent_offsprings_table(float f, float* table) nogil
+
 cdef float impute_snp_from_parent_offsprings(int snp,
                                             int parent,
                                             int[:, :] snp_ibd0,
                                             int[:, :] snp_ibd1,
                                             int[:, :] snp_ibd2,
                                             float f,
-                                            double[:, :] bed,
+                                            signed char[:, :] bed,
                                             int len_snp_ibd0,
                                             int len_snp_ibd1,
                                             int len_snp_ibd2,
@@ -35,4 +45,16 @@ cdef float impute_snp_from_parent_offsprings(int snp,
 
 cdef cmap[cpair[cstring, cstring], vector[int]] dict_to_cmap(dict the_dict)
 
-cdef char is_possible_child(int child, int parent) nogil
\ No newline at end of file
+cdef char is_possible_child(int child, int parent) nogil
+
+cdef float impute_snp_from_parent_offsprings_table(int snp,
+                                                  int parent,
+                                                  int[:, :] snp_ibd0,
+                                                  int[:, :] snp_ibd1,
+                                                  int[:, :] snp_ibd2,
+                                                  float* table,
+                                                  signed char[:, :] bed,
+                                                  int len_snp_ibd0,
+                                                  int len_snp_ibd1,
+                                                  int len_snp_ibd2,
+                                                  ) nogil
@@ -5,8 +5,24 @@ Functions
     is_possible_child
     dict_to_cmap
     impute_snp_from_offsprings
+    parent_offsprings_table_index
+    fill_parent_offsprings_table
     impute_snp_from_parent_offsprings
+    impute_snp_from_parent_offsprings_table
+    impute_snp_from_parent_offsprings_branches
     get_IBD_type
+    get_IBD_type_from_index
+    is_ibd_index
+    build_ibd_index
+    write_output_metadata
+    get_output_chunk_shape
+    create_imputed_gts_dataset
+    encode_imputed_gts
+    report_progress
+
+Classes
+-------
+    ParallelChunkWriter
     impute
 """
 # distutils: language = c++
@@ -20,45 +36,51 @@ from libcpp.pair cimport pair as cpair
 cimport numpy as cnp
 from libcpp.vector cimport vector
 import cython
-from libc.math cimport isnan
+from libc.limits cimport INT_MIN, INT_MAX
 import h5py
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 from cython.parallel import prange
 cimport openmp
-from libc.stdio cimport printf
-from libc.time cimport time, ctime, time_t
 cdef float nan_float = np.nan
+#Genotypes are stored as int8 and missing genotypes are marked with MISSING_GENOTYPE, which is shared with the preprocessing
+from sibreg.bin.constants import MISSING_GENOTYPE
+cdef signed char c_missing_genotype = MISSING_GENOTYPE
 
-cdef extern from * nogil:
-    r"""
-    #include <omp.h>
-    #include <stdio.h>  
-    #include <string.h>
-    static omp_lock_t cnt_lock;
-    static int cnt = 0;
-    void reset(){
-        omp_init_lock(&cnt_lock);
-        cnt = 0;
+#the progress counters are shared between the threads of impute, so they are read and updated atomically
+cdef extern from *:
+    """
+    static long atomic_read_long(long* value) {
+        long result;
+        #pragma omp atomic read
+        result = *value;
+        return result;
+    }
+    static void atomic_add_long(long* value, long increment) {
+        #pragma omp atomic update
+        *value += increment;
     }
-    void destroy(){
-        omp_destroy_lock(&cnt_lock);
-    }   
-    void report(int mod, char* chromosomes, int total){
-        time_t now;
-        char* text;
-        omp_set_lock(&cnt_lock);
-        cnt++;
-        if(cnt%mod == 0){
-            now = time(NULL);
-            text = ctime(&now);
-            text[strlen(text)-1] = 0;
-            printf("%s INFO impute with chromosome %s: progress is %d%\n", text, chromosomes, (100*cnt)/total);
+    static int claim_progress_report(double* next_report_time, double now, double interval) {
+        double deadline;
+        int claimed = 0;
+        #pragma omp atomic read
+        deadline = *next_report_time;
+        if (now < deadline) {
+            return 0;
         }
-        omp_unset_lock(&cnt_lock);
+        #pragma omp critical(sibreg_progress_report)
+        {
+            if (now >= *next_report_time) {
+                *next_report_time = now + interval;
+                claimed = 1;
+            }
+        }
+        return claimed;
     }
     """
-    void reset()
-    void destroy()
-    void report(int mod, char* pre_message_info, int total)
+    long atomic_read_long(long* value) nogil
+    void atomic_add_long(long* value, long increment) nogil
+    int claim_progress_report(double* next_report_time, double now, double interval) nogil
 
 cdef char is_possible_child(int child, int parent) nogil:
     """Checks whether a person with child genotype can be an offspring of someone with the parent genotype.
@@ -103,7 +125,7 @@ cdef float impute_snp_from_offsprings(int snp,
                       int[:, :] snp_ibd1,
                       int[:, :] snp_ibd2,
                       float f,
-                      double[:, :] bed,
+                      signed char[:, :] bed,
                       int len_snp_ibd0,
                       int len_snp_ibd1,
                       int len_snp_ibd2) nogil:
@@ -125,8 +147,8 @@ cdef float impute_snp_from_offsprings(int snp,
         f : float
             Minimum allele frequency for the SNP.
 
-        bed : cnp.ndarray[cnp.double_t, ndim=2]
-            A two-dimensional array containing genotypes for all individuals and SNPs.
+        bed : cnp.ndarray[cnp.int8_t, ndim=2]
+            A two-dimensional array containing genotypes for all individuals and SNPs. Missing genotypes are MISSING_GENOTYPE.
 
         len_snp_ibd0 : int
             The number of sibling pairs in snp_ibd0.
@@ -189,6 +211,62 @@ cdef float impute_snp_from_offsprings(int snp,
 
     return result/2
 
+#Contributions of a sib pair to the imputation of the missing parent are stored in a table indexed by
+#the IBD status of the pair (1 or 2), the genotype of the parent and the genotypes of the sibs.
+#the size is a compile time constant, so tables can be allocated on the stack
+cdef enum:
+    c_parent_offsprings_table_size = 54
+PARENT_OFFSPRINGS_TABLE_SIZE = c_parent_offsprings_table_size
+
+cdef int parent_offsprings_table_index(int ibd_type, int gp, int gs1, int gs2) nogil:
+    """Returns the index of the entry for a sib pair with IBD status ibd_type(1 or 2), parent genotype gp and sib genotypes gs1 and gs2
+    """
+    return ((ibd_type-1)*3 + gp)*9 + gs1*3 + gs2
+
+@cython.wraparound(False)
+@cython.boundscheck(False)
+@cython.cdivision(True)
+cdef void fill_parent_offsprings_table(float f, float* table) nogil:
+    """Fills the table of the contributions of sib pairs to the imputation of the missing parent for a SNP with allele frequency f
+
+    Entries are indexed with parent_offsprings_table_index. Entries of the pairs that can not be children of the parent or are
+    not used in the imputation are NAN.
+
+    Args:
+        f : float
+            Minimum allele frequency for the SNP.
+
+        table : float*
+            The table that's filled. It should have PARENT_OFFSPRINGS_TABLE_SIZE elements.
+    """
+    cdef int index
+    for index in range(c_parent_offsprings_table_size):
+        table[index] = nan_float
+    #ibd1
+    table[parent_offsprings_table_index(1, 0, 0, 0)] = 0.5*f*(1-f)/((1-f)**2 + 0.5*f*(1-f))
+    table[parent_offsprings_table_index(1, 0, 0, 1)] = 1
+    table[parent_offsprings_table_index(1, 0, 1, 0)] = 1
+    table[parent_offsprings_table_index(1, 0, 1, 1)] = (0.5*f*(1-f) + 2*f**2)/(0.5*f*(1-f)+f**2)
+    table[parent_offsprings_table_index(1, 1, 0, 0)] = 0
+    table[parent_offsprings_table_index(1, 1, 0, 1)] = f*(1-f)/(0.5*(1-f)**2 + f*(1-f))
+    table[parent_offsprings_table_index(1, 1, 1, 0)] = f*(1-f)/(0.5*(1-f)**2 + f*(1-f))
+    table[parent_offsprings_table_index(1, 1, 1, 1)] = 0.5*f**2/(0.25*f**2 + 0.25*(1-f)**2)
+    table[parent_offsprings_table_index(1, 1, 1, 2)] = f*(1-f)/(f*(1-f) + 0.5*f**2) + f**2/(f*(1-f) + 0.5*f**2)
+    table[parent_offsprings_table_index(1, 1, 2, 1)] = f*(1-f)/(f*(1-f) + 0.5*f**2) + f**2/(f*(1-f) + 0.5*f**2)
+    table[parent_offsprings_table_index(1, 1, 2, 2)] = 2
+    table[parent_offsprings_table_index(1, 2, 1, 1)] = 0.5*f*(1-f)/(0.5*f*(1-f)+(1-f)**2)
+    table[parent_offsprings_table_index(1, 2, 1, 2)] = 1
+    table[parent_offsprings_table_index(1, 2, 2, 1)] = 1
+    table[parent_offsprings_table_index(1, 2, 2, 2)] = 0.5*f*(1-f)/(0.5*f*(1-f) + f**2) + 2*f**2/(0.5*f*(1-f) + f**2)
+    #ibd2, only pairs with the same genotypes are used
+    table[parent_offsprings_table_index(2, 0, 0, 0)] = f*(1-f)/((1-f)**2 + f*(1-f))
+    table[parent_offsprings_table_index(2, 0, 1, 1)] = (f*(1-f) + 2*(f**2))/(f*(1-f) + f**2)
+    table[parent_offsprings_table_index(2, 1, 0, 0)] = 0.5*f*(1-f)/(0.5*f*(1-f) + 0.5*(1-f)**2)
+    table[parent_offsprings_table_index(2, 1, 1, 1)] = (f*(1-f) + f**2)/(0.5*(1-f)**2 + f*(1-f) + 0.5*f**2)
+    table[parent_offsprings_table_index(2, 1, 2, 2)] = (0.5*f*(1-f) + f**2)/(0.5*f*(1-f) + 0.5*f**2)
+    table[parent_offsprings_table_index(2, 2, 1, 1)] = f*(1-f)/((1-f)**2 + f*(1-f))
+    table[parent_offsprings_table_index(2, 2, 2, 2)] = (f*(1-f) + 2*f**2)/(f*(1-f) + f**2)
+
 @cython.wraparound(False)
 @cython.boundscheck(False)
 @cython.cdivision(True)
@@ -198,7 +276,7 @@ cdef float impute_snp_from_parent_offsprings(int snp,
                       int[:, :] snp_ibd1,
                       int[:, :] snp_ibd2,
                       float f,
-                      double[:, :] bed,
+                      signed char[:, :] bed,
                       int len_snp_ibd0,
                       int len_snp_ibd1,
                       int len_snp_ibd2,
@@ -206,6 +284,8 @@ cdef float impute_snp_from_parent_offsprings(int snp,
     """Imputes the missing parent for a single SNP from the other parent and offsprings and returns the imputed value
     
     If returns Nan if there are no sibling pairs that can be children of the existing parent.
+    It fills the table of the SNP and calls impute_snp_from_parent_offsprings_table. When imputing many families,
+    the tables should be filled once per SNP with fill_parent_offsprings_table instead.
 
     Args:
         snp : int
@@ -224,8 +304,8 @@ cdef float impute_snp_from_parent_offsprings(int snp,
         f : float
             Minimum allele frequency for the SNP.
 
-        bed : cnp.ndarray[cnp.double_t, ndim=2]
-            A two-dimensional array containing genotypes for all individuals and SNPs.
+        bed : cnp.ndarray[cnp.int8_t, ndim=2]
+            A two-dimensional array containing genotypes for all individuals and SNPs. Missing genotypes are MISSING_GENOTYPE.
 
         len_snp_ibd0 : int
             The number of sibling pairs in snp_ibd0.
@@ -238,17 +318,50 @@ cdef float impute_snp_from_parent_offsprings(int snp,
 
     Returns:
         float
-            Imputed missing parent. NAN if all the children are NAN in this SNP.
+            Imputed missing parent. NAN if all the children are NAN in this SNP or the parent is missing.
+
+    """
+    cdef float table[c_parent_offsprings_table_size]
+    fill_parent_offsprings_table(f, table)
+    return impute_snp_from_parent_offsprings_table(snp, parent, snp_ibd0, snp_ibd1, snp_ibd2, table, bed, len_snp_ibd0, len_snp_ibd1, len_snp_ibd2)
+
+@cython.wraparound(False)
+@cython.boundscheck(False)
+@cython.cdivision(True)
+cdef float impute_snp_from_parent_offsprings_table(int snp,
+                      int parent,
+                      int[:, :] snp_ibd0,
+                      int[:, :] snp_ibd1,
+                      int[:, :] snp_ibd2,
+                      float* table,
+                      signed char[:, :] bed,
+                      int len_snp_ibd0,
+                      int len_snp_ibd1,
+                      int len_snp_ibd2,
+                      ) nogil:
+    """Imputes the missing parent for a single SNP from the other parent and offsprings using the table of the SNP and returns the imputed value
+
+    Args:
+        table : float*
+            The table of the SNP filled by fill_parent_offsprings_table.
+
+        snp, parent, snp_ibd0, snp_ibd1, snp_ibd2, bed, len_snp_ibd0, len_snp_ibd1, len_snp_ibd2
+            Same as impute_snp_from_parent_offsprings.
+
+    Returns:
+        float
+            Imputed missing parent. NAN if all the children are NAN in this SNP or the parent is missing.
 
     """
 
     cdef float result = nan_float
     cdef float additive
-    cdef float gs1, gs2
-    cdef float sibsum = 0
-    cdef int sib1, sib2, pair_index, counter
-    cdef float gp = bed[parent, snp]
-        
+    cdef int gs1, gs2
+    cdef int sib1, sib2, pair_index, counter, ibd_type, len_snp_ibd
+    cdef int gp = bed[parent, snp]
+    if bed[parent, snp] == c_missing_genotype:
+        return nan_float
+
     if len_snp_ibd0 > 0:
         #if there is any ibd state0 we have observed all of the parents' genotypes,
         #therefore we can discard other ibd statuses
@@ -261,7 +374,7 @@ cdef float impute_snp_from_parent_offsprings(int snp,
             sib2 = snp_ibd0[pair_index, 1]
             gs2 = bed[sib2, snp]
 
-            if not is_possible_child(<int> gs1, <int> gp) or not is_possible_child(<int> gs2, <int> gp):
+            if not is_possible_child(gs1, gp) or not is_possible_child(gs2, gp):
                 continue
 
             result += (gs1 + gs2)
@@ -272,75 +385,150 @@ cdef float impute_snp_from_parent_offsprings(int snp,
         else:
             result = nan_float
 
+    elif len_snp_ibd1 > 0 or len_snp_ibd2 > 0:
+        #Because ibd2 is similar to having just one individual, we can discard ibd2s if there is any ibd1
+        #TODO handle the case of only ibd2s with different genorypes
+        if len_snp_ibd1 > 0:
+            ibd_type = 1
+            len_snp_ibd = len_snp_ibd1
+        else:
+            ibd_type = 2
+            len_snp_ibd = len_snp_ibd2
+        result = 0
+        counter = 0
+        for pair_index in range(len_snp_ibd):
+            if ibd_type == 1:
+                sib1 = snp_ibd1[pair_index, 0]
+                sib2 = snp_ibd1[pair_index, 1]
+            else:
+                sib1 = snp_ibd2[pair_index, 0]
+                sib2 = snp_ibd2[pair_index, 1]
+            gs1 = bed[sib1, snp]
+            gs2 = bed[sib2, snp]
+            if gs1 < 0 or gs1 > 2 or gs2 < 0 or gs2 > 2:
+                continue
+            #entries of the pairs that can not be children of the parent are NAN
+            additive = table[parent_offsprings_table_index(ibd_type, gp, gs1, gs2)]
+            if additive != additive:
+                continue
+            result += additive
+            counter += 1
+
+        if counter > 0:
+            result = result/counter
+        else:
+            result = nan_float
+
+    return result
+
+@cython.wraparound(False)
+@cython.boundscheck(False)
+@cython.cdivision(True)
+cdef float impute_snp_from_parent_offsprings_branches(int snp,
+                      int parent,
+                      int[:, :] snp_ibd0,
+                      int[:, :] snp_ibd1,
+                      int[:, :] snp_ibd2,
+                      float f,
+                      signed char[:, :] bed,
+                      int len_snp_ibd0,
+                      int len_snp_ibd1,
+                      int len_snp_ibd2,
+                      ) nogil:
+    """Imputes the missing parent for a single SNP from the other parent and offsprings by evaluating the contribution of each sib pair and returns the imputed value
+
+    It's the reference implementation that the tables of impute_snp_from_parent_offsprings_table replaced, and returns the same values.
+    impute uses it when single_parent_tables is False, so benchmarks/benchmark_impute.py can compare the two.
+
+    Args:
+        snp, parent, snp_ibd0, snp_ibd1, snp_ibd2, f, bed, len_snp_ibd0, len_snp_ibd1, len_snp_ibd2
+            Same as impute_snp_from_parent_offsprings.
+
+    Returns:
+        float
+            Imputed missing parent. NAN if all the children are NAN in this SNP or the parent is missing.
+    """
+    cdef float result = nan_float
+    cdef float additive
+    cdef int gs1, gs2
+    cdef int sib1, sib2, pair_index, counter
+    cdef int gp = bed[parent, snp]
+    if bed[parent, snp] == c_missing_genotype:
+        return nan_float
+
+    if len_snp_ibd0 > 0:
+        #if there is any ibd state0 we have observed all of the parents' genotypes,
+        #therefore we can discard other ibd statuses
+        result = 0
+        counter = 0
+        for pair_index in range(len_snp_ibd0):
+            sib1 = snp_ibd0[pair_index, 0]
+            gs1 = bed[sib1, snp]
+            sib2 = snp_ibd0[pair_index, 1]
+            gs2 = bed[sib2, snp]
+            if not is_possible_child(gs1, gp) or not is_possible_child(gs2, gp):
+                continue
+            result += (gs1 + gs2)
+            counter += 1
+        if counter > 0:
+            result = result/counter - gp
+        else:
+            result = nan_float
+
     elif len_snp_ibd1 > 0:
         #Because ibd2 is similar to having just one individual, we can discard ibd2s
         result = 0
         counter = 0
-
         for pair_index in range(len_snp_ibd1):
             sib1 = snp_ibd1[pair_index, 0]
             sib2 = snp_ibd1[pair_index, 1]
             gs1 = bed[sib1, snp]
             gs2 = bed[sib2, snp]
-
-            if not is_possible_child(<int> gs1, <int> gp) or not is_possible_child(<int> gs2, <int> gp):
+            if gs1 < 0 or gs1 > 2 or gs2 < 0 or gs2 > 2:
+                continue
+            if not is_possible_child(gs1, gp) or not is_possible_child(gs2, gp):
                 continue
-            
             additive = 0
             if gp == 0 and (gs1 == 0 and gs2 == 0):
                 additive = 0.5*f*(1-f)/((1-f)**2 + 0.5*f*(1-f))
                 counter +=1
-            
             elif gp == 0 and ((gs1 == 0 and gs2 == 1) or (gs1 == 1 and gs2 == 0)):
                 additive = 1
                 counter +=1
-
             elif gp == 0 and (gs1 == 1 and gs2 == 1):
                 additive = (0.5*f*(1-f) + 2*f**2)/(0.5*f*(1-f)+f**2)
                 counter +=1
-
             elif gp == 1 and (gs1 == 0 and gs2 == 0):
                 additive = 0
                 counter +=1
-            
             elif gp == 1 and ((gs1 == 0 and gs2 == 1) or (gs1 == 1 and gs2 == 0)):
                 additive = f*(1-f)/(0.5*(1-f)**2 + f*(1-f))
                 counter +=1
-
             elif gp == 1 and (gs1 == 1 and gs2 == 1):
                 additive = 0.5*f**2/(0.25*f**2 + 0.25*(1-f)**2)
                 counter +=1
-
             elif gp == 1 and ((gs1 == 1 and gs2 == 2) or (gs1 == 2 and gs2 == 1)):
                 additive = f*(1-f)/(f*(1-f) + 0.5*f**2) + f**2/(f*(1-f) + 0.5*f**2)
                 counter +=1
-
             elif gp == 1 and (gs1 == 2 and gs2 == 2):
                 additive = 2
                 counter +=1
-            
             elif gp == 2 and (gs1 == 1 and gs2 == 1):
                 additive = 0.5*f*(1-f)/(0.5*f*(1-f)+(1-f)**2)
                 counter +=1
-
             elif gp == 2 and ((gs1 == 1 and gs2 == 2) or (gs1 == 2 and gs2 == 1)):
                 additive = 1
                 counter +=1
-
             elif gp == 2 and (gs1 == 2 and gs2 == 2):
                 additive = 0.5*f*(1-f)/(0.5*f*(1-f) + f**2) + 2*f**2/(0.5*f*(1-f) + f**2)
                 counter +=1
-
             result += additive
-
-        if counter > 0 :
+        if counter > 0:
             result = result/counter
-        else:            
+        else:
             result = nan_float
-    
-    
+
     elif len_snp_ibd2 > 0:
-        #As ibd2 simillar to having one individual, we dividsnpe the sum of the pair by two
         #TODO handle the case of only ibd2s with different genorypes
         result = 0
         counter = 0
@@ -349,48 +537,40 @@ cdef float impute_snp_from_parent_offsprings(int snp,
             sib2 = snp_ibd2[pair_index, 1]
             gs1 = bed[sib1, snp]
             gs2 = bed[sib2, snp]
-
-            if not is_possible_child(<int> gs1, <int> gp) or not is_possible_child(<int> gs2, <int> gp):
+            if gs1 < 0 or gs1 > 2 or gs2 < 0 or gs2 > 2:
                 continue
-
-            additive = 0    
+            if not is_possible_child(gs1, gp) or not is_possible_child(gs2, gp):
+                continue
+            additive = 0
             if gs1 == gs2:
                 if gp == 0 and gs1 == 0:
                     additive = f*(1-f)/((1-f)**2 + f*(1-f))
                     counter += 1
-
                 elif gp == 0 and gs1 == 1:
                     additive = (f*(1-f) + 2*(f**2))/(f*(1-f) + f**2)
                     counter += 1
-
                 elif gp == 1 and gs1 == 0:
                     additive = 0.5*f*(1-f)/(0.5*f*(1-f) + 0.5*(1-f)**2)
                     counter += 1
-
                 elif gp == 1 and gs1 == 1:
                     additive = (f*(1-f) + f**2)/(0.5*(1-f)**2 + f*(1-f) + 0.5*f**2)
                     counter += 1
-
                 elif gp == 1 and gs1 == 2:
                     additive = (0.5*f*(1-f) + f**2)/(0.5*f*(1-f) + 0.5*f**2)
                     counter += 1
-
                 elif gp == 2 and gs1 == 1:
                     additive = f*(1-f)/((1-f)**2 + f*(1-f))
                     counter += 1
-
                 elif gp == 2 and gs1 == 2:
                     additive = (f*(1-f) + 2*f**2)/(f*(1-f) + f**2)
                     counter += 1
-
             result += additive
-            
         if counter > 0:
             result = result/counter
         else:
             result = nan_float
 
-    return result    
+    return result
 
 cdef int get_IBD_type(cstring id1,
                       cstring id2,
@@ -447,7 +627,422 @@ cdef int get_IBD_type(cstring id1,
 
 @cython.wraparound(False)
 @cython.boundscheck(False)
-def impute(sibships, iid_to_bed_index,  gts, ibd, pos, hdf5_output_dict, chromosome, output_address = None, threads = None, output_compression = None, output_compression_opts = None):
+cdef int get_IBD_type_from_index(int loc,
+                                 const int[:, :] segments,
+                                 int first,
+                                 int last,
+                                 int* cursor) nogil:
+    """Returns the IBD status of a pair in the SNP located at loc using the pair's sorted segments
+
+    The segments of the pair are segments[first:last], sorted by start. They should not overlap, so they are sorted by end too.
+    cursor is the index of the segment where the search starts. It's moved forward as loc increases, so when SNPs are visited
+    in the order of their positions each lookup takes amortised constant time. If loc is before the segment pointed to by
+    the cursor, the cursor is moved back with a binary search.
+
+    Args:
+        loc : int
+            Location of the SNP
+
+        segments : cnp.ndarray[cnp.int_t, ndim=2]
+            A two-dimensional array where each row is a segment consisting of start, end, and IBD status (start and end are inclusive).
+            build_ibd_index can be used to create this.
+
+        first : int
+            Index of the first segment of the pair in segments.
+
+        last : int
+            Index after the last segment of the pair in segments.
+
+        cursor : int*
+            Index of the segment the search starts from. It's updated in place. Before the first lookup it should be set to either first,
+            or last so that the first lookup is a binary search.
+
+    Returns:
+        int
+            the IBD status of the pair in the SNP located at loc
+    """
+    cdef int index = cursor[0]
+    cdef int low, high, middle
+    if index > first and segments[index-1, 1] >= loc:
+        #loc is before the cursor, finding the first segment that ends after loc
+        low = first
+        high = index
+        while low < high:
+            middle = (low+high)//2
+            if segments[middle, 1] < loc:
+                low = middle+1
+            else:
+                high = middle
+        index = low
+
+    while index < last and segments[index, 1] < loc:
+        index = index+1
+    cursor[0] = index
+    if index < last and segments[index, 0] <= loc:
+        return segments[index, 2]
+    return 0
+
+def is_ibd_index(ibd):
+    """Returns True if ibd is an index built by build_ibd_index rather than the IBD segments it's built from
+
+    Args:
+        ibd : dict or tuple
+            IBD segments as accepted by build_ibd_index or its output.
+
+    Returns:
+        bool
+    """
+    return isinstance(ibd, tuple) and len(ibd) == 5
+
+def build_ibd_index(fams, ibd):
+    """Builds an index of the IBD segments of all the sib pairs of the families
+
+    Pairs of each family are ordered as they are visited in the imputation: for sibs i and j, with j < i, the pair
+    index within the family is i*(i-1)/2 + j.
+
+    It also finds the breakpoints of each family, the locations where the IBD status of any of its pairs may change.
+    Between two consecutive breakpoints, IBD statuses of all the pairs in the family are constant.
+
+    IIDs are coded with integers and the sib pairs are found by a binary search of their codes in the sorted codes of the related pairs,
+    so the index is built with vectorised operations.
+
+    Segments of a pair can be given in any order, but they should not overlap.
+
+    Args:
+        fams : list
+            List of families where each family is a list of the IIDs of the sibs as ascii bytes.
+
+        ibd : dict or tuple(numpy.array, numpy.array, numpy.array)
+            A (str,str)->list[int] dictionary containing flattened IBD segments for each pair of related individuals.
+            Values are lists of integers in this fashion: [start0, end0, ibd_status0, start2, end2, ibd_status2, ...]
+            It can also be the segments grouped by pair in the layout returned by sibreg.bin.preprocess_data.prepare_ibd.
+            Sibreg.bin.preprocess_data.prepare_data can be used to create this.
+
+    Returns:
+        tuple(numpy.array, numpy.array, numpy.array, numpy.array, numpy.array)
+            The first element maps each family to the index of its first pair. Pairs of family i are in [fam_pair_offsets[i], fam_pair_offsets[i+1]).
+            The second element maps each pair to the index of its first segment. Segments of pair p are in [pair_segment_offsets[p], pair_segment_offsets[p+1]).
+            The third element is a two-dimensional array where each row is a segment consisting of start, end and IBD status.
+            Segments of each pair are sorted by start and do not overlap.
+            The fourth element maps each family to the index of its first breakpoint. Breakpoints of family i are in [fam_breakpoint_offsets[i], fam_breakpoint_offsets[i+1]).
+            The fifth element is the sorted breakpoints of all the families. A breakpoint is either the start of a segment or the location after its end.
+    """
+    if isinstance(ibd, tuple):
+        pair_ids, pair_offsets, pair_segments_table = ibd
+    else:
+        #the dictionary is converted to the grouped layout
+        pair_ids = np.array([[id1, id2] for id1, id2 in ibd.keys()], dtype=str).reshape((-1, 2))
+        pair_offsets = np.zeros(len(ibd)+1, dtype=np.dtype("i"))
+        pair_offsets[1:] = np.cumsum([len(pair_segments)//3 for pair_segments in ibd.values()])
+        pair_segments_table = np.array([loc for pair_segments in ibd.values() for loc in pair_segments], dtype=np.dtype("i")).reshape((-1, 3))
+    pair_ids = np.asarray(pair_ids).astype(str).reshape((-1, 2))
+    pair_offsets = np.asarray(pair_offsets)
+    fam_sizes = np.array([len(fam) for fam in fams], dtype=int)
+    fam_pair_offsets = np.zeros(len(fams)+1, dtype=np.dtype("i"))
+    fam_pair_offsets[1:] = np.cumsum(fam_sizes*(fam_sizes-1)//2)
+    fam_iid_offsets = np.zeros(len(fams)+1, dtype=int)
+    fam_iid_offsets[1:] = np.cumsum(fam_sizes)
+    iids = np.array([iid for fam in fams for iid in fam], dtype="S").astype(str)
+    #iids of both tables are coded with integers, so that a pair is a single int64 code
+    unique_ids, id_codes = np.unique(np.concatenate((iids, pair_ids.ravel())), return_inverse=True)
+    id_codes = id_codes.astype(np.int64)
+    fam_id_codes = id_codes[:iids.shape[0]]
+    pair_codes = id_codes[iids.shape[0]:].reshape((-1, 2))
+    pair_codes = pair_codes[:, 0]*unique_ids.shape[0] + pair_codes[:, 1]
+    pair_order = np.argsort(pair_codes, kind="stable")
+    sorted_pair_codes = pair_codes[pair_order]
+    #pairs of a family of size k are the first k*(k-1)/2 entries of the lower triangle of the largest family, in row-major order
+    max_fam_size = fam_sizes.max() if len(fams) > 0 else 0
+    sib_i, sib_j = np.tril_indices(max_fam_size, -1)
+    number_of_pairs = fam_pair_offsets[-1]
+    pair_fams = np.repeat(np.arange(len(fams)), np.diff(fam_pair_offsets))
+    pair_in_fam = np.arange(number_of_pairs) - fam_pair_offsets[pair_fams]
+    first_codes = fam_id_codes[fam_iid_offsets[pair_fams] + sib_i[pair_in_fam]]
+    second_codes = fam_id_codes[fam_iid_offsets[pair_fams] + sib_j[pair_in_fam]]
+    def find_pairs(codes):
+        if sorted_pair_codes.shape[0] == 0:
+            return np.full(codes.shape[0], -1)
+        indices = np.minimum(np.searchsorted(sorted_pair_codes, codes), sorted_pair_codes.shape[0]-1)
+        return np.where(sorted_pair_codes[indices] == codes, pair_order[indices], -1)
+    #a pair may be stored in either order of its individuals
+    matches = find_pairs(first_codes*unique_ids.shape[0] + second_codes)
+    missing = matches < 0
+    matches[missing] = find_pairs(second_codes[missing]*unique_ids.shape[0] + first_codes[missing])
+    found = matches >= 0
+    pair_starts = np.where(found, pair_offsets[np.maximum(matches, 0)], 0)
+    pair_segment_counts = np.where(found, pair_offsets[np.maximum(matches, 0)+1] - pair_starts, 0)
+    pair_segment_offsets = np.zeros(number_of_pairs+1, dtype=np.dtype("i"))
+    pair_segment_offsets[1:] = np.cumsum(pair_segment_counts)
+    segment_indices = np.repeat(pair_starts - pair_segment_offsets[:-1], pair_segment_counts) + np.arange(pair_segment_offsets[-1])
+    segments = np.asarray(pair_segments_table, dtype=np.dtype("i")).reshape((-1, 3))[segment_indices]
+    #segments of each pair are sorted by start
+    segment_pairs = np.repeat(np.arange(number_of_pairs), pair_segment_counts)
+    segments = segments[np.lexsort((segments[:, 0], segment_pairs))]
+    #get_IBD_type_from_index needs the segments of each pair to be disjoint, ends are inclusive
+    overlapping = (segment_pairs[1:] == segment_pairs[:-1]) & (segments[1:, 0] <= segments[:-1, 1])
+    if np.any(overlapping):
+        pair = segment_pairs[np.argmax(overlapping)]
+        fam = pair_fams[pair]
+        sib1 = fams[fam][sib_i[pair_in_fam[pair]]]
+        sib2 = fams[fam][sib_j[pair_in_fam[pair]]]
+        raise ValueError("IBD segments of " + str(sib1) + " and " + str(sib2) + " overlap")
+    #breakpoints of all families are sorted by family and then location and duplicates are removed
+    segment_fams = np.repeat(np.arange(len(fams)), np.diff(pair_segment_offsets[fam_pair_offsets]))
+    breakpoint_fams = np.concatenate((segment_fams, segment_fams))
+    breakpoints = np.concatenate((segments[:, 0], segments[:, 1]+1))
+    order = np.lexsort((breakpoints, breakpoint_fams))
+    breakpoint_fams = breakpoint_fams[order]
+    breakpoints = breakpoints[order]
+    unique = np.ones(breakpoints.shape[0], dtype=bool)
+    unique[1:] = (breakpoint_fams[1:] != breakpoint_fams[:-1]) | (breakpoints[1:] != breakpoints[:-1])
+    fam_breakpoint_offsets = np.zeros(len(fams)+1, dtype=np.dtype("i"))
+    fam_breakpoint_offsets[1:] = np.cumsum(np.bincount(breakpoint_fams[unique], minlength=len(fams)))
+    breakpoints = breakpoints[unique].astype(np.dtype("i"))
+    return fam_pair_offsets, pair_segment_offsets, np.ascontiguousarray(segments), fam_breakpoint_offsets, breakpoints
+
+def write_output_metadata(hdf5_file, sibships, pos, hdf5_output_dict):
+    """Writes everything except the imputed genotypes to the imputation output.
+
+    Args:
+        hdf5_file : h5py.File
+            The HDF5 file the imputation output is written to.
+
+        sibships : pandas.Dataframe
+            The sibships that are imputed, in the order of the rows of the imputed genotypes.
+
+        pos : numpy.array
+            A numpy array with the position of each SNP in the order of the columns of the imputed genotypes.
+
+        hdf5_output_dict : dict
+            Other key values to be added to the HDF5 output. It should contain "bim_columns", "bim_values" and "pedigree".
+    """
+    hdf5_file['families'] = np.array(sibships["FID"].values, dtype='S')
+    hdf5_file['parental_status'] = sibships[["has_father", "has_mother", "single_parent"]]
+    hdf5_file['pos'] = pos
+    hdf5_file["bim_columns"] = np.array(hdf5_output_dict["bim_columns"], dtype='S')
+    hdf5_file["bim_values"] = np.array(hdf5_output_dict["bim_values"], dtype='S')
+    hdf5_file["pedigree"] =  np.array(hdf5_output_dict["pedigree"], dtype='S')
+
+#imputed parental genotypes are in [0, 2]. With the uint8 encoding they are stored as round(value/UINT8_SCALE), and NaN as UINT8_NAN_CODE
+UINT8_NAN_CODE = 255
+UINT8_SCALE = 2./254
+OUTPUT_ENCODINGS = ["float16", "uint8"]
+#uint8 codes are computed in blocks of this many imputed genotypes, so the float64 temporaries of the encoding stay small
+ENCODE_BLOCK_SIZE = 2**16
+
+def create_imputed_gts_dataset(hdf5_file, number_of_fams, number_of_snps, encoding = "float16", chunk_layout = "auto", chunk_kb = 1024, compression = None, compression_opts = None):
+    """Creates the 'imputed_par_gts' dataset of the imputation output.
+
+    With the uint8 encoding, the scale and the NaN code of the dosages are stored as the attributes 'scale' and 'nan_code' of the dataset.
+    sibreg.sibreg.read_imputed_par_gts decodes it.
+
+    Args:
+        hdf5_file : h5py.File
+            The HDF5 file the imputation output is written to.
+
+        number_of_fams : int
+            Number of the imputed families.
+
+        number_of_snps : int
+            Number of the imputed SNPs.
+
+        encoding : str, optional
+            "float16" or "uint8". Its name is stored as the attribute 'encoding' of the dataset.
+
+        chunk_layout : str, optional
+            Take a look at get_output_chunk_shape.
+
+        chunk_kb : int, optional
+            Take a look at get_output_chunk_shape.
+
+        compression: str, optional
+            Optional compression algorithm, either gzip or lzf. None means no compression.
+
+        compression_opts': int, optional
+            Additional settings for the optional compression algorithm. Take a look at the create_dataset function of h5py library for more information.
+
+    Returns:
+        h5py.Dataset
+            The dataset. encode_imputed_gts should be used to encode the values written to it.
+    """
+    if encoding not in OUTPUT_ENCODINGS:
+        raise ValueError("unknown output encoding " + str(encoding))
+    dtype = np.dtype(encoding)
+    chunks = get_output_chunk_shape(number_of_fams, number_of_snps, chunk_layout, chunk_kb, dtype.itemsize)
+    dataset = hdf5_file.create_dataset('imputed_par_gts', (number_of_fams, number_of_snps), dtype = dtype, chunks = chunks, compression = compression, compression_opts = compression_opts)
+    dataset.attrs['encoding'] = encoding
+    if encoding == "uint8":
+        dataset.attrs['scale'] = UINT8_SCALE
+        dataset.attrs['nan_code'] = UINT8_NAN_CODE
+    return dataset
+
+def encode_imputed_gts(imputed_gts, encoding = "float16"):
+    """Encodes imputed parental genotypes to be written to a dataset created by create_imputed_gts_dataset
+
+    Args:
+        imputed_gts : numpy.array
+            The imputed parental genotypes.
+
+        encoding : str, optional
+            "float16" or "uint8".
+
+    Returns:
+        numpy.array
+            The encoded genotypes. Besides them, the uint8 encoding only allocates temporaries for ENCODE_BLOCK_SIZE genotypes.
+    """
+    imputed_gts = np.asarray(imputed_gts)
+    if encoding == "float16":
+        return imputed_gts.astype(np.float16)
+    codes = np.empty(imputed_gts.shape, dtype=np.uint8)
+    rows_per_block = max(1, ENCODE_BLOCK_SIZE//max(int(np.prod(imputed_gts.shape[1:])), 1))
+    for block_start in range(0, imputed_gts.shape[0], rows_per_block):
+        block = np.clip(imputed_gts[block_start:block_start+rows_per_block], 0, 2)
+        block /= UINT8_SCALE
+        np.rint(block, out=block)
+        block[np.isnan(block)] = UINT8_NAN_CODE
+        codes[block_start:block_start+rows_per_block] = block
+    return codes
+
+def get_output_chunk_shape(number_of_fams, number_of_snps, chunk_layout = "auto", chunk_kb = 1024, itemsize = 2):
+    """Returns the chunk shape of the imputed genotypes in the imputation output.
+
+    Args:
+        number_of_fams : int
+            Number of the imputed families, the rows of the imputed genotypes.
+
+        number_of_snps : int
+            Number of the imputed SNPs, the columns of the imputed genotypes.
+
+        chunk_layout : str, optional
+            "snp" for chunks of many families and few SNPs, which are fast to read for a subset of SNPs like imputed_par_gts[:, in_obs_sid] in sibreg.get_gts_matrix.
+            "fam" for chunks of few families and many SNPs, which are fast to read for a subset of families.
+            "auto" leaves the chunk shape to h5py.
+
+        chunk_kb : int, optional
+            Size of each chunk in kilobytes.
+
+        itemsize : int, optional
+            Size of each imputed genotype in bytes.
+
+    Returns:
+        tuple(int, int) or bool
+            The chunk shape, or True for "auto", which can be passed to h5py as chunks.
+    """
+    if chunk_layout == "auto":
+        return True
+    elements = max(1, chunk_kb*1024//itemsize)
+    if chunk_layout == "snp":
+        rows = min(number_of_fams, elements)
+        cols = min(number_of_snps, elements//max(rows, 1))
+    elif chunk_layout == "fam":
+        cols = min(number_of_snps, elements)
+        rows = min(number_of_fams, elements//max(cols, 1))
+    else:
+        raise ValueError("unknown chunk layout " + str(chunk_layout))
+    return (max(rows, 1), max(cols, 1))
+
+class ParallelChunkWriter:
+    """Writes slices of SNPs of the imputed genotypes to a chunked HDF5 dataset, compressing its chunks in parallel
+
+    With gzip compression, a slice that consists of whole columns of chunks is split into its chunks, which are compressed by a pool of threads
+    (zlib does not hold the GIL) and written with write_direct_chunk. Other slices are written through h5py, which compresses them on one thread.
+    It should be used as a context manager, so its threads are stopped.
+
+    Args:
+        dataset : h5py.Dataset
+            The two-dimensional chunked dataset of the imputed genotypes.
+
+        threads : int, optional
+            Number of the threads that compress the chunks. The default number of the threads is one.
+    """
+    def __init__(self, dataset, threads = None):
+        self.dataset = dataset
+        self.compression_level = dataset.compression_opts if dataset.compression_opts is not None else 4
+        self.parallel = dataset.compression == "gzip" and dataset.chunks is not None and not dataset.shuffle and hasattr(dataset.id, "write_direct_chunk")
+        self.executor = ThreadPoolExecutor(max_workers = threads or 1)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.executor.shutdown()
+
+    def compress_chunk(self, data, row, col):
+        chunk_rows, chunk_cols = self.dataset.chunks
+        chunk = data[row:row+chunk_rows, col:col+chunk_cols]
+        if chunk.shape != (chunk_rows, chunk_cols):
+            #chunks on the edges of the dataset are stored full size
+            padded = np.zeros((chunk_rows, chunk_cols), dtype=self.dataset.dtype)
+            padded[:chunk.shape[0], :chunk.shape[1]] = chunk
+            chunk = padded
+        return zlib.compress(np.ascontiguousarray(chunk).tobytes(), self.compression_level)
+
+    def write(self, start, data):
+        """Writes data to the columns [start, start+data.shape[1]) of the dataset"""
+        data = np.asarray(data, dtype=self.dataset.dtype)
+        end = start+data.shape[1]
+        number_of_rows, number_of_cols = self.dataset.shape
+        if self.parallel:
+            chunk_rows, chunk_cols = self.dataset.chunks
+        if not self.parallel or start % chunk_cols != 0 or (end % chunk_cols != 0 and end != number_of_cols):
+            self.dataset[:, start:end] = data
+            return
+        offsets = [(row, col) for col in range(start, end, chunk_cols) for row in range(0, number_of_rows, chunk_rows)]
+        compressed_chunks = self.executor.map(lambda offset: self.compress_chunk(data, offset[0], offset[1]-start), offsets)
+        for offset, compressed_chunk in zip(offsets, compressed_chunks):
+            self.dataset.id.write_direct_chunk(offset, compressed_chunk)
+
+def report_progress(chromosome, imputed, number_of_fams, number_of_snps, elapsed_time, progress_callback = None):
+    """Logs the progress and the throughput of the imputation and passes them to progress_callback
+
+    Args:
+        chromosome: str
+            Name of the chromosome(s) that's being imputed.
+
+        imputed : int
+            Number of the (family, SNP) pairs that are imputed so far.
+
+        number_of_fams : int
+            Number of the families that are being imputed.
+
+        number_of_snps : int
+            Number of the SNPs that are being imputed.
+
+        elapsed_time : float
+            Seconds since the imputation started.
+
+        progress_callback : callable, optional
+            If presented, it's called with the dictionary that's returned.
+
+    Returns:
+        dict
+            A dictionary with keys "chromosome", "progress"(percentage of the imputed family SNPs), "families_per_second", "snps_per_second",
+            "elapsed"(seconds since the start) and "eta"(estimated seconds to the end, NAN if nothing is imputed yet).
+    """
+    total = number_of_fams*number_of_snps
+    elapsed_time = max(elapsed_time, 1e-9)
+    rate = imputed/elapsed_time
+    eta = np.nan
+    if rate > 0:
+        eta = (total-imputed)/rate
+    progress = {"chromosome":chromosome,
+                "progress":100.*imputed/max(total, 1),
+                "families_per_second":rate/max(number_of_snps, 1),
+                "snps_per_second":rate/max(number_of_fams, 1),
+                "elapsed":elapsed_time,
+                "eta":eta,
+                }
+    logging.info("with chromosome " + str(chromosome)+": " + "progress is {:.0f}%, {:.1f} families/s, {:.1f} SNPs/s, ETA {:.0f}s".format(progress["progress"],
+                                                                                                                                        progress["families_per_second"],
+                                                                                                                                        progress["snps_per_second"],
+                                                                                                                                        progress["eta"]))
+    if progress_callback is not None:
+        progress_callback(progress)
+    return progress
+
+@cython.wraparound(False)
+@cython.boundscheck(False)
+def impute(sibships, iid_to_bed_index,  gts, ibd, pos, hdf5_output_dict, chromosome, output_address = None, threads = None, output_compression = None, output_compression_opts = None, snp_tile_size = 1024, progress_interval = 10, progress_callback = None, output_chunk_layout = "auto", output_chunk_kb = 1024, output_encoding = "float16", single_parent_tables = True):
     """Does the parent sum imputation for families in sibships and all the SNPs in gts and returns the results.
 
     Inputs and outputs of this function are ascii bytes instead of strings
@@ -461,11 +1056,12 @@ def impute(sibships, iid_to_bed_index,  gts, ibd, pos, hdf5_output_dict, chromos
             A dictionary mapping IIDs of people to their location in the bed file.
 
         gts : numpy.array
-            Numpy array containing the genotype data from the bed file.
+            Numpy array containing the genotype data from the bed file as int8, where missing genotypes are MISSING_GENOTYPE.
+            Arrays of other types, with NaN for missing genotypes, are converted to int8.
 
-        ibd : pandas.Dataframe
-            A pandas DataFrame with columns "ID1", "ID2", 'segment'. The segments column is a list of IBD segments between ID1 and ID2.
-            Each segment consists of a start, an end, and an IBD status. The segment list is flattened meaning it's like [start0, end0, ibd_status0, start1, end1, ibd_status1, ...]
+        ibd : dict or tuple
+            IBD segments of pairs of individuals as accepted by build_ibd_index, like the output of sibreg.bin.preprocess_data.prepare_ibd.
+            It can also be the output of build_ibd_index for sibships, so the index can be reused when imputing slices of SNPs.
 
         pos : numpy.array
             A numpy array with the position of each SNP in the order of appearance in gts.
@@ -497,6 +1093,30 @@ def impute(sibships, iid_to_bed_index,  gts, ibd, pos, hdf5_output_dict, chromos
         output_compression_opts': int
             Additional settings for the optional compression algorithm. Take a look at the create_dataset function of h5py library for more information. None means no compression setting.        
 
+        snp_tile_size : int, optional
+            SNPs are imputed in tiles of this many SNPs. Genotypes of each family for a tile are copied to a small contiguous block
+            before imputation, so the inner loop does not stride across the rows of gts.
+            Threads are dynamically scheduled over (family, tile) pairs, so smaller tiles keep more threads busy when there are few families.
+
+        progress_interval : float, optional
+            Progress and throughput of the imputation are reported every progress_interval seconds and once at the end. Take a look at report_progress.
+
+        progress_callback : callable, optional
+            If presented, it's called with the dictionary returned by report_progress on every report.
+
+        output_chunk_layout : str, optional
+            Chunk layout of the imputed genotypes in the output, "snp", "fam" or "auto". Take a look at get_output_chunk_shape.
+
+        output_chunk_kb : int, optional
+            Size of the chunks of the imputed genotypes in the output in kilobytes. It's not used with the "auto" layout.
+
+        output_encoding : str, optional
+            Encoding of the imputed genotypes in the output, "float16" or "uint8". Take a look at create_imputed_gts_dataset.
+
+        single_parent_tables : bool, optional
+            If True, the default, families with one genotyped parent are imputed with the per-SNP tables of fill_parent_offsprings_table.
+            Otherwise they are imputed with the reference implementation impute_snp_from_parent_offsprings_branches, which gives the same results.
+
     Returns:
         tuple(list, numpy.array)
             The second element is imputed parental genotypes and the first element is family ids of the imputed parents(in the order of appearance in the first element).
@@ -516,7 +1136,6 @@ def impute(sibships, iid_to_bed_index,  gts, ibd, pos, hdf5_output_dict, chromos
     cdef int max_sibs = np.max(sibships["sib_count"])
     cdef int max_ibd_pairs = max_sibs*(max_sibs-1)//2
     cdef int number_of_fams = sibships.shape[0]
-    cdef cnp.ndarray[cnp.double_t, ndim=1]freqs = np.nanmean(gts,axis=0)/2.0
     sibships["parent"] = sibships["FATHER_ID"]
     sibships["parent"][sibships["has_father"]] = sibships["FATHER_ID"][sibships["has_father"]]
     sibships["parent"][sibships["has_mother"]] = sibships["MOTHER_ID"][sibships["has_mother"]]
@@ -531,10 +1150,24 @@ def impute(sibships, iid_to_bed_index,  gts, ibd, pos, hdf5_output_dict, chromos
     #iid_to_bed_index
     cdef cmap[cstring, int] c_iid_to_bed_index = iid_to_bed_index
     #gts
-    cdef double[:, :] c_gts = gts
+    if gts.dtype != np.int8:
+        gts = np.where(np.isnan(gts), MISSING_GENOTYPE, gts).astype(np.int8)
+    cdef signed char[:, :] c_gts = gts
     cdef int number_of_snps = c_gts.shape[1]
+    cdef double[:] freqs = np.zeros(number_of_snps)
+    cdef long[:] genotype_sums = np.zeros(number_of_snps, dtype=np.int_)
+    cdef long[:] genotype_counts = np.zeros(number_of_snps, dtype=np.int_)
     #ibd
-    cdef cmap[cpair[cstring, cstring], vector[int]] c_ibd = dict_to_cmap(ibd)
+    if not is_ibd_index(ibd):
+        ibd = build_ibd_index(sibships["IID"].values.tolist(), ibd)
+    fam_pair_offsets, pair_segment_offsets, segments, fam_breakpoint_offsets, breakpoints = ibd
+    cdef const int[:] c_fam_pair_offsets = fam_pair_offsets
+    cdef const int[:] c_pair_segment_offsets = pair_segment_offsets
+    cdef const int[:, :] c_segments = segments
+    cdef const int[:] c_fam_breakpoint_offsets = fam_breakpoint_offsets
+    cdef const int[:] c_breakpoints = breakpoints
+    cdef int[:, :] cursors = np.zeros((number_of_threads, max(max_ibd_pairs, 1)), dtype=np.dtype("i"))
+    cdef int[:, :] pair_ibd = np.zeros((number_of_threads, max(max_ibd_pairs, 1)), dtype=np.dtype("i"))
     #pos
     cdef cnp.ndarray[cnp.int_t, ndim=1] c_pos = pos
     
@@ -544,97 +1177,181 @@ def impute(sibships, iid_to_bed_index,  gts, ibd, pos, hdf5_output_dict, chromos
     cdef int[:,:,:] snp_ibd0 = np.ones([number_of_threads, max_ibd_pairs, 2], dtype=np.dtype("i"))
     cdef int[:,:,:] snp_ibd1 = np.ones([number_of_threads, max_ibd_pairs, 2], dtype=np.dtype("i"))
     cdef int[:,:,:] snp_ibd2 = np.ones([number_of_threads, max_ibd_pairs, 2], dtype=np.dtype("i"))    
-    cdef int i, j, loc, ibd_type, sib1_index, sib2_index, progress
-    cdef cstring sib1_id, sib2_id
-    cdef int[:, :] sibs_index = np.zeros((number_of_threads, max_sibs)).astype("i")
+    cdef int i, j, loc, ibd_type, sib1_index, sib2_index, progress, pair, first_pair, number_of_pairs
+    cdef int run_start, run_end, low, high, middle
+    cdef int[:, :] sibs_index = np.zeros((number_of_threads, max_sibs+1)).astype("i")
+    cdef int c_snp_tile_size = snp_tile_size
+    cdef int tile_start, tile_end, tile_snp, number_of_members
+    cdef signed char[:, :, :] family_gts = np.zeros((number_of_threads, max_sibs+1, c_snp_tile_size), dtype=np.int8)
     cdef double[:,:] imputed_par_gts = np.zeros((number_of_fams, number_of_snps))
     cdef int snp, this_thread, sib1_gene_isnan, sib2_gene_isnan, index
-    byte_chromosome = chromosome.encode("ASCII")
-    cdef char* chromosome_c = byte_chromosome
-    cdef int mod = (number_of_fams+1)//100
-    reset()
+    #allele frequencies of the SNPs, NAN if all genotypes of a SNP are missing
+    with nogil:
+        for i in range(c_gts.shape[0]):
+            for snp in range(number_of_snps):
+                if c_gts[i, snp] != c_missing_genotype:
+                    genotype_sums[snp] += c_gts[i, snp]
+                    genotype_counts[snp] += 1
+        for snp in range(number_of_snps):
+            if genotype_counts[snp] > 0:
+                freqs[snp] = genotype_sums[snp]/(2.0*genotype_counts[snp])
+            else:
+                freqs[snp] = nan_float
+    #tables of the single parent imputation only depend on the allele frequency, so they are filled once per SNP
+    cdef bint c_single_parent_tables = single_parent_tables
+    cdef float[:, :] parent_offsprings_tables = np.zeros((number_of_snps if np.any(single_parent) and single_parent_tables else 0, c_parent_offsprings_table_size), dtype=np.float32)
+    with nogil:
+        for snp in range(parent_offsprings_tables.shape[0]):
+            fill_parent_offsprings_table(freqs[snp], &parent_offsprings_tables[snp, 0])
+    #each work item is a family and a tile of SNPs, so that all threads have work even when there are few families
+    cdef int number_of_tiles = (number_of_snps+c_snp_tile_size-1)//c_snp_tile_size
+    cdef int number_of_work_items = number_of_fams*number_of_tiles
+    cdef int work_item
+    #each thread counts its imputed family SNPs in its own cache line. The first thread that passes the report time
+    #claims the report, so progress is reported every progress_interval seconds whichever thread picks up the work items
+    cdef long[:, :] imputed_counts = np.zeros((number_of_threads, 8), dtype=np.int_)
+    cdef long imputed_sum
+    cdef int count_thread
+    cdef double c_progress_interval = progress_interval
+    #start time and the time of the next report
+    cdef double[:] report_times = np.array([openmp.omp_get_wtime()]*2)
+    report_times[1] += c_progress_interval
     logging.info("with chromosome " + str(chromosome)+": " + "using "+str(threads)+" threads")
-    for index in prange(number_of_fams, nogil = True, num_threads = number_of_threads):
-        report(mod, chromosome_c, number_of_fams)
+    for work_item in prange(number_of_work_items, nogil = True, num_threads = number_of_threads, schedule = 'dynamic'):
         this_thread = openmp.omp_get_thread_num()
+        if claim_progress_report(&report_times[1], openmp.omp_get_wtime(), c_progress_interval):
+            imputed_sum = 0
+            for count_thread in range(number_of_threads):
+                imputed_sum = imputed_sum + atomic_read_long(&imputed_counts[count_thread, 0])
+            with gil:
+                report_progress(chromosome, imputed_sum, number_of_fams, number_of_snps, openmp.omp_get_wtime()-report_times[0], progress_callback)
+        index = work_item // number_of_tiles
+        tile_start = (work_item % number_of_tiles)*c_snp_tile_size
+        tile_end = min(tile_start+c_snp_tile_size, number_of_snps)
         for i in range(sib_count[index]):
-            sibs_index[this_thread, i] = c_iid_to_bed_index[fams[index][i]]        
-        snp = 0
-        while snp < number_of_snps:
+            sibs_index[this_thread, i] = c_iid_to_bed_index[fams[index][i]]
+        #the parent, if any, is the row after the sibs in family_gts
+        if single_parent[index]:
+            sibs_index[this_thread, sib_count[index]] = c_iid_to_bed_index[parents[index]]
+            number_of_members = sib_count[index]+1
+        else:
+            number_of_members = sib_count[index]
+        first_pair = c_fam_pair_offsets[index]
+        number_of_pairs = c_fam_pair_offsets[index+1]-first_pair
+        #the tile may start anywhere in the chromosome, so the first lookup of each pair is a binary search
+        for pair in range(number_of_pairs):
+            cursors[this_thread, pair] = c_pair_segment_offsets[first_pair+pair+1]
+        #[run_start, run_end) is the run of locations where IBD statuses of the pairs are constant and stored in pair_ibd
+        run_start = 1
+        run_end = 0
+        #genotypes of the family for this tile of SNPs are copied to a small contiguous block
+        for i in range(number_of_members):
+            sib1_index = sibs_index[this_thread, i]
+            for snp in range(tile_start, tile_end):
+                family_gts[this_thread, i, snp-tile_start] = c_gts[sib1_index, snp]
+        for snp in range(tile_start, tile_end):
+            tile_snp = snp-tile_start
             len_snp_ibd0 = 0
             len_snp_ibd1 = 0
             len_snp_ibd2 = 0
             loc = c_pos[snp]
+            if loc < run_start or loc >= run_end:
+                #finding the run containing loc between the breakpoints of the family
+                low = c_fam_breakpoint_offsets[index]
+                high = c_fam_breakpoint_offsets[index+1]
+                while low < high:
+                    middle = (low+high)//2
+                    if c_breakpoints[middle] <= loc:
+                        low = middle+1
+                    else:
+                        high = middle
+                if low > c_fam_breakpoint_offsets[index]:
+                    run_start = c_breakpoints[low-1]
+                else:
+                    run_start = INT_MIN
+                if low < c_fam_breakpoint_offsets[index+1]:
+                    run_end = c_breakpoints[low]
+                else:
+                    run_end = INT_MAX
+                for pair in range(number_of_pairs):
+                    pair_ibd[this_thread, pair] = get_IBD_type_from_index(loc,
+                                                                          c_segments,
+                                                                          c_pair_segment_offsets[first_pair+pair],
+                                                                          c_pair_segment_offsets[first_pair+pair+1],
+                                                                          &cursors[this_thread, pair])
+            #sibs are referred to by their row in family_gts
             if sib_count[index] > 1:
             #sibcount should be positive 
                 for i in range(1, sib_count[index]):
                     for j in range(i):
-                        sib1_index = sibs_index[this_thread, i]
-                        sib2_index = sibs_index[this_thread, j]
-                        sib1_id = fams[index][i]
-                        sib2_id = fams[index][j]
-                        sib1_gene_isnan = isnan(c_gts[sib1_index, snp])
-                        sib2_gene_isnan = isnan(c_gts[sib2_index, snp])
-                        ibd_type = get_IBD_type(sib1_id, sib2_id, loc, c_ibd)
+                        sib1_gene_isnan = family_gts[this_thread, i, tile_snp] == c_missing_genotype
+                        sib2_gene_isnan = family_gts[this_thread, j, tile_snp] == c_missing_genotype
+                        ibd_type = pair_ibd[this_thread, i*(i-1)//2 + j]
                         if sib1_gene_isnan  and sib2_gene_isnan:
                             continue
                         #if one sib is nan, create a ibd2 pair consisting of the other sib
                         elif not sib1_gene_isnan  and sib2_gene_isnan:
-                            snp_ibd2[this_thread, len_snp_ibd2,0] = sib1_index
-                            snp_ibd2[this_thread, len_snp_ibd2,1] = sib1_index
+                            snp_ibd2[this_thread, len_snp_ibd2,0] = i
+                            snp_ibd2[this_thread, len_snp_ibd2,1] = i
                             len_snp_ibd2 = len_snp_ibd2+1
 
                         elif sib1_gene_isnan  and not sib2_gene_isnan:
-                            snp_ibd2[this_thread, len_snp_ibd2,0] = sib2_index
-                            snp_ibd2[this_thread, len_snp_ibd2,1] = sib2_index
+                            snp_ibd2[this_thread, len_snp_ibd2,0] = j
+                            snp_ibd2[this_thread, len_snp_ibd2,1] = j
                             len_snp_ibd2 = len_snp_ibd2 + 1
 
                         elif not sib1_gene_isnan and not sib2_gene_isnan:
                             if ibd_type == 2:
-                                snp_ibd2[this_thread, len_snp_ibd2,0] = sib1_index
-                                snp_ibd2[this_thread, len_snp_ibd2,1] = sib2_index
+                                snp_ibd2[this_thread, len_snp_ibd2,0] = i
+                                snp_ibd2[this_thread, len_snp_ibd2,1] = j
                                 len_snp_ibd2 = len_snp_ibd2 + 1
                             if ibd_type == 1:
-                                snp_ibd1[this_thread, len_snp_ibd1,0] = sib1_index
-                                snp_ibd1[this_thread, len_snp_ibd1,1] = sib2_index
+                                snp_ibd1[this_thread, len_snp_ibd1,0] = i
+                                snp_ibd1[this_thread, len_snp_ibd1,1] = j
                                 len_snp_ibd1 = len_snp_ibd1 + 1
                             if ibd_type == 0:
-                                snp_ibd0[this_thread, len_snp_ibd0,0] = sib1_index
-                                snp_ibd0[this_thread, len_snp_ibd0,1] = sib2_index
+                                snp_ibd0[this_thread, len_snp_ibd0,0] = i
+                                snp_ibd0[this_thread, len_snp_ibd0,1] = j
                                 len_snp_ibd0 = len_snp_ibd0 + 1
             else :
-                sib1_index = sibs_index[this_thread, 0]
-                if not isnan(c_gts[sib1_index, snp]):
-                    snp_ibd2[this_thread, len_snp_ibd2,0] = sib1_index
-                    snp_ibd2[this_thread, len_snp_ibd2,1] = sib1_index
+                if family_gts[this_thread, 0, tile_snp] != c_missing_genotype:
+                    snp_ibd2[this_thread, len_snp_ibd2,0] = 0
+                    snp_ibd2[this_thread, len_snp_ibd2,1] = 0
                     len_snp_ibd2 = len_snp_ibd2 + 1
-            snp_ibd0[this_thread,:,:]
-            snp_ibd1[this_thread,:,:]
-            snp_ibd2[this_thread,:,:]
-            if single_parent[index]:
-                imputed_par_gts[index, snp] = impute_snp_from_parent_offsprings(snp,
-                                                                                c_iid_to_bed_index[parents[index]],
-                                                                                snp_ibd0[this_thread,:,:],
-                                                                                snp_ibd1[this_thread,:,:],
-                                                                                snp_ibd2[this_thread,:,:],
-                                                                                freqs[snp],
-                                                                                c_gts,
-                                                                                len_snp_ibd0,
-                                                                                len_snp_ibd1,
-                                                                                len_snp_ibd2
-                                                                                )
+            if single_parent[index] and not c_single_parent_tables:
+                imputed_par_gts[index, snp] = impute_snp_from_parent_offsprings_branches(tile_snp,
+                                                                                         sib_count[index],
+                                                                                         snp_ibd0[this_thread,:,:],
+                                                                                         snp_ibd1[this_thread,:,:],
+                                                                                         snp_ibd2[this_thread,:,:],
+                                                                                         freqs[snp],
+                                                                                         family_gts[this_thread,:,:],
+                                                                                         len_snp_ibd0,
+                                                                                         len_snp_ibd1,
+                                                                                         len_snp_ibd2
+                                                                                         )
+            elif single_parent[index]:
+                imputed_par_gts[index, snp] = impute_snp_from_parent_offsprings_table(tile_snp,
+                                                                                      sib_count[index],
+                                                                                      snp_ibd0[this_thread,:,:],
+                                                                                      snp_ibd1[this_thread,:,:],
+                                                                                      snp_ibd2[this_thread,:,:],
+                                                                                      &parent_offsprings_tables[snp, 0],
+                                                                                      family_gts[this_thread,:,:],
+                                                                                      len_snp_ibd0,
+                                                                                      len_snp_ibd1,
+                                                                                      len_snp_ibd2
+                                                                                      )
             else:
-                imputed_par_gts[index, snp] = impute_snp_from_offsprings(snp, snp_ibd0[this_thread,:,:], snp_ibd1[this_thread,:,:], snp_ibd2[this_thread,:,:], freqs[snp], c_gts, len_snp_ibd0, len_snp_ibd1, len_snp_ibd2)
-            snp = snp+1
-    destroy()
+                imputed_par_gts[index, snp] = impute_snp_from_offsprings(tile_snp, snp_ibd0[this_thread,:,:], snp_ibd1[this_thread,:,:], snp_ibd2[this_thread,:,:], freqs[snp], family_gts[this_thread,:,:], len_snp_ibd0, len_snp_ibd1, len_snp_ibd2)
+        atomic_add_long(&imputed_counts[this_thread, 0], tile_end-tile_start)
+    report_progress(chromosome, np.sum(imputed_counts[:, 0]), number_of_fams, number_of_snps, openmp.omp_get_wtime()-report_times[0], progress_callback)
     if output_address is not None:
         logging.info("with chromosome " + str(chromosome)+": " + "Writing the results as a hdf5 file to "+output_address + ".hdf5")
         with h5py.File(output_address+".hdf5",'w') as f:
-            f.create_dataset('imputed_par_gts',(number_of_fams, number_of_snps),dtype = 'float16', chunks = True, compression = output_compression, compression_opts=output_compression_opts, data = imputed_par_gts)
-            f['families'] = np.array(sibships["FID"].values, dtype='S')
-            f['parental_status'] = sibships[["has_father", "has_mother", "single_parent"]]
-            f['pos'] = pos
-            f["bim_columns"] = np.array(hdf5_output_dict["bim_columns"], dtype='S')
-            f["bim_values"] = np.array(hdf5_output_dict["bim_values"], dtype='S')
-            f["pedigree"] =  np.array(hdf5_output_dict["pedigree"], dtype='S')
-    return sibships["FID"].values.tolist(), np.array(imputed_par_gts)
\ No newline at end of file
+            dataset = create_imputed_gts_dataset(f, number_of_fams, number_of_snps, output_encoding, output_chunk_layout, output_chunk_kb, output_compression, output_compression_opts)
+            with ParallelChunkWriter(dataset, number_of_threads) as writer:
+                writer.write(0, encode_imputed_gts(imputed_par_gts, output_encoding))
+            write_output_metadata(f, sibships, pos, hdf5_output_dict)
+    #the imputed genotypes are returned without a copy
+    return sibships["FID"].values.tolist(), np.asarray(imputed_par_gts)
\ No newline at end of file
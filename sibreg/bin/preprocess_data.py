@@ -2,41 +2,100 @@
 
 Classes
 -------
-    Person
+    Pedigree
+    BedGenotypeReader
 
 Functions
 ----------
     recurcive_append
+    find_clusters
     create_pedigree
     add_control
+    read_gts
+    prepare_sibships
+    group_ibd_segments
+    prepare_ibd
+    write_ibd_cache
+    read_ibd_cache
+    prepare_lazy_data
     prepare_data
 """
 import logging
+import os
+from collections import deque
 import pandas as pd
 import numpy as np
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
 from pysnptools.snpreader import Bed
-class Person:
-    """Just a simple data structure representing individuals
+from sibreg.bin.constants import MISSING_GENOTYPE
+IBD_CACHE_KEYS = ["pair_ids", "pair_segment_offsets", "segments"]
+class Pedigree:
+    """A columnar pedigree where individuals, their parents and their families are integer codes
+
+    All the ids are stored once in a string table, and each column of the pedigree is an array of indices into it,
+    so joins between the columns are integer operations.
 
     Args:
-        id : str
-            IID of the individual.
-        fid : str
-            FID of the individual.
-        pid : str
-            IID of the father of that individual.
-        mid : str
-            IID of the mother of that individual.
+        ids : numpy.ndarray
+            The string table of all the FIDs and IIDs of the pedigree.
+        fids : numpy.ndarray
+            Code of the FID of each individual.
+        iids : numpy.ndarray
+            Code of the IID of each individual.
+        father_ids : numpy.ndarray
+            Code of the IID of the father of each individual.
+        mother_ids : numpy.ndarray
+            Code of the IID of the mother of each individual.
     """
-    def __init__(self, id, fid=None, pid=None, mid=None):
-        self.id = id
-        self.fid = fid
-        self.pid = pid
-        self.mid = mid
+    def __init__(self, ids, fids, iids, father_ids, mother_ids):
+        self.ids = ids
+        self.fids = fids
+        self.iids = iids
+        self.father_ids = father_ids
+        self.mother_ids = mother_ids
+
+    @classmethod
+    def from_ids(cls, fids, iids, father_ids, mother_ids):
+        """Creates the columnar pedigree of the FID, IID, father IID and mother IID of each individual"""
+        codes, ids = pd.factorize(np.column_stack((fids, iids, father_ids, mother_ids)).astype(str).ravel())
+        codes = codes.reshape((-1, 4)).astype(np.int32)
+        return cls(np.asarray(ids).astype(str), codes[:, 0], codes[:, 1], codes[:, 2], codes[:, 3])
+
+    @classmethod
+    def from_dataframe(cls, pedigree):
+        """Creates the columnar pedigree of a pedigree table with 'FID', 'IID', 'FATHER_ID' and, 'MOTHER_ID' columns"""
+        return cls.from_ids(*pedigree[["FID", "IID", "FATHER_ID", "MOTHER_ID"]].values.T)
+
+    def to_dataframe(self):
+        """Returns the pedigree table with 'FID', 'IID', 'FATHER_ID' and, 'MOTHER_ID' columns"""
+        return pd.DataFrame({"FID":self.ids[self.fids], "IID":self.ids[self.iids], "FATHER_ID":self.ids[self.father_ids], "MOTHER_ID":self.ids[self.mother_ids]},
+                            columns = ['FID' , 'IID', 'FATHER_ID' , 'MOTHER_ID'])
+
+    def codes(self, ids):
+        """Returns the codes of the ids, -1 for the ids that are not in the pedigree"""
+        return pd.Index(self.ids).get_indexer(np.asarray(ids).astype(str))
+
+    def rows(self, ids):
+        """Returns the row of the individual of each IID, -1 for the ids that are not individuals of the pedigree. The last row of repeated IIDs is used"""
+        row_of_code = np.full(self.ids.shape[0], -1)
+        np.maximum.at(row_of_code, self.iids, np.arange(self.iids.shape[0]))
+        codes = self.codes(ids)
+        return np.where(codes >= 0, row_of_code[codes], -1)
+
+    def has_father(self):
+        """Returns whether the father of each individual is in the pedigree"""
+        return np.isin(self.father_ids, self.iids)
+
+    def has_mother(self):
+        """Returns whether the mother of each individual is in the pedigree"""
+        return np.isin(self.mother_ids, self.iids)
 
 def recurcive_append(dictionary, index, element):
     """Adds an element to value of all the keys that can be reached from index with using get recursively. 
 
+    Each key is visited once with a breadth first search, so it takes linear time in the size of the reachable part of the graph.
+
     Args:
         dictionary : dict
             A dictionary of objects to list
@@ -47,14 +106,36 @@ def recurcive_append(dictionary, index, element):
         element
             What should be added to values
     """
-    queue = {index}
-    seen_so_far = set()
+    queue = deque([index])
+    seen_so_far = {index}
     while queue:
-        current_index = queue.pop()
-        seen_so_far.add(current_index)
+        current_index = queue.popleft()
         dictionary[current_index].add(element)
-        queue = queue.union(dictionary[current_index])
-        queue = queue.difference(seen_so_far)
+        for neighbour in list(dictionary[current_index]):
+            if neighbour not in seen_so_far:
+                seen_so_far.add(neighbour)
+                queue.append(neighbour)
+
+def find_clusters(number_of_nodes, edges):
+    """Finds the clusters of an undirected graph, the sets of nodes that are connected through its edges.
+
+    It takes linear time in the number of nodes and edges.
+
+    Args:
+        number_of_nodes : int
+            Number of the nodes. Nodes are numbered from 0.
+
+        edges : numpy.ndarray
+            A two-dimensional array where each row is the two nodes of an edge.
+
+    Returns:
+        numpy.ndarray
+            The cluster of each node. Clusters are numbered from 0 in the order of their first node.
+    """
+    edges = np.asarray(edges).reshape((-1, 2))
+    graph = coo_matrix((np.ones(edges.shape[0]), (edges[:, 0], edges[:, 1])), shape=(number_of_nodes, number_of_nodes))
+    number_of_clusters, clusters = connected_components(graph, directed=False)
+    return clusters
 
 def create_pedigree(king_address, agesex_address):
     """Creates pedigree table from agesex file and kinship file in KING format.
@@ -72,6 +153,9 @@ def create_pedigree(king_address, agesex_address):
             Each row contains the age and sex of one individual. Male and Female sex should be represented with 'M' and 'F'.
             Age column is used for distinguishing between parent and child in a parent-offspring relationship inferred from the kinship file.
             ID1 is a parent of ID2 if there is a 'PO' relationship between them and 'ID1' is at least 12 years older than ID2.
+
+    Individuals connected through 'FS' relationships are in the same family. Families are the connected components of the graph of 'FS' relationships.
+    Parents are assigned with array operations over all the 'PO' relationships.
     
     Returns:
         pd.DataFrame:
@@ -89,83 +173,59 @@ def create_pedigree(king_address, agesex_address):
     kinship = pd.merge(kinship, agesex.rename(columns={"sex":"sex1", "age":"age1"}), left_on="ID1", right_index=True)
     kinship = pd.merge(kinship, agesex.rename(columns={"sex":"sex2", "age":"age2"}), left_on="ID2", right_index=True)
     logging.info("dictionaries created")
-    people = {}
-    fid_counter = 0
-    dropouts = []
-    kinship_cols = kinship.columns.tolist()
-    index_id1 = kinship_cols.index("ID1")
-    index_id2 = kinship_cols.index("ID2")
-    index_sex1 = kinship_cols.index("sex1")
-    index_sex2 = kinship_cols.index("sex2")
-    index_age1 = kinship_cols.index("age1")
-    index_age2 = kinship_cols.index("age2")
-    index_inftype = kinship_cols.index("InfType")
-    logging.info("creating pedigree objects")
-    pop_size = kinship.values.shape[0]
-    t = kinship.values.tolist()
-    for row in range(pop_size):
-        relation = t[row][index_inftype]
-        id1 = t[row][index_id1]
-        id2 = t[row][index_id2]
-        age1 = t[row][index_age1]
-        age2 = t[row][index_age2]
-        sex1 = t[row][index_sex1]
-        sex2 = t[row][index_sex2]
-        p1 = people.get(id1)
-        if p1 is None:
-            p1 = Person(id1)
-            people[id1] = p1
-        
-        p2 = people.get(id2)
-        if p2 is None:
-            p2 = Person(id2)
-            people[id2] = p2
-
-        if relation == "PO":
-            if age1 >  age2+12:
-                if sex1 == "F":
-                    p2.mid = p1.id
-                if sex1 == "M":
-                    p2.pid = p1.id
-
-            if age2 > age1+12:
-                if sex2 == "F":
-                    p1.mid = p2.id
-                if sex2 == "M":
-                    p1.pid = p2.id
-        if relation == "FS":
-            if p1.fid is None and p2.fid is None:
-                p1.fid = str(fid_counter)
-                p2.fid = str(fid_counter)
-                fid_counter += 1
-            
-            if p1.fid is None and p2.fid is not None:
-                p1.fid = p2.fid
-
-            if p1.fid is not None and p2.fid is None:
-                p2.fid = p1.fid
-
-    for excess in dropouts:
-        people.pop(excess)
-
-    data = []
-    for p in people.values():
-        if p.fid is None:
-            p.fid = str(fid_counter)
-            fid_counter += 1
-
-        if p.mid is None:
-            #default mother id
-            p.mid = p.fid + "___M"
-
-        if p.pid is None:
-            #default father ir
-            p.pid = p.fid + "___P"
-        
-        data.append((p.fid, p.id, p.pid, p.mid))
-
-    data = pd.DataFrame(data, columns = ['FID' , 'IID', 'FATHER_ID' , 'MOTHER_ID']).astype(str)
-    return data
+    id1 = kinship["ID1"].values
+    id2 = kinship["ID2"].values
+    relation = kinship["InfType"].values
+    #individuals are numbered in the order of their first appearance
+    id_codes, ids = pd.factorize(np.column_stack((id1, id2)).ravel())
+    id_codes = id_codes.reshape((-1, 2))
+    number_of_people = len(ids)
+    logging.info("finding parents")
+    age1 = kinship["age1"].values
+    age2 = kinship["age2"].values
+    sex1 = kinship["sex1"].values
+    sex2 = kinship["sex2"].values
+    is_po = relation == "PO"
+    first_is_parent = is_po & (age1 > age2+12)
+    second_is_parent = is_po & (age2 > age1+12)
+    rows = np.arange(kinship.shape[0])
+    parent_relations = pd.DataFrame({
+        "row": np.concatenate((rows[first_is_parent], rows[second_is_parent])),
+        "child": np.concatenate((id_codes[first_is_parent, 1], id_codes[second_is_parent, 0])),
+        "parent": np.concatenate((id_codes[first_is_parent, 0], id_codes[second_is_parent, 1])),
+        "sex": np.concatenate((sex1[first_is_parent], sex2[second_is_parent])),
+    }).sort_values("row", kind="mergesort")
+    father_codes = np.full(number_of_people, -1)
+    mother_codes = np.full(number_of_people, -1)
+    for sex, parent_codes in [("M", father_codes), ("F", mother_codes)]:
+        #the last relationship of each child in the kinship file is kept
+        relations = parent_relations[parent_relations["sex"] == sex].drop_duplicates("child", keep="last")
+        parent_codes[relations["child"].values] = relations["parent"].values
+    logging.info("finding families")
+    #full siblings that are connected through FS relationships are in the same family
+    fs_codes = id_codes[relation == "FS"]
+    components = find_clusters(number_of_people, fs_codes)
+    has_sibling = np.zeros(number_of_people, dtype=bool)
+    has_sibling[fs_codes.ravel()] = True
+    fid_codes = np.zeros(number_of_people, dtype=int)
+    sibling_fid_codes, sibling_fids = pd.factorize(components[has_sibling])
+    fid_codes[has_sibling] = sibling_fid_codes
+    fid_codes[~has_sibling] = len(sibling_fids)+np.arange(np.sum(~has_sibling))
+    number_of_fams = len(sibling_fids)+np.sum(~has_sibling)
+    fids = np.arange(number_of_fams).astype(str).astype(object)
+    #individuals, families and default father and mother ids of each family are coded in one string table
+    table_codes, table = pd.factorize(np.concatenate((np.asarray(ids).astype(str), fids, fids + "___P", fids + "___M")).astype(str))
+    table_codes = table_codes.astype(np.int32)
+    iid_codes = table_codes[:number_of_people]
+    fid_table_codes = table_codes[number_of_people:number_of_people+number_of_fams]
+    default_father_codes = table_codes[number_of_people+number_of_fams:number_of_people+2*number_of_fams]
+    default_mother_codes = table_codes[number_of_people+2*number_of_fams:]
+    coded_pedigree = Pedigree(np.asarray(table).astype(str),
+                              fid_table_codes[fid_codes],
+                              iid_codes,
+                              np.where(father_codes >= 0, iid_codes[father_codes], default_father_codes[fid_codes]),
+                              np.where(mother_codes >= 0, iid_codes[mother_codes], default_mother_codes[fid_codes]))
+    return coded_pedigree.to_dataframe()
     
 def add_control(pedigree):
     """Adds control families to the pedigree table for testing.
@@ -185,34 +245,291 @@ def add_control(pedigree):
 
     """
 
-    pedigree["has_mother"] = pedigree["MOTHER_ID"].isin(pedigree["IID"])
-    pedigree["has_father"] = pedigree["FATHER_ID"].isin(pedigree["IID"])
-    families_with_both_parents = pedigree[pedigree["has_father"] & pedigree["has_mother"]]
-    count_of_sibs_in_fam = families_with_both_parents.groupby(["FID", "FATHER_ID", "MOTHER_ID"]).count().reset_index()
-    FIDs_with_multiple_sibs = count_of_sibs_in_fam[count_of_sibs_in_fam["IID"] > 1][["FID"]]
-    families_with_multiple_sibs = families_with_both_parents.merge(FIDs_with_multiple_sibs, on = "FID")
-
-    families_with_multiple_sibs["FID"] = "_o_" + families_with_multiple_sibs["FID"].astype(str)
-    families_with_multiple_sibs["MOTHER_ID"] = families_with_multiple_sibs["FID"].astype(str) + "_M"
-    families_with_multiple_sibs["FATHER_ID"] = families_with_multiple_sibs["FID"].astype(str) + "_P"
-
-    keep_mother = families_with_both_parents.copy()
-    keep_mother["FID"] = "_m_" + keep_mother["FID"].astype(str)
-    keep_mother["FATHER_ID"] = keep_mother["FID"].astype(str) + "_P"
-
-    keep_father = families_with_both_parents.copy()
-    keep_father["FID"] = "_p_" + keep_father["FID"].astype(str)
-    keep_father["MOTHER_ID"] = keep_father["FID"].astype(str) + "_M"
-    pedigree = pedigree.append(families_with_multiple_sibs).append(keep_father).append(keep_mother)
-    pedigree = pedigree[['FID' , 'IID', 'FATHER_ID' , 'MOTHER_ID']]
+    coded_pedigree = Pedigree.from_dataframe(pedigree)
+    pedigree["has_mother"] = coded_pedigree.has_mother()
+    pedigree["has_father"] = coded_pedigree.has_father()
+    columns = ['FID' , 'IID', 'FATHER_ID' , 'MOTHER_ID']
+    both_parents = pedigree["has_father"].values & pedigree["has_mother"].values
+    families_with_both_parents = pedigree.loc[both_parents, columns]
+    fids = families_with_both_parents["FID"].astype(str)
+    #sibs are counted by grouping the codes of their family and parents
+    sibship_codes = pd.DataFrame({"FID":coded_pedigree.fids[both_parents],
+                                  "FATHER_ID":coded_pedigree.father_ids[both_parents],
+                                  "MOTHER_ID":coded_pedigree.mother_ids[both_parents]})
+    sib_counts = sibship_codes.groupby(["FID", "FATHER_ID", "MOTHER_ID"])["FID"].transform("size").values
+    has_multiple_sibs = np.isin(sibship_codes["FID"].values, sibship_codes["FID"].values[sib_counts > 1])
+    #all the control families are built with column operations and concatenated once
+    controls = []
+    for prefix, keep_father, keep_mother, rows in [("_o_", False, False, has_multiple_sibs),
+                                                   ("_p_", True, False, slice(None)),
+                                                   ("_m_", False, True, slice(None))]:
+        control = families_with_both_parents[rows].copy()
+        control_fids = prefix + fids[rows]
+        control["FID"] = control_fids
+        if not keep_father:
+            control["FATHER_ID"] = control_fids + "_P"
+        if not keep_mother:
+            control["MOTHER_ID"] = control_fids + "_M"
+        controls.append(control)
+    pedigree = pd.concat([pedigree[columns]] + controls)
     return pedigree
 
 
-def prepare_data(pedigree, genotypes_address, ibd, start=None, end=None, bim_address = None):
-    """Processes the required data for the imputation and returns it.
+class BedGenotypeReader:
+    """Reads the genotypes of a subset of individuals directly from the 2-bit packed bytes of a .bed file
+
+    Only the bytes of the selected individuals are decoded, with a lookup table, straight to int8 genotypes in the layout used by the imputation.
+    Genotypes count the A1 alleles like pysnptools.snpreader.Bed with count_A1 = True. Missing genotypes are sibreg.bin.constants.MISSING_GENOTYPE.
+
+    Args:
+        bed_address : str
+            Address of the .bed file(includes '.bed'). It should be in SNP-major mode.
+        iid_indices : numpy.ndarray
+            Indices of the selected individuals in the .bed file, in the order of their rows in the genotypes that are read.
+        iid_total : int
+            Number of the individuals in the .bed file.
+        sid_total : int
+            Number of the SNPs in the .bed file.
+        sid_start : int, optional
+            Index of the first SNP of the reader in the .bed file.
+        sid_end : int, optional
+            Index after the last SNP of the reader in the .bed file.
+        snps_per_block : int, optional
+            SNPs are decoded in blocks of this many SNPs to keep the temporary arrays small.
+    """
+    #genotype of each 2-bit code: homozygous A1, missing, heterozygous, homozygous A2
+    genotype_of_code = np.array([2, MISSING_GENOTYPE, 1, 0], dtype=np.int8)
+
+    def __init__(self, bed_address, iid_indices, iid_total, sid_total, sid_start = None, sid_end = None, snps_per_block = 1024):
+        self.bed_address = bed_address
+        self.iid_indices = np.asarray(iid_indices, dtype=int)
+        self.iid_count = self.iid_indices.shape[0]
+        self.sid_start, self.sid_end, _ = slice(sid_start, sid_end).indices(sid_total)
+        self.sid_count = max(0, self.sid_end - self.sid_start)
+        self.snps_per_block = snps_per_block
+        self.bytes_per_snp = (iid_total+3)//4
+        with open(bed_address, "rb") as f:
+            magic_number = f.read(3)
+        if magic_number != b"\x6c\x1b\x01":
+            raise ValueError(bed_address+" is not a SNP-major .bed file")
+        self.packed = np.memmap(bed_address, dtype=np.uint8, mode="r", offset=3, shape=(sid_total, self.bytes_per_snp))
+        self.byte_indices = self.iid_indices//4
+        self.shifts = (2*(self.iid_indices%4)).astype(np.uint8)
+
+    def read(self, start = None, end = None):
+        """Reads a slice of the SNPs of the reader and returns it as int8 genotypes with shape(iid_count, end-start)"""
+        start, end, _ = slice(start, end).indices(self.sid_count)
+        gts = np.empty((self.iid_count, max(0, end-start)), dtype=np.int8)
+        for block_start in range(start, end, self.snps_per_block):
+            block_end = min(block_start+self.snps_per_block, end)
+            #the codes are extracted in place, so a block only has the packed bytes and the decoded genotypes as temporaries
+            codes = self.packed[self.sid_start+block_start:self.sid_start+block_end, self.byte_indices]
+            np.right_shift(codes, self.shifts, out=codes)
+            np.bitwise_and(codes, 3, out=codes)
+            gts[:, block_start-start:block_end-start] = self.genotype_of_code[codes].T
+        return gts
+
+def read_gts(gts_reader, start=None, end=None):
+    """Reads a slice of SNPs from a genotype reader and returns it as int8 genotypes.
+
+    Args:
+        gts_reader : BedGenotypeReader or pysnptools.snpreader.SnpReader
+            The genotype reader. prepare_lazy_data can be used to create this.
+
+        start : int, optional
+            Index of the first SNP of the slice.
+
+        end : int, optional
+            Index after the last SNP of the slice.
+
+    Returns:
+        numpy.ndarray
+            Numpy int8 array containing the genotypes of the slice. Missing genotypes are sibreg.bin.constants.MISSING_GENOTYPE.
+    """
+    if isinstance(gts_reader, BedGenotypeReader):
+        return gts_reader.read(start, end)
+    gts = gts_reader[:, start:end].read(dtype=np.float32).val
+    gts[np.isnan(gts)] = MISSING_GENOTYPE
+    return gts.astype(np.int8)
+
+def prepare_sibships(pedigree):
+    """Finds the sibships that should be imputed in the pedigree.
+
+    Args:
+        pedigree : pd.DataFrame
+            The pedigree table. It contains 'FID', 'IID', 'FATHER_ID' and, 'MOTHER_ID' columns.
+
+    Returns:
+        tuple(pandas.Dataframe, set)
+            The first element is the sibships as described in prepare_data. The second element is the set of the IIDs, as ascii bytes,
+            of the individuals that do not have both parents in the pedigree. Only genotypes of these individuals are needed for the imputation.
+    """
+    coded_pedigree = Pedigree.from_dataframe(pedigree)
+    has_father = coded_pedigree.has_father()
+    has_mother = coded_pedigree.has_mother()
+    pedigree["has_father"] = has_father
+    pedigree["has_mother"] = has_mother
+    #keeping individuals with no parents
+    no_parent = ~(has_father & has_mother)
+    no_parent_pedigree = pd.DataFrame({"FID":coded_pedigree.fids[no_parent],
+                                       "FATHER_ID":coded_pedigree.father_ids[no_parent],
+                                       "MOTHER_ID":coded_pedigree.mother_ids[no_parent],
+                                       "has_father":has_father[no_parent],
+                                       "has_mother":has_mother[no_parent],
+                                       "IID":coded_pedigree.iids[no_parent]})
+    byte_ids = coded_pedigree.ids.astype("S")
+    ped_ids = set(byte_ids[no_parent_pedigree["IID"].values].tolist())
+    #finding siblings in each family, grouping by the codes
+    sibships = no_parent_pedigree.groupby(["FID", "FATHER_ID", "MOTHER_ID", "has_father", "has_mother"]).agg({'IID':list}).reset_index()
+    for column in ["FID", "FATHER_ID", "MOTHER_ID"]:
+        sibships[column] = byte_ids[sibships[column].values]
+    sibships["IID"] = [byte_ids[iids].tolist() for iids in sibships["IID"].values]
+
+    sibships["sib_count"] = sibships["IID"].apply(len)
+    sibships["single_parent"] = sibships["has_father"] ^ sibships["has_mother"]
+    sibships = sibships[(sibships["sib_count"]>1) | sibships["single_parent"]]
+    return sibships, ped_ids
+
+def group_ibd_segments(id1, id2, segments):
+    """Groups IBD segments by the pair of individuals that share them
+
+    Args:
+        id1 : numpy.ndarray
+            IID of the first individual of the pair of each segment.
+
+        id2 : numpy.ndarray
+            IID of the second individual of the pair of each segment.
+
+        segments : numpy.ndarray
+            A two-dimensional array where each row is a segment consisting of start, end and IBD status.
+
+    Returns:
+        tuple(numpy.ndarray, numpy.ndarray, numpy.ndarray)
+            The segments in the layout described in prepare_ibd.
+    """
+    if len(id1) == 0:
+        return np.zeros((0, 2), dtype=str), np.zeros(1, dtype=np.dtype("i")), np.zeros((0, 3), dtype=np.dtype("i"))
+    pair_codes, pairs = pd.factorize(pd.MultiIndex.from_arrays([id1, id2]))
+    order = np.argsort(pair_codes, kind="stable")
+    pair_segment_offsets = np.zeros(len(pairs)+1, dtype=np.dtype("i"))
+    pair_segment_offsets[1:] = np.cumsum(np.bincount(pair_codes, minlength=len(pairs)))
+    pair_ids = np.column_stack((pairs.get_level_values(0).values.astype(str), pairs.get_level_values(1).values.astype(str))).reshape((-1, 2))
+    return pair_ids, pair_segment_offsets, np.ascontiguousarray(np.asarray(segments, dtype=np.dtype("i"))[order])
+
+def prepare_ibd(ibd, bim, chromosomes):
+    """Maps the IBD segments of the chromosomes to the locations of their SNPs and returns them grouped by pair of individuals.
+
+    SNP ids are mapped to locations by a binary search in the sorted SNP ids of bim, and segments are grouped by sorting them by pair,
+    so the whole table is processed with vectorised operations.
+
+    Args:
+        ibd : pd.DataFrame
+            A pandas dataframe containing IBD statuses for all SNPs.
+            This It has these columns: "chr", "ID1", "ID2", "IBDType", "StartSNP", "StopSNP".
+
+        bim : pd.DataFrame
+            The bim table of the chromosomes with columns "Chr", "id", "morgans", "coordinate", "allele1", "allele2".
+
+        chromosomes : numpy.ndarray
+            The chromosomes, as strings, whose segments are kept.
+
+    Returns:
+        tuple(numpy.ndarray, numpy.ndarray, numpy.ndarray)
+            IBD segments in a compressed sparse row layout. The first element is a two-dimensional array of str where each row is the IIDs of a pair of related individuals.
+            The second element maps each pair to the index of its first segment. Segments of pair p are in [pair_segment_offsets[p], pair_segment_offsets[p+1]).
+            The third element is a two-dimensional int32 array where each row is a segment consisting of start, end and IBD status.
+            sibreg.bin.impute_from_sibs.build_ibd_index accepts this as its ibd argument.
+    """
+    #chromosomes are compared as labels, so that X, XY and MT are kept
+    chromosome_mask = np.isin(ibd["Chr"].values.astype(str), np.asarray(chromosomes).astype(str))
+    ibd = ibd[chromosome_mask]
+    #mapping SNP ids to locations
+    snp_ids = bim["id"].values.astype(str)
+    snp_order = np.argsort(snp_ids, kind="stable")
+    sorted_snp_ids = snp_ids[snp_order]
+    sorted_snp_locs = bim["coordinate"].values[snp_order]
+    def snp_locations(snps):
+        if sorted_snp_ids.shape[0] == 0:
+            return np.zeros(snps.shape[0], dtype=int), np.zeros(snps.shape[0], dtype=bool)
+        indices = np.minimum(np.searchsorted(sorted_snp_ids, snps), sorted_snp_ids.shape[0]-1)
+        return sorted_snp_locs[indices], sorted_snp_ids[indices] == snps
+    start_locs, start_found = snp_locations(ibd["StartSNP"].values.astype(str))
+    stop_locs, stop_found = snp_locations(ibd["StopSNP"].values.astype(str))
+    found = start_found & stop_found
+    id1 = ibd["ID1"].values.astype(str)[found]
+    id2 = ibd["ID2"].values.astype(str)[found]
+    ibd_types = np.where(ibd["IBDType"].values[found].astype(str) == "IBD2", 2, 1)
+    segments = np.column_stack((start_locs[found], stop_locs[found], ibd_types)).astype(np.dtype("i"))
+    return group_ibd_segments(id1, id2, segments)
+
+def write_ibd_cache(ibd, bim, cache_address):
+    """Writes the IBD segments of the chromosomes of bim to a binary cache that can be memory-mapped by read_ibd_cache
+
+    Segments of each chromosome are written in the layout of prepare_ibd, with SNP ids replaced by their locations,
+    to cache_address/chr{chromosome}.{name}.npy.
+
+    Args:
+        ibd : pd.DataFrame
+            A pandas dataframe containing IBD statuses for all SNPs.
+            This It has these columns: "chr", "ID1", "ID2", "IBDType", "StartSNP", "StopSNP".
+
+        bim : pd.DataFrame
+            The bim table of the chromosomes with columns "Chr", "id", "morgans", "coordinate", "allele1", "allele2".
+
+        cache_address : str
+            Address of the cache directory. It's created if it does not exist.
+    """
+    if not os.path.exists(cache_address):
+        os.makedirs(cache_address)
+    #the tables are grouped by chromosome once, so that each chromosome only processes its own segments
+    ibd_rows = ibd.groupby(ibd["Chr"].values.astype(str)).indices
+    bim_rows = bim.groupby(bim["Chr"].values.astype(str)).indices
+    for chromosome in bim["Chr"].unique().astype(str):
+        logging.info("writing the ibd segments of chromosome " + chromosome + " to " + cache_address)
+        chromosome_bim = bim.iloc[bim_rows[chromosome]]
+        chromosome_ibd = ibd.iloc[ibd_rows.get(chromosome, [])]
+        pair_ids, pair_segment_offsets, segments = prepare_ibd(chromosome_ibd, chromosome_bim, [chromosome])
+        #pair ids are stored as fixed width strings so they can be memory-mapped
+        for key, array in zip(IBD_CACHE_KEYS, [pair_ids.astype(str), pair_segment_offsets, segments]):
+            np.save(os.path.join(cache_address, "chr"+chromosome+"."+key+".npy"), array)
+
+def read_ibd_cache(cache_address, chromosomes):
+    """Memory-maps the IBD segments of the chromosomes written by write_ibd_cache and returns them
+
+    Args:
+        cache_address : str
+            Address of the cache directory.
+
+        chromosomes : numpy.ndarray
+            The chromosomes, as strings, whose segments are returned. Chromosomes missing from the cache have no segments.
+
+    Returns:
+        tuple(numpy.ndarray, numpy.ndarray, numpy.ndarray)
+            IBD segments of the chromosomes in the layout described in prepare_ibd. With one chromosome, the arrays are read-only memory maps.
+    """
+    tables = []
+    for chromosome in chromosomes:
+        addresses = [os.path.join(cache_address, "chr"+str(chromosome)+"."+key+".npy") for key in IBD_CACHE_KEYS]
+        if not os.path.exists(addresses[0]):
+            logging.warning("no ibd segments for chromosome " + str(chromosome) + " in " + cache_address)
+            continue
+        tables.append(tuple(np.load(address, mmap_mode="r") for address in addresses))
+    if len(tables) == 1:
+        return tables[0]
+    if not tables:
+        return np.zeros((0, 2), dtype=str), np.zeros(1, dtype=np.dtype("i")), np.zeros((0, 3), dtype=np.dtype("i"))
+    #pairs of different chromosomes are grouped again
+    id1 = np.concatenate([np.repeat(pair_ids[:, 0], np.diff(offsets)) for pair_ids, offsets, segments in tables])
+    id2 = np.concatenate([np.repeat(pair_ids[:, 1], np.diff(offsets)) for pair_ids, offsets, segments in tables])
+    segments = np.concatenate([segments for pair_ids, offsets, segments in tables])
+    return group_ibd_segments(id1, id2, segments)
+
+def prepare_lazy_data(pedigree, genotypes_address, ibd, start=None, end=None, bim_address = None, sibships = None):
+    """Processes the required data for the imputation except the genotypes and returns it.
+
+    It's the same as prepare_data but instead of the genotypes, it returns a reader of them that has not been read yet.
+    This way the genotypes can be read and imputed in slices of SNPs using read_gts.
 
-    Outputs for used for the imputation have ascii bytes instead of strings.
-    
     Args:
         pedigree : pd.DataFrame 
             The pedigree table. It contains 'FID', 'IID', 'FATHER_ID' and, 'MOTHER_ID' columns.
@@ -224,6 +541,8 @@ def prepare_data(pedigree, genotypes_address, ibd, start=None, end=None, bim_add
             A pandas dataframe containing IBD statuses for all SNPs.
             This It has these columns: "chr", "ID1", "ID2", "IBDType", "StartSNP", "StopSNP".
             Each line states an IBD segment between a pair on individuals. This can be generated using King software.
+            It can also be the address of a cache written by write_ibd_cache, in which case the segments of the chromosomes are read from the cache.
+            It can also be the output of sibreg.bin.impute_from_sibs.build_ibd_index for sibships, in which case it's returned as it is.
 
         start : int, optional
             This function can be used for preparing a slice of a chromosome. This is the location of the start of the slice.
@@ -234,17 +553,12 @@ def prepare_data(pedigree, genotypes_address, ibd, start=None, end=None, bim_add
         bim_address : str, optional
             Address of the bim file if it's different from the address of the bed file. Does not include '.bim'.
 
+        sibships : tuple(pandas.Dataframe, set), optional
+            Output of prepare_sibships for the pedigree, if it's already computed.
+
     Returns:
-        tuple(pandas.Dataframe, dict, numpy.ndarray, pandas.Dataframe, numpy.ndarray, numpy.ndarray)
-            Returns the data required for the imputation. This data is a tuple of multiple objects.
-                sibships: A pandas DataFrame with columns ['FID', 'FATHER_ID', 'MOTHER_ID', 'IID', 'has_father', 'has_mother', 'single_parent'] where IID columns is a list of the IIDs of individuals in that family.
-                    It only contains families that have more than one child or only one parent.
-                iid_to_bed_index: A str->int dictionary mapping IIDs of people to their location in bed file.
-                gts: Numpy array containing the genotype data from the bed file.
-                ibd: A pandas DataFrame with columns "ID1", "ID2", 'segment'. The segments column is a list of IBD segments between ID1 and ID2.
-                    Each segment consists of a start, an end, and an IBD status. The segment list is flattened meaning it's like [start0, end0, ibd_status0, start1, end1, ibd_status1, ...]
-                pos: A numpy array with the position of each SNP in the order of appearance in gts.
-                hdf5_output_dict: A  dictionary whose values will be written in the imputation output under its keys.
+        tuple(pandas.Dataframe, dict, BedGenotypeReader, pandas.Dataframe, numpy.ndarray, numpy.ndarray)
+            The same data as prepare_data, where gts is replaced with gts_reader which is a reader of the genotypes of the individuals in the pedigree and the selected SNPs.
     """
     logging.info("For file "+genotypes_address+": Finding which chromosomes")
     if bim_address is None:
@@ -255,56 +569,31 @@ def prepare_data(pedigree, genotypes_address, ibd, start=None, end=None, bim_add
     chromosomes = bim["Chr"].unique()
     logging.info("with chromosomes " + str(chromosomes)+": " + "initializing data")
     logging.info("with chromosomes " + str(chromosomes)+": " + "loading and filtering pedigree file ...")
-    #keeping individuals with no parents
-    pedigree["has_father"] = pedigree["FATHER_ID"].isin(pedigree["IID"])
-    pedigree["has_mother"] = pedigree["MOTHER_ID"].isin(pedigree["IID"])
-    no_parent_pedigree = pedigree[~(pedigree["has_mother"] & pedigree["has_father"])]
-    no_parent_pedigree[["FID", "IID", "FATHER_ID", "MOTHER_ID"]] = no_parent_pedigree[["FID", "IID", "FATHER_ID", "MOTHER_ID"]].astype("S")
-    ped_ids =  set(no_parent_pedigree["IID"].tolist())
-    #finding siblings in each family
-    sibships = no_parent_pedigree.groupby(["FID", "FATHER_ID", "MOTHER_ID", "has_father", "has_mother"]).agg({'IID':lambda x: list(x)}).reset_index()
-
-    sibships["sib_count"] = sibships["IID"].apply(len)
-    sibships["single_parent"] = sibships["has_father"] ^ sibships["has_mother"]
-    sibships = sibships[(sibships["sib_count"]>1) | sibships["single_parent"]]
-    fids = set([i for i in sibships["FID"].values.tolist() if i.startswith(b"_")])
+    if sibships is None:
+        sibships, ped_ids = prepare_sibships(pedigree)
+    else:
+        sibships, ped_ids = sibships
     logging.info("with chromosomes " + str(chromosomes)+": " + "loading bim file ...")    
     #TODO what if people are related but do not have ibd on chrom
-    logging.info("with chromosomes " + str(chromosomes)+": " + "loading and transforming ibd file ...")
-    ibd["Chr"] = ibd["Chr"].astype(int)
-    ibd = ibd.astype(str)
-    #Adding location of start and end of each
     chromosomes = chromosomes.astype(str)
-    if len(chromosomes)>1:
-        ibd = ibd[ibd["Chr"].isin(chromosomes)][["ID1", "ID2", "IBDType", "StartSNP", "StopSNP"]]
-    else:
-        ibd = ibd[ibd["Chr"]==chromosomes[0]][["ID1", "ID2", "IBDType", "StartSNP", "StopSNP"]]
-
-    ibd["IBDType"] = ibd["IBDType"].apply(lambda x: 2 if x=="IBD2" else 1)
-    temp = bim[["id", "coordinate"]].rename(columns = {"id":"StartSNP","coordinate":"StartSNPLoc"})
-    ibd= ibd.merge(temp, on="StartSNP")
-    temp = bim[["id", "coordinate"]].rename(columns = {"id":"StopSNP","coordinate":"StopSNPLoc"})
-    ibd = ibd.merge(temp, on="StopSNP")
-    ibd['segment'] = ibd[['StartSNPLoc', 'StopSNPLoc', "IBDType"]].values.tolist()
-    def create_seg_list(x):
-        elements = list(x)
-        result = []
-        for el in elements:
-            result = result+el
-        return result
-    ibd = ibd.groupby(["ID1", "ID2"]).agg({'segment':lambda x:create_seg_list(x)}).to_dict()["segment"]
+    if isinstance(ibd, str):
+        logging.info("with chromosomes " + str(chromosomes)+": " + "loading ibd cache ...")
+        ibd = read_ibd_cache(ibd, chromosomes)
+    elif isinstance(ibd, pd.DataFrame):
+        logging.info("with chromosomes " + str(chromosomes)+": " + "loading and transforming ibd file ...")
+        ibd = prepare_ibd(ibd, bim, chromosomes)
     logging.info("with chromosomes " + str(chromosomes)+": " + "loading bed file ...")
     gts_f = Bed(genotypes_address+".bed",count_A1 = True)
-    ids_in_ped = [(id in ped_ids) for id in gts_f.iid[:,1].astype("S")]
+    ids_in_ped = np.isin(gts_f.iid[:,1].astype("S"), np.array(list(ped_ids), dtype="S"))
     gts_ids = gts_f.iid[ids_in_ped]
     if end is not None:        
-        gts = gts_f[ids_in_ped , start:end].read().val.astype(float)
         pos = gts_f.pos[start:end, 2]
         sid = gts_f.sid[start:end]
     else:
-        gts = gts_f[ids_in_ped, :].read().val.astype(float)
+        start = None
         pos = gts_f.pos[:, 2]
         sid = gts_f.sid
+    gts_reader = BedGenotypeReader(genotypes_address+".bed", np.where(ids_in_ped)[0], gts_f.iid_count, gts_f.sid_count, start, end)
     iid_to_bed_index = {i.encode("ASCII"):index for index, i in enumerate(gts_ids[:,1])}
     logging.info("with chromosomes " + str(chromosomes)+": " + "initializing data done ...")
     pedigree[["FID", "IID", "FATHER_ID", "MOTHER_ID"]] = pedigree[["FID", "IID", "FATHER_ID", "MOTHER_ID"]].astype(str)
@@ -313,4 +602,49 @@ def prepare_data(pedigree, genotypes_address, ibd, start=None, end=None, bim_add
     bim_values = selected_bim.to_numpy().astype('S')
     bim_columns = selected_bim.columns
     hdf5_output_dict = {"bim_columns":bim_columns, "bim_values":bim_values, "pedigree":pedigree_output}
+    return sibships, iid_to_bed_index, gts_reader, ibd, pos, chromosomes, hdf5_output_dict
+
+def prepare_data(pedigree, genotypes_address, ibd, start=None, end=None, bim_address = None, sibships = None):
+    """Processes the required data for the imputation and returns it.
+
+    Outputs for used for the imputation have ascii bytes instead of strings.
+    
+    Args:
+        pedigree : pd.DataFrame 
+            The pedigree table. It contains 'FID', 'IID', 'FATHER_ID' and, 'MOTHER_ID' columns.
+        
+        genotypes_address : str
+            Address of the bed file (does not inlude '.bed').
+        
+        ibd : pd.DataFrame
+            A pandas dataframe containing IBD statuses for all SNPs.
+            This It has these columns: "chr", "ID1", "ID2", "IBDType", "StartSNP", "StopSNP".
+            Each line states an IBD segment between a pair on individuals. This can be generated using King software.
+            It can also be the address of a cache written by write_ibd_cache.
+
+        start : int, optional
+            This function can be used for preparing a slice of a chromosome. This is the location of the start of the slice.
+
+        end : int, optional
+            This function can be used for preparing a slice of a chromosome. This is the location of the end of the slice.
+
+        bim_address : str, optional
+            Address of the bim file if it's different from the address of the bed file. Does not include '.bim'.
+
+        sibships : tuple(pandas.Dataframe, set), optional
+            Output of prepare_sibships for the pedigree, if it's already computed.
+
+    Returns:
+        tuple(pandas.Dataframe, dict, numpy.ndarray, pandas.Dataframe, numpy.ndarray, numpy.ndarray)
+            Returns the data required for the imputation. This data is a tuple of multiple objects.
+                sibships: A pandas DataFrame with columns ['FID', 'FATHER_ID', 'MOTHER_ID', 'IID', 'has_father', 'has_mother', 'single_parent'] where IID columns is a list of the IIDs of individuals in that family.
+                    It only contains families that have more than one child or only one parent.
+                iid_to_bed_index: A str->int dictionary mapping IIDs of people to their location in bed file.
+                gts: Numpy int8 array containing the genotype data from the bed file. Missing genotypes are sibreg.bin.constants.MISSING_GENOTYPE.
+                ibd: IBD segments of the pairs of individuals grouped by pair, as returned by prepare_ibd. Each segment consists of a start, an end, and an IBD status.
+                pos: A numpy array with the position of each SNP in the order of appearance in gts.
+                hdf5_output_dict: A  dictionary whose values will be written in the imputation output under its keys.
+    """
+    sibships, iid_to_bed_index, gts_reader, ibd, pos, chromosomes, hdf5_output_dict = prepare_lazy_data(pedigree, genotypes_address, ibd, start, end, bim_address, sibships)
+    gts = read_gts(gts_reader)
     return sibships, iid_to_bed_index, gts, ibd, pos, chromosomes, hdf5_output_dict
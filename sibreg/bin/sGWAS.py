@@ -60,6 +60,9 @@ if __name__ == '__main__':
     parser.add_argument('--no_covariate_estimates',action='store_true',default=False,help='Suppress output of covariate effect estimates')
     parser.add_argument('--fit_VC', action='store_true', default=False,
                         help='Fit the variance components for each SNP (default is to use null model MLE)')
+    parser.add_argument('--batch_size', type=int,
+                        help='Number of SNPs fitted together when the variance components are those of the null model (default 1000)',
+                        default=1000)
     parser.add_argument('--start', type=int,
                         help='Start index of SNPs to perform imputation for in genotype file (starting at zero)',
                         default=0)
@@ -260,37 +263,42 @@ if __name__ == '__main__':
     outfile = h5py.File(args.outprefix+'.hdf5','w')
     outfile['sid'] = sid
     X_length = n_X + 2
-    outfile.create_dataset('xtx',(G.shape[2],X_length,X_length),dtype = 'f',chunks = True, compression = 'gzip', compression_opts=9)
+    # SNPs that are not fitted are left as nan
+    outfile.create_dataset('xtx',(G.shape[2],X_length,X_length),dtype = 'f',chunks = True, compression = 'gzip', compression_opts=9, fillvalue=np.nan)
     outfile.create_dataset('xty', (G.shape[2], X_length), dtype='f', chunks=True, compression='gzip',
-                           compression_opts=9)
+                           compression_opts=9, fillvalue=np.nan)
 
     ############### Loop through loci and fit models ######################
     print('Fitting models for genome-wide SNPs')
-    # Optimize model for SNP
     N_L = np.zeros((G.shape[2]), dtype=int)
-    for loc in xrange(0,G.shape[2]):
-        if freqs[loc] > args.min_maf and freqs[loc] < (1-args.min_maf) and (100*missingness[loc]) < args.max_missing:
-            # Find NAs
-            not_nans = np.sum(G[:, :, loc].mask, axis=1) == 0
-            n_l = np.sum(not_nans)
-            N_L[loc] = n_l
+    passes_filters = ma.filled(np.logical_and(np.logical_and(freqs > args.min_maf, freqs < (1-args.min_maf)), (100*missingness) < args.max_missing), False)
+    # Number of samples without missing genotypes for each SNP
+    not_nans = np.sum(ma.getmaskarray(G), axis=1) == 0
+    N_L[passes_filters] = np.sum(not_nans[:, passes_filters], axis=0)
+    if args.fit_VC:
+        # Optimize model for SNP
+        for loc in np.where(passes_filters)[0]:
+            n_l = N_L[loc]
             X_l = np.ones((n_l, X_length), dtype=np.float64)
-            X_l[:, 0:n_X] = X[not_nans, :]
-            X_l[:, n_X:X_length] = G[not_nans, :, loc]
-            model_l = sibreg.model(y[not_nans], X_l, fam_labels[not_nans])
-            if args.fit_VC:
-                optim_l = model_l.optimize_model(np.array([null_optim['sigma2'], null_optim['tau']]))
-                if optim_l['success']:
-                    alpha_l = model_l.alpha_mle(optim_l['tau'], optim_l['sigma2'], compute_cov=True, xtx_out= True)
-                else:
-                    raise(ValueError('Maximisation of likelihood failed for for ' + sid[loc]))
+            X_l[:, 0:n_X] = X[not_nans[:, loc], :]
+            X_l[:, n_X:X_length] = G[not_nans[:, loc], :, loc]
+            model_l = sibreg.model(y[not_nans[:, loc]], X_l, fam_labels[not_nans[:, loc]])
+            optim_l = model_l.optimize_model(np.array([null_optim['sigma2'], null_optim['tau']]))
+            if optim_l['success']:
+                alpha_l = model_l.alpha_mle(optim_l['tau'], optim_l['sigma2'], compute_cov=True, xtx_out= True)
             else:
-                alpha_l = model_l.alpha_mle(null_optim['tau'], null_optim['sigma2'], compute_cov=True, xtx_out= True)
+                raise(ValueError('Maximisation of likelihood failed for for ' + sid[loc]))
             outfile['xtx'][loc,:,:] = alpha_l[0]
             outfile['xty'][loc,:] = alpha_l[1]
-        else:
-            outfile['xtx'][loc, :, :] = np.nan
-            outfile['xty'][loc, :] = np.nan
+    else:
+        # Fit blocks of SNPs with the null model variance components, handling missing genotypes of each SNP with masks
+        snp_model = sibreg.model(y, X, fam_labels)
+        snp_indices = np.where(passes_filters)[0]
+        for block_start in range(0, snp_indices.shape[0], args.batch_size):
+            block = snp_indices[block_start:(block_start+args.batch_size)]
+            xtx_block, xty_block, alpha_block, alpha_cov_block = snp_model.fit_snps(G[:, :, block], null_optim['tau'], null_optim['sigma2'])
+            outfile['xtx'][block] = xtx_block
+            outfile['xty'][block] = xty_block
     outfile['sigma2'] = null_optim['sigma2']
     outfile['tau'] = null_optim['tau']
     outfile['N_L'] = N_L
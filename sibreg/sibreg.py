@@ -2,7 +2,9 @@ import numpy as np
 import numpy.ma as ma
 from pysnptools.snpreader import Bed, Pheno
 from scipy.optimize import fmin_l_bfgs_b
+from scipy.sparse import csr_matrix
 import h5py
+from sibreg.bin.preprocess_data import Pedigree
 
 class model(object):
     """Define a linear model with within-class correlations.
@@ -31,25 +33,21 @@ class model(object):
         if add_intercept:
             X = np.hstack((np.ones((self.n,1),dtype=X.dtype),X))
         self.X = X
-        # Label mapping
-        self.label_counts = dict()
-        self.label_indices = dict()
-        for l in range(0,labels.shape[0]):
-            if labels[l] not in self.label_counts:
-                self.label_counts[labels[l]]=1
-                self.label_indices[labels[l]] = [l]
-            else:
-                self.label_counts[labels[l]]+=1
-                self.label_indices[labels[l]].append(l)
-        self.y_lab = dict()
-        self.X_lab = dict()
-        for label in self.label_indices.keys():
-            self.y_lab[label]=y[self.label_indices[label]]
-            self.X_lab[label]=X[self.label_indices[label],:]
-        self.n_labels = len(self.y_lab.keys())
         # response
         self.y=y
         self.labels=labels
+        # Families as integer codes, and a sparse families x samples indicator matrix for summing within families
+        self.label_values, self.label_codes = np.unique(labels, return_inverse=True)
+        self.family_sizes = np.bincount(self.label_codes)
+        self.family_indicator = csr_matrix((np.ones(self.n), (self.label_codes, np.arange(self.n))), shape=(self.label_values.shape[0], self.n))
+        self.n_labels = self.label_values.shape[0]
+        # Sufficient statistics for alpha_mle
+        X = X.astype(np.float64, copy=False)
+        y = y.astype(np.float64, copy=False)
+        self.X_T_X = X.T.dot(X)
+        self.X_T_y = X.T.dot(y)
+        self.X_sums = self.family_sums(X)
+        self.y_sums = self.family_sums(y)
 
     def alpha_mle(self, tau, sigma2, compute_cov = False, xtx_out = False):
         """
@@ -66,16 +64,10 @@ class model(object):
                 MLE of alpha
 
         """
-        X_T_X = np.zeros((self.X.shape[1],self.X.shape[1]),dtype = np.float64)
-        X_T_y = np.zeros((self.X.shape[1]), dtype = np.float64)
-
-        for label in self.y_lab.keys():
-            sigma_u = sigma2/tau
-            Sigma_lab = sigma_u*np.ones((self.label_counts[label],self.label_counts[label]))
-            np.fill_diagonal(Sigma_lab,sigma_u+sigma2)
-            Sigma_lab_inv = np.linalg.inv(Sigma_lab)
-            X_T_X = X_T_X + np.dot(self.X_lab[label].T,Sigma_lab_inv.dot(self.X_lab[label]))
-            X_T_y = X_T_y + np.dot(self.X_lab[label].T, Sigma_lab_inv.dot(self.y_lab[label]))
+        # Within a family of size n, Sigma = sigma2*(I+11'/tau), so Sigma^{-1} = (I-11'/(tau+n))/sigma2
+        weights = 1/(tau+self.family_sizes)
+        X_T_X = (self.X_T_X-(self.X_sums.T*weights).dot(self.X_sums))/sigma2
+        X_T_y = (self.X_T_y-(self.X_sums.T*weights).dot(self.y_sums))/sigma2
 
         if xtx_out:
             return [X_T_X,X_T_y.reshape((self.X.shape[1]))]
@@ -108,6 +100,7 @@ class model(object):
         """
         ## Likelihood
         alpha = self.alpha_mle(tau, sigma2)
+        # The residuals are computed directly, as expanding RSS with X'X and X'y cancels badly when y is not centred
         resid = self.y - self.X.dot(alpha)
         RSS = np.sum(np.square(resid))
 
@@ -116,19 +109,13 @@ class model(object):
         ## Gradient with respect to sigma2
         grad_sigma2 = self.n/sigma2-RSS/np.square(sigma2)
 
+        ## Family terms
+        weights = 1/(tau+self.family_sizes)
+        resid_square_sums = np.square(self.family_sums(resid))
+        L = L - np.sum(resid_square_sums*weights)/sigma2+np.sum(np.log(1+self.family_sizes/tau))
+        grad_sigma2 += np.sum(resid_square_sums*weights)/np.square(sigma2)
         ## Gradient with respect to tau
-        grad_tau = 0
-
-        for label in self.y_lab.keys():
-            resid_label=resid[self.label_indices[label]]
-            resid_sum = np.sum(resid_label)
-            resid_square_sum = np.square(resid_sum)
-            # Add to likelihood
-            L = L - resid_square_sum/(sigma2*(tau+self.label_counts[label]))+np.log(1+self.label_counts[label]/tau)
-            # Add to grad sigma2
-            grad_sigma2+=resid_square_sum/(np.square(sigma2)*(tau+self.label_counts[label]))
-            # Add to grad tau
-            grad_tau+=(resid_square_sum/sigma2-self.label_counts[label]*(1+self.label_counts[label]/tau))/np.square(tau+self.label_counts[label])
+        grad_tau = np.sum((resid_square_sums/sigma2-self.family_sizes*(1+self.family_sizes/tau))*np.square(weights))
 
         # Overall gradient vector
         grad = np.hstack((grad_sigma2,grad_tau))
@@ -149,14 +136,15 @@ class model(object):
                 dictionary with keys: 'success', whether optimisation was successful (bool);
                 'warnflag', output of L-BFGS-B algorithm giving warnings; 'sigma2', MLE of
                 residual variance; 'tau', MLE of ratio of residual variance to within-class variance;
-                'likelihood', maximum of likelihood.
+                'likelihood', maximum of likelihood; 'iterations' and 'evaluations', number of iterations
+                and likelihood evaluations of L-BFGS-B.
 
         """
         # Paramtere boundaries
         parbounds=[(0.00001, None),(0.00001, None)]
         # Optimize
         optimized = fmin_l_bfgs_b(func=lik_and_grad,x0=init_params,
-                                args=(self.y, self.X, self.labels),
+                                args=(self,),
                                   bounds = parbounds)
 
         # Get MLE
@@ -168,23 +156,156 @@ class model(object):
             optim['success'] = False
         optim['sigma2'] = optimized[0][0]
         optim['tau'] = optimized[0][1]
+        optim['iterations'] = optimized[2]['nit']
+        optim['evaluations'] = optimized[2]['funcalls']
         # Get parameter covariance
         optim['likelihood'] = -0.5 * np.float64(self.n) * (optimized[1] + np.log(2 * np.pi))
 
         return optim
 
+    def family_sums(self, x):
+        """
+        Sum an array over the samples of each family
+
+        Args:
+            x : :class:`~numpy:numpy.array`
+                array whose first axis is the samples
+
+        Returns:
+            sums : :class:`~numpy:numpy.array`
+                sums over the families, in the order of label_values
+
+        """
+        return self.family_indicator.dot(x.reshape((self.n, -1))).reshape((self.n_labels,)+x.shape[1:])
+
     def sigma_inv_root(self,tau,sigma2):
+        """
+        Compute the symmetric inverse square root of the covariance matrix of each family
 
-        sigma2_nsqrt = dict()
+        Within a family of size n, Sigma^{-1/2} = (I-c11'/n)/sqrt(sigma2) where c = 1-1/sqrt(1+n/tau),
+        so the matrix is computed once for each family size.
 
-        for label in self.y_lab.keys():
-            sigma_u = sigma2/tau
-            Sigma_lab = sigma_u*np.ones((self.label_counts[label],self.label_counts[label]))
-            np.fill_diagonal(Sigma_lab,sigma_u+sigma2)
-            sigma2_chol_lab = np.linalg.cholesky(Sigma_lab)
-            sigma2_nsqrt[label] = np.linalg.inv(sigma2_chol_lab)
+        Args:
+            tau : :class:`float`
+                ratio of variance of model residuals to variance explained by mean differences between classes
+            sigma2 : :class:`float`
+                variance of model residuals
+
+        Returns:
+            sigma2_nsqrt : :class:`dict`
+                inverse square root of the covariance matrix of each label
+
+        """
+        sigma2_nsqrt_sizes = dict()
+        for size in np.unique(self.family_sizes).tolist():
+            c = 1-1/np.sqrt(1+size/tau)
+            sigma2_nsqrt_sizes[size] = (np.identity(size)-c/size)/np.sqrt(sigma2)
+        return {label:sigma2_nsqrt_sizes[size] for label, size in zip(self.label_values.tolist(), self.family_sizes.tolist())}
+
+    def fit_snps(self, G, tau, sigma2):
+        """
+        Compute the MLE of alpha for many SNPs at once, given variance parameters
 
-        return sigma2_nsqrt
+        The design matrix of SNP m is the covariates of the model followed by G[:,:,m], and the computations
+        are done with array operations over all the SNPs. Missing genotypes are given as nan or as the mask
+        of a masked array. Each SNP is fitted on the samples with none of its genotype covariates missing,
+        with family sizes and sums computed over those samples, as if the model was subset to them.
+        Memory scales with samples x genotype covariates x SNPs, so large G should be split in blocks of SNPs.
+
+        Args:
+            G : :class:`~numpy:numpy.array`
+                3D array, or masked array, of genotype covariates with shape (samples, genotype covariates, SNPs)
+            tau : :class:`float`
+                ratio of variance of model residuals to variance explained by mean differences between classes
+            sigma2 : :class:`float`
+                variance of model residuals
+
+        Returns:
+            X_T_X, X_T_y, alpha, alpha_cov : :class:`~numpy:numpy.array`
+                X'Sigma^{-1}X, X'Sigma^{-1}y, MLE of alpha and its covariance matrix stacked over the SNPs.
+                alpha and alpha_cov are nan for the SNPs whose X'Sigma^{-1}X is singular.
+
+        """
+        if G.ndim != 3 or G.shape[0] != self.n:
+            raise(ValueError('G should have shape (samples, genotype covariates, SNPs)'))
+        n_X = self.X.shape[1]
+        n_G = G.shape[1]
+        n_snps = G.shape[2]
+        # A sample is used for a SNP if none of its genotype covariates are missing, and missing values are zeroed
+        missing = np.isnan(ma.getdata(G))
+        if ma.is_masked(G):
+            missing = np.logical_or(missing, ma.getmaskarray(G))
+        observed = np.logical_not(np.any(missing, axis=1))
+        complete = np.all(observed)
+        if complete:
+            G = ma.getdata(G).astype(np.float64, copy=False)
+        else:
+            data = ma.getdata(G)
+            G = np.zeros(data.shape, dtype=np.float64)
+            np.copyto(G, data, where=observed[:, np.newaxis, :])
+        G_sums = self.family_sums(G)
+        X_T_X = np.zeros((n_snps, n_X+n_G, n_X+n_G), dtype=np.float64)
+        X_T_y = np.zeros((n_snps, n_X+n_G), dtype=np.float64)
+        Xy = np.column_stack((self.X, self.y))
+        if complete:
+            weights = 1/(tau+self.family_sizes)
+            weighted_G_sums = G_sums*weights.reshape((self.n_labels,1,1))
+            # Covariates
+            X_T_X[:, :n_X, :n_X] = (self.X_T_X-(self.X_sums.T*weights).dot(self.X_sums))/sigma2
+            X_T_y[:, :n_X] = (self.X_T_y-(self.X_sums.T*weights).dot(self.y_sums))/sigma2
+            # Covariates and response with genotypes, in one pass over G
+            Xy_T_G = np.tensordot(Xy, G, axes=(0, 0))-np.tensordot(np.column_stack((self.X_sums, self.y_sums)), weighted_G_sums, axes=(0, 0))
+        else:
+            # Family sizes and sums of covariates and response over the samples observed for each SNP
+            observed = observed.astype(np.float64)
+            weights = 1/(tau+self.family_sums(observed))
+            weighted_G_sums = G_sums*weights[:, np.newaxis, :]
+            Xy_sums = np.stack([self.family_indicator.multiply(Xy[:, j]).tocsr().dot(observed) for j in range(n_X+1)], axis=1)
+            # Covariates
+            Xy_T_Xy = observed.T.dot((Xy[:, :, np.newaxis]*Xy[:, np.newaxis, :]).reshape((self.n, -1))).reshape((n_snps, n_X+1, n_X+1))
+            Xy_T_Xy = (Xy_T_Xy-np.einsum('fjm,flm->mjl', Xy_sums*weights[:, np.newaxis, :], Xy_sums))/sigma2
+            X_T_X[:, :n_X, :n_X] = Xy_T_Xy[:, :n_X, :n_X]
+            X_T_y[:, :n_X] = Xy_T_Xy[:, :n_X, n_X]
+            # Covariates and response with genotypes
+            Xy_T_G = np.tensordot(Xy, G, axes=(0, 0))-np.einsum('fjm,fkm->jkm', Xy_sums, weighted_G_sums)
+        Xy_T_G = Xy_T_G/sigma2
+        X_T_X[:, :n_X, n_X:] = np.transpose(Xy_T_G[:n_X], (2, 0, 1))
+        X_T_X[:, n_X:, :n_X] = np.transpose(Xy_T_G[:n_X], (2, 1, 0))
+        X_T_y[:, n_X:] = Xy_T_G[n_X].T
+        # Genotypes
+        X_T_X[:, n_X:, n_X:] = (np.einsum('ikm,ilm->mkl', G, G)-np.einsum('fkm,flm->mkl', G_sums, weighted_G_sums))/sigma2
+        # Solve for the SNPs with invertible X'Sigma^{-1}X
+        alpha = np.full((n_snps, n_X+n_G), np.nan)
+        alpha_cov = np.full((n_snps, n_X+n_G, n_X+n_G), np.nan)
+        invertible = np.linalg.matrix_rank(X_T_X) == n_X+n_G
+        alpha_cov[invertible] = np.linalg.inv(X_T_X[invertible])
+        alpha[invertible] = np.einsum('mkl,ml->mk', alpha_cov[invertible], X_T_y[invertible])
+        return X_T_X, X_T_y, alpha, alpha_cov
+
+    def whiten(self, x, tau, sigma2, axis = 0):
+        """
+        Multiply x by the symmetric inverse square root of the covariance matrix of the families, as given by sigma_inv_root
+
+        Args:
+            x : :class:`~numpy:numpy.array`
+                array with the samples of the model along axis
+            tau : :class:`float`
+                ratio of variance of model residuals to variance explained by mean differences between classes
+            sigma2 : :class:`float`
+                variance of model residuals
+            axis : :class:`int`
+                axis of the samples
+
+        Returns:
+            x : :class:`~numpy:numpy.array`
+                transformed array with the shape of x
+
+        """
+        x = np.moveaxis(x, axis, 0)
+        shape = (self.n_labels,)+(1,)*(x.ndim-1)
+        c = 1-1/np.sqrt(1+self.family_sizes/tau)
+        family_shrinkage = (c/self.family_sizes).reshape(shape)*self.family_sums(x)
+        return np.moveaxis((x-family_shrinkage[self.label_codes])/np.sqrt(sigma2), 0, axis)
 
     def predict(self,X):
         """
@@ -209,8 +330,12 @@ class model(object):
 
 def lik_and_grad(pars,*args):
     # Wrapper for function to pass to L-BFGS-B
-    y, X, labels = args
-    mod = model(y,X,labels)
+    # args is either a model, which is evaluated without being rebuilt, or y, X and labels to build one
+    if len(args) == 1:
+        mod = args[0]
+    else:
+        y, X, labels = args
+        mod = model(y,X,labels)
     return mod.likelihood_and_gradient(pars[0],pars[1])
 
 def simulate(n,alpha,sigma2,tau):
@@ -414,6 +539,27 @@ def make_id_dict(x,col=0):
         id_dict[x[i]] = i
     return id_dict
 
+def find_id_indices(x, ids):
+    # Index of each element of x in ids, or -1 if it's not in ids. Like make_id_dict, the last occurrence of repeated ids is used
+    x = np.asarray(x)
+    ids = np.asarray(ids)
+    if ids.shape[0] == 0:
+        return np.full(x.shape[0], -1, dtype=int)
+    order = np.argsort(ids, kind='mergesort')
+    sorted_ids = ids[order]
+    positions = np.searchsorted(sorted_ids, x, side='right') - 1
+    found = positions >= 0
+    found[found] = sorted_ids[positions[found]] == x[found]
+    return np.where(found, order[np.maximum(positions, 0)], -1)
+
+def find_dict_indices(x, id_dict):
+    # Values of id_dict for the elements of x, or -1 for those that are not in id_dict
+    if len(id_dict) == 0:
+        return np.full(np.asarray(x).shape[0], -1, dtype=int)
+    dict_values = np.array(list(id_dict.values()), dtype=int)
+    indices = find_id_indices(x, np.array(list(id_dict.keys())))
+    return np.where(indices >= 0, dict_values[indices], -1)
+
 def convert_str_array(x):
     x_shape = x.shape
     x = x.flatten()
@@ -432,19 +578,55 @@ def encode_str_array(x):
     x_out = np.array([y.encode('ascii') for y in x])
     return x_out.reshape(x_shape)
 
+def read_imputed_par_gts(imputed_par_gts, index = ()):
+    # Reads imputed parental genotypes from the imputation output, decoding them if they are stored as quantised dosages
+    values = imputed_par_gts[index]
+    if imputed_par_gts.attrs.get('encoding') == 'uint8':
+        decoded = np.asarray(values, dtype=np.float32)*np.float32(imputed_par_gts.attrs['scale'])
+        decoded[values == imputed_par_gts.attrs['nan_code']] = np.nan
+        return decoded
+    return np.array(values)
+
+def read_imputed_region(par_gts_f, chromosome, start = None, end = None):
+    # Reads the imputed parental genotypes of the SNPs of chromosome with start <= position <= end from a whole genome imputation output
+    # Uses the snp_index written by impute_runner.merge_imputation_outputs
+    # Returns the imputed parental genotypes (families x SNPs), the positions and the ids of the SNPs
+    snp_index = par_gts_f['snp_index']
+    # the SNPs of a chromosome are contiguous in the index
+    in_chromosome = np.flatnonzero(np.array(snp_index['chromosome']).astype(str) == str(chromosome))
+    first, last = (in_chromosome[0], in_chromosome[-1]+1) if in_chromosome.shape[0] > 0 else (0, 0)
+    pos = np.array(snp_index['pos'][first:last])
+    # positions are sorted within a chromosome
+    region_start = 0 if start is None else np.searchsorted(pos, start, side='left')
+    region_end = pos.shape[0] if end is None else np.searchsorted(pos, end, side='right')
+    first, last, pos = first+region_start, first+region_end, pos[region_start:region_end]
+    sid = np.array(snp_index['sid'][first:last]).astype(str)
+    groups = np.array(snp_index['groups']).astype(str)
+    snp_groups = np.array(snp_index['group'][first:last])
+    columns = np.array(snp_index['column'][first:last])
+    imp_gts = np.zeros((par_gts_f['families'].shape[0], last-first), dtype=np.float32)
+    for group in np.unique(snp_groups):
+        in_group = np.where(snp_groups == group)[0]
+        # h5py reads columns in increasing order
+        order = np.argsort(columns[in_group])
+        imp_gts[:, in_group[order]] = read_imputed_par_gts(par_gts_f[groups[group]+'/imputed_par_gts'], (slice(None), columns[in_group][order]))
+    return imp_gts, pos, sid
+
 def find_individuals_with_sibs(ids,ped,gts_ids, return_ids_only = False):
+    # Code the pedigree, so the ids are joined with it on integer codes
+    coded_ped = Pedigree.from_ids(ped[:, 0], ped[:, 1], ped[:, 2], ped[:, 3])
     # Find genotyped sibships of size > 1
-    ped_dict = make_id_dict(ped, 1)
-    ids_in_ped = np.array([x in ped_dict for x in gts_ids])
+    gts_ped_indices = coded_ped.rows(gts_ids)
+    ids_in_ped = gts_ped_indices >= 0
     gts_fams = np.zeros((gts_ids.shape[0]),dtype=gts_ids.dtype)
-    gts_fams[ids_in_ped] = np.array([ped[ped_dict[x], 0] for x in gts_ids[ids_in_ped]])
+    gts_fams[ids_in_ped] = ped[gts_ped_indices[ids_in_ped], 0]
     fams, counts = np.unique(gts_fams[ids_in_ped], return_counts=True)
-    sibships = set(fams[counts > 1])
+    sibships = fams[counts > 1]
     # Find individuals with genotyped siblings
-    ids_in_ped = np.array([x in ped_dict for x in ids])
-    ids = ids[ids_in_ped]
-    ids_fams = np.array([ped[ped_dict[x], 0] for x in ids])
-    ids_with_sibs = np.array([x in sibships for x in ids_fams])
+    ped_indices = coded_ped.rows(ids)
+    ids = ids[ped_indices >= 0]
+    ids_fams = ped[ped_indices[ped_indices >= 0], 0]
+    ids_with_sibs = np.isin(ids_fams, sibships)
     ids = ids[ids_with_sibs]
     ids_fams = ids_fams[ids_with_sibs]
     if return_ids_only:
@@ -481,6 +663,13 @@ def get_fam_means(ids,ped,gts,gts_ids,remove_proband = True, return_famsizes = F
         return gtarray(G_sib,ids)
 
 
+def code_indices(coded_ped, ids, indices):
+    # Index of each code of coded_ped, from the indices of ids, or -1 for the codes that are not in ids. The largest index of repeated ids is used
+    codes = coded_ped.codes(ids)
+    index_of_code = np.full(coded_ped.ids.shape[0], -1, dtype=int)
+    np.maximum.at(index_of_code, codes[codes >= 0], np.asarray(indices, dtype=int)[codes >= 0])
+    return index_of_code
+
 def find_par_gts(pheno_ids,ped,gts_id_dict,fams = None):
     # Whether mother and father have observed/imputed genotypes
     par_status = np.zeros((pheno_ids.shape[0],2),dtype=int)
@@ -488,42 +677,35 @@ def find_par_gts(pheno_ids,ped,gts_id_dict,fams = None):
     # Indices of obsered/imputed genotypes in relevant arrays
     gt_indices = np.zeros((pheno_ids.shape[0],3),dtype=int)
     gt_indices[:] = -1
-    ## Build dictionaries
-    ## Where each individual is in the pedigree
-    ped_dict = make_id_dict(ped,1)
+    # Store family ID of each individual
+    fam_labels = np.zeros((pheno_ids.shape[0]),dtype=ped.dtype)
+    # Find index in genotypes
+    gt_indices[:, 0] = find_dict_indices(pheno_ids, gts_id_dict)
+    # Code the pedigree, so the joins with it are integer operations
+    coded_ped = Pedigree.from_ids(ped[:, 0], ped[:, 1], ped[:, 2], ped[:, 3])
+    # Find index in pedigree
+    ped_indices = coded_ped.rows(pheno_ids)
+    in_ped = np.where(ped_indices >= 0)[0]
+    ped_rows = ped[ped_indices[in_ped], :]
+    fam_labels[in_ped] = ped_rows[:, 0]
+    # Genotype index of each code of the pedigree
+    gts_of_code = code_indices(coded_ped, np.array(list(gts_id_dict.keys())), np.array(list(gts_id_dict.values()), dtype=int))
+    # Check for observed fathers and mothers
+    for parent_codes, gt_col, status_col in [(coded_ped.father_ids, 1, 0), (coded_ped.mother_ids, 2, 1)]:
+        parent_indices = gts_of_code[parent_codes[ped_indices[in_ped]]]
+        observed = in_ped[parent_indices >= 0]
+        gt_indices[observed, gt_col] = parent_indices[parent_indices >= 0]
+        par_status[observed, status_col] = 0
+    # If parent not observed, look for imputation
     if fams is not None:
         # Where the imputed data is for each family
-        fam_dict = make_id_dict(fams)
-        # Store family ID of each individual
-    fam_labels = np.zeros((pheno_ids.shape[0]),dtype='U')
-    # Find status and find indices
-    for i in range(0,pheno_ids.shape[0]):
-        # Find index in genotypes
-        if pheno_ids[i] in gts_id_dict:
-            gt_indices[i,0] = gts_id_dict[pheno_ids[i]]
-        # Find index in pedigree
-        if pheno_ids[i] in ped_dict:
-            ped_i = ped[ped_dict[pheno_ids[i]],:]
-            fam_labels[i] = ped_i[0]
-            # Check for observed father
-            if ped_i[2] in gts_id_dict:
-                gt_indices[i,1] = gts_id_dict[ped_i[2]]
-                par_status[i,0] = 0
-            # Check for observed mother
-            if ped_i[3] in gts_id_dict:
-                gt_indices[i, 2] = gts_id_dict[ped_i[3]]
-                par_status[i,1] = 0
-            # If parent not observed, look for imputation
-            if fams is not None:
-                if ped_i[0] in fam_dict:
-                    imp_index = fam_dict[ped_i[0]]
-                    # Check if this is imputation of father, or mother, or both
-                    if ped_i[4] == 'False':
-                        gt_indices[i,1] = imp_index
-                        par_status[i,0] = 1
-                    if ped_i[5] == 'False':
-                        gt_indices[i, 2] = imp_index
-                        par_status[i, 1] = 1
+        fams = np.asarray(fams)
+        imp_indices = code_indices(coded_ped, fams, np.arange(fams.shape[0]))[coded_ped.fids[ped_indices[in_ped]]]
+        # Check if this is imputation of father, or mother, or both
+        for has_parent_col, gt_col, status_col in [(4, 1, 0), (5, 2, 1)]:
+            imputed = (imp_indices >= 0) & (ped_rows[:, has_parent_col] == 'False')
+            gt_indices[in_ped[imputed], gt_col] = imp_indices[imputed]
+            par_status[in_ped[imputed], status_col] = 1
     return par_status, gt_indices, fam_labels
 
 
@@ -614,7 +796,7 @@ def get_gts_matrix(par_gts_f,gts_f,snp_ids,ids = None, sib = False):
 
     # Read imputed parental genotypes
     print('Reading imputed parental genotypes')
-    imp_gts = np.array(par_gts_f['imputed_par_gts'][:,in_obs_sid])
+    imp_gts = read_imputed_par_gts(par_gts_f['imputed_par_gts'], (slice(None), in_obs_sid))
     imp_gts = imp_gts[imp_indices,:]
     fams = fams[imp_indices]
     # Read observed genotypes
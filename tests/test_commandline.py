@@ -1,129 +1,202 @@
 import unittest
 import subprocess
+import os
+import re
+import json
+import shutil
+import tracemalloc
+import h5py
+import numpy as np
+import pandas as pd
 from tests.test_imputation import imputation_test
+from sibreg.sibreg import read_imputed_region, read_imputed_par_gts
+from sibreg.bin.preprocess_data import add_control, prepare_lazy_data, BedGenotypeReader
+from sibreg.bin.impute_from_sibs import build_ibd_index
+from impute_runner import get_chunk_size, run_chunked_imputation
+
+def impute_runner_command(*args, control = True, ibd = "test_data/sample.segments.gz", genotypes = "test_data/sample~", chromosomes = ("1", "3"),
+                          relatives = ("--pedigree", "test_data/sample.ped"), output_address = "outputs/tmp/test_sample_imputed~"):
+    """Returns the command that imputes the test sample with impute_runner.py, followed by args"""
+    command = ["python", "impute_runner.py"] + (["-c"] if control else []) + [ibd, genotypes]
+    if chromosomes is not None:
+        command += ["--from_chr", chromosomes[0], "--to_chr", chromosomes[1]]
+    return command + list(relatives) + ["--output_address", output_address] + list(args)
+
+def prepare_sample_chromosome():
+    """Prepares the first chromosome of the test sample for run_chunked_imputation, with the genotypes not read yet"""
+    pedigree = add_control(pd.read_csv("test_data/sample.ped", sep = " "))
+    ibd = pd.read_csv("test_data/sample.segments.gz", sep = "\t")
+    sibships, iid_to_bed_index, gts_reader, ibd, pos, chromosomes, hdf5_output_dict = prepare_lazy_data(pedigree, "test_data/sample1", ibd)
+    ibd = build_ibd_index(sibships["IID"].values.tolist(), ibd)
+    return sibships, iid_to_bed_index, gts_reader, ibd, pos.astype(int), chromosomes, hdf5_output_dict
+
+class RunInterrupted(Exception):
+    pass
+
+class InterruptedGenotypeReader(BedGenotypeReader):
+    """Reads the genotypes like reader and counts the reads. After max_reads reads, it raises RunInterrupted as if the run was killed"""
+    def __init__(self, reader, max_reads = None):
+        self.__dict__.update(reader.__dict__)
+        self.max_reads = max_reads
+        self.reads = 0
+
+    def read(self, start = None, end = None):
+        if self.max_reads is not None and self.reads >= self.max_reads:
+            raise RunInterrupted()
+        self.reads += 1
+        return BedGenotypeReader.read(self, start, end)
 
 class TestCommanline(unittest.TestCase):
     p_value_threshold = 0.01
-    def test_impute_runner_with_pedigree(self):
-        command = ["python",
-                   "impute_runner.py",
-                   "test_data/sample.segments.gz",
-                   "test_data/sample~",
-                   "--from_chr", "1",
-                   "--to_chr", "3",
-                   "--pedigree", "test_data/sample.ped",
-                   "--output_address", "outputs/tmp/test_sample_imputed~",
-                   ]
-        subprocess.check_call(command)
-    
-    def test_impute_runner_with_pedigree_control(self):
-        command = ["python",
-                   "impute_runner.py",
-                   "-c",
-                   "test_data/sample.segments.gz",
-                   "test_data/sample~",
-                   "--from_chr", "1",
-                   "--to_chr", "3",
-                   "--pedigree", "test_data/sample.ped",
-                   "--output_address", "outputs/tmp/test_sample_imputed~",
-                   ]
-        subprocess.check_call(command)
-        coef, z, p_value = imputation_test([1, 2],
-                imputed_prefix = "outputs/tmp/test_sample_imputed",
+    def assert_imputation(self, chromosomes = [1, 2], imputed_prefix = "outputs/tmp/test_sample_imputed"):
+        coef, z, p_value = imputation_test(chromosomes,
+                imputed_prefix = imputed_prefix,
                 expected_prefix = "test_data/sample",
                 )
         self.assertGreaterEqual(p_value[0], self.p_value_threshold)
         self.assertGreaterEqual(p_value[1], self.p_value_threshold)
 
+    def test_impute_runner_with_pedigree(self):
+        subprocess.check_call(impute_runner_command(control = False))
+    
+    def test_impute_runner_with_pedigree_control(self):
+        subprocess.check_call(impute_runner_command())
+        self.assert_imputation()
+
     def test_impute_runner_with_king(self):
-        command = ["python",
-                   "impute_runner.py",
-                   "test_data/sample.segments.gz",
-                   "test_data/sample~",
-                   "--from_chr", "1",
-                   "--to_chr", "3",
-                   "--king", "test_data/sample.king",
-                   "--agesex", "test_data/sample.agesex",
-                   "--output_address", "outputs/tmp/test_sample_imputed~",
-                   ]
-        subprocess.check_call(command)
+        subprocess.check_call(impute_runner_command(control = False, relatives = ["--king", "test_data/sample.king", "--agesex", "test_data/sample.agesex"]))
 
     def test_impute_runner_with_king_control(self):
-        command = ["python",
-                   "impute_runner.py",
-                   "-c",
-                   "test_data/sample.segments.gz",
-                   "test_data/sample~",
-                   "--from_chr", "1",
-                   "--to_chr", "3",
-                   "--king", "test_data/sample.king",
-                   "--agesex", "test_data/sample.agesex",
-                   "--output_address", "outputs/tmp/test_sample_imputed~",
-                   ]
-        subprocess.check_call(command)
-        coef, z, p_value = imputation_test([1, 2],
-                imputed_prefix = "outputs/tmp/test_sample_imputed",
-                expected_prefix = "test_data/sample",
-                )
-        self.assertGreaterEqual(p_value[0], self.p_value_threshold)
-        self.assertGreaterEqual(p_value[1], self.p_value_threshold)
-
+        subprocess.check_call(impute_runner_command(relatives = ["--king", "test_data/sample.king", "--agesex", "test_data/sample.agesex"]))
+        self.assert_imputation()
 
     def test_impute_runner_with_pedigree_control_multithread(self):
-        command = ["python",
-                   "impute_runner.py",
-                   "-c",
-                   "test_data/sample.segments.gz",
-                   "test_data/sample~",
-                   "--from_chr", "1",
-                   "--to_chr", "3",
-                   "--pedigree", "test_data/sample.ped",
-                   "--output_address", "outputs/tmp/test_sample_imputed~",
-                   "--threads", "2",
-                   ]
-        subprocess.check_call(command)
-        coef, z, p_value = imputation_test([1, 2],
-                imputed_prefix = "outputs/tmp/test_sample_imputed",
-                expected_prefix = "test_data/sample",
-                )
-        self.assertGreaterEqual(p_value[0], self.p_value_threshold)
-        self.assertGreaterEqual(p_value[1], self.p_value_threshold)
+        subprocess.check_call(impute_runner_command("--threads", "2"))
+        self.assert_imputation()
 
     def test_impute_runner_with_pedigree_control_multiprocess(self):
+        subprocess.check_call(impute_runner_command("--processes", "2"))
+        self.assert_imputation()
+
+    def test_impute_runner_with_pedigree_control_shared_data(self):
+        subprocess.check_call(impute_runner_command("--processes", "2", "--shared_data"))
+        self.assert_imputation()
+
+    def test_impute_runner_shared_data_removed_on_failure(self):
+        #there is no test_data/sample3, so the run fails after the shared data directory is created
+        command = impute_runner_command("--processes", "2", "--shared_data", chromosomes = ("1", "4"), output_address = "outputs/tmp/test_sample_failed_imputed~")
+        self.assertNotEqual(subprocess.call(command), 0)
+        self.assertEqual([name for name in os.listdir("outputs/tmp") if name.startswith("impute_shared_data")], [])
+
+    def test_impute_runner_with_pedigree_control_ibd_cache(self):
         command = ["python",
-                   "impute_runner.py",
-                   "-c",
+                   "create_ibd_cache.py",
                    "test_data/sample.segments.gz",
                    "test_data/sample~",
+                   "outputs/tmp/test_sample_ibd_cache",
                    "--from_chr", "1",
                    "--to_chr", "3",
-                   "--pedigree", "test_data/sample.ped",
-                   "--output_address", "outputs/tmp/test_sample_imputed~",
-                   "--processes", "2",
                    ]
         subprocess.check_call(command)
-        coef, z, p_value = imputation_test([1, 2],
-                imputed_prefix = "outputs/tmp/test_sample_imputed",
-                expected_prefix = "test_data/sample",
-                )
-        self.assertGreaterEqual(p_value[0], self.p_value_threshold)
-        self.assertGreaterEqual(p_value[1], self.p_value_threshold)
+        subprocess.check_call(impute_runner_command(ibd = "outputs/tmp/test_sample_ibd_cache"))
+        self.assert_imputation()
 
-    def test_impute_runner_with_pedigree_control_notilda(self):
-        command = ["python",
-                   "impute_runner.py",
-                   "-c",
-                   "test_data/sample.segments.gz",
-                   "test_data/sample1",
-                   "--pedigree", "test_data/sample.ped",
-                   "--output_address", "outputs/tmp/test_sample_imputed1",
-                   "--threads", "2",
-                   ]
+    def test_impute_runner_with_pedigree_control_max_memory(self):
+        log = subprocess.run(impute_runner_command("--max_memory", "1"), stderr = subprocess.PIPE, universal_newlines = True, check = True).stderr
+        self.assert_imputation()
+        #each chromosome is imputed in the slices that fit in the ceiling
+        sibships, iid_to_bed_index, gts_reader, ibd, pos, chromosomes, hdf5_output_dict = prepare_sample_chromosome()
+        chunk_size = get_chunk_size(1, gts_reader.iid_count, sibships.shape[0])
+        slices = [tuple(int(number) for number in match) for match in re.findall(r"imputing (\d+) SNPs in (\d+) slices of (\d+) SNPs", log)]
+        self.assertEqual(slices, [(pos.shape[0], -(-pos.shape[0]//chunk_size), chunk_size)]*2)
+        self.assertGreater(slices[0][1], 1)
+
+    def test_run_chunked_imputation_peak_memory(self):
+        sibships, iid_to_bed_index, gts_reader, ibd, pos, chromosomes, hdf5_output_dict = prepare_sample_chromosome()
+        max_memory = 8
+        for output_encoding in ["float16", "uint8"]:
+            chunk_size = get_chunk_size(max_memory, gts_reader.iid_count, sibships.shape[0], np.dtype(output_encoding).itemsize)
+            #the chromosome is imputed in several slices
+            self.assertLess(4*chunk_size, pos.shape[0])
+            #numpy arrays are traced by tracemalloc
+            tracemalloc.start()
+            run_chunked_imputation(sibships.copy(), iid_to_bed_index, gts_reader, ibd, pos, chromosomes, hdf5_output_dict, "outputs/tmp/test_sample_peak_memory", max_memory, output_encoding = output_encoding)
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            self.assertLessEqual(peak, max_memory*2**20, msg="peak memory of the "+output_encoding+" imputation is over the ceiling")
+
+    def test_run_chunked_imputation_resume(self):
+        sibships, iid_to_bed_index, gts_reader, ibd, pos, chromosomes, hdf5_output_dict = prepare_sample_chromosome()
+        max_memory = 2
+        run_chunked_imputation(sibships.copy(), iid_to_bed_index, gts_reader, ibd, pos, chromosomes, hdf5_output_dict, "outputs/tmp/test_sample_uninterrupted", max_memory)
+        output_address = "outputs/tmp/test_sample_resumed"
+        for suffix in [".hdf5", ".tmp.hdf5", ".manifest.json"]:
+            if os.path.exists(output_address+suffix):
+                os.remove(output_address+suffix)
+        #the run is killed while reading its sixth slice
+        interrupted_reader = InterruptedGenotypeReader(gts_reader, 5)
+        with self.assertRaises(RunInterrupted):
+            run_chunked_imputation(sibships.copy(), iid_to_bed_index, interrupted_reader, ibd, pos, chromosomes, hdf5_output_dict, output_address, max_memory, resume = True)
+        self.assertFalse(os.path.exists(output_address+".hdf5"))
+        with open(output_address+".manifest.json") as f:
+            manifest = json.load(f)
+        self.assertTrue(0 < len(manifest["done"]) < 5)
+        #only the slices that are not in the manifest are read and imputed again
+        resumed_reader = InterruptedGenotypeReader(gts_reader)
+        run_chunked_imputation(sibships.copy(), iid_to_bed_index, resumed_reader, ibd, pos, chromosomes, hdf5_output_dict, output_address, max_memory, resume = True)
+        self.assertEqual(resumed_reader.reads, -(-pos.shape[0]//manifest["chunk_size"]) - len(manifest["done"]))
+        self.assertFalse(os.path.exists(output_address+".manifest.json"))
+        with h5py.File(output_address+".hdf5", "r") as resumed, h5py.File("outputs/tmp/test_sample_uninterrupted.hdf5", "r") as uninterrupted:
+            self.assertTrue(np.array_equal(np.array(resumed["families"]), np.array(uninterrupted["families"])))
+            self.assertTrue(np.array_equal(read_imputed_par_gts(resumed["imputed_par_gts"]), read_imputed_par_gts(uninterrupted["imputed_par_gts"]), equal_nan = True))
+
+    def test_impute_runner_with_pedigree_control_chunk_layout(self):
+        subprocess.check_call(impute_runner_command("--max_memory", "1",
+                                                    "--threads", "2",
+                                                    "--output_compression", "gzip",
+                                                    "--output_chunk_layout", "snp",
+                                                    "--output_chunk_kb", "64",
+                                                    ))
+        self.assert_imputation()
+
+    def test_impute_runner_with_pedigree_control_uint8(self):
+        subprocess.check_call(impute_runner_command("--output_encoding", "uint8"))
+        self.assert_imputation()
+
+    def test_impute_runner_with_pedigree_control_genome_output(self):
+        #both bed files of the test data are on chromosome 1, so the second one is relabelled as chromosome 2, whose segments are in the IBD file
+        for chromosome in ["1", "2"]:
+            for suffix in [".bed", ".fam"]:
+                shutil.copyfile("test_data/sample"+chromosome+suffix, "outputs/tmp/test_genome_sample"+chromosome+suffix)
+            bim = pd.read_csv("test_data/sample"+chromosome+".bim", sep = "\t", header = None)
+            bim[0] = chromosome
+            bim.to_csv("outputs/tmp/test_genome_sample"+chromosome+".bim", sep = "\t", header = False, index = False)
+        subprocess.check_call(impute_runner_command("--genome_output", "outputs/tmp/test_genome_sample_imputed",
+                                                    genotypes = "outputs/tmp/test_genome_sample~",
+                                                    output_address = "outputs/tmp/test_genome_sample_imputed~"))
+        #the outputs of the chromosomes are kept by default
+        with h5py.File("outputs/tmp/test_genome_sample_imputed.hdf5", "r") as genome_f:
+            self.assertEqual(np.array(genome_f["snp_index/groups"]).astype(str).tolist(), ["chr1", "chr2"])
+            for chromosome in [1, 2]:
+                with h5py.File("outputs/tmp/test_genome_sample_imputed"+str(chromosome)+".hdf5", "r") as f:
+                    self.assertTrue(np.array_equal(np.array(genome_f["families"]), np.array(f["families"])))
+                    imp_gts, pos, sid = read_imputed_region(genome_f, chromosome)
+                    self.assertTrue(np.array_equal(pos, np.array(f["pos"])))
+                    self.assertTrue(np.allclose(imp_gts, read_imputed_par_gts(f["imputed_par_gts"]), equal_nan=True))
+                    #a region in the middle of the chromosome
+                    imp_gts, region_pos, sid = read_imputed_region(genome_f, chromosome, pos[10], pos[19])
+                    self.assertTrue(np.array_equal(region_pos, pos[10:20]))
+                    self.assertTrue(np.allclose(imp_gts, read_imputed_par_gts(f["imputed_par_gts"])[:, 10:20], equal_nan=True))
+
+    def test_impute_runner_with_pedigree_control_resume(self):
+        command = impute_runner_command("--max_memory", "1", "--resume")
         subprocess.check_call(command)
-        coef, z, p_value = imputation_test([1],
-                imputed_prefix = "outputs/tmp/test_sample_imputed",
-                expected_prefix = "test_data/sample",
-                )
-        self.assertGreaterEqual(p_value[0], self.p_value_threshold)
-        self.assertGreaterEqual(p_value[1], self.p_value_threshold)
+        #the second run finds the complete outputs and skips the chromosomes
+        log = subprocess.run(command, stderr = subprocess.PIPE, universal_newlines = True, check = True).stderr
+        self.assertEqual(len(re.findall(r"skipping .*already exists", log)), 2)
+        self.assertNotIn("imputing", log)
+        self.assert_imputation()
 
+    def test_impute_runner_with_pedigree_control_notilda(self):
+        subprocess.check_call(impute_runner_command("--threads", "2", genotypes = "test_data/sample1", chromosomes = None, output_address = "outputs/tmp/test_sample_imputed1"))
+        self.assert_imputation([1])
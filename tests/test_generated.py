@@ -60,7 +60,6 @@ class TestGenerated(unittest.TestCase):
 		sibships, iid_to_bed_index, gts, ibd, pos, chromosomes, hdf5_output_dict = prepare_data(sibs,
 																"outputs/tmp/generated_sibs",
 																ibd)
-		gts = gts.astype(float)
 		pos = pos.astype(int)
 		imputed_fids, imputed_par_gts = impute(sibships, iid_to_bed_index, gts, ibd, pos, hdf5_output_dict, str(chromosomes), threads = 2)
 		expected_parents = Bed("outputs/tmp/generated_parents.bed", count_A1 = True)
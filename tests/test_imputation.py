@@ -3,6 +3,7 @@ import numpy as np
 import pandas as pd
 from pysnptools.snpreader import Bed
 from scipy.stats import norm
+from sibreg.sibreg import read_imputed_par_gts
 #testing the imputation result for whole genome
 def imputation_test(chromosomes,
                    imputed_prefix = 'outputs/parent_imputed_chr',
@@ -17,7 +18,7 @@ def imputation_test(chromosomes,
     chromosomes_imputed_genes_pm = []
     for chromosome in chromosomes:
         with h5py.File(imputed_prefix+str(chromosome)+".hdf5",'r') as f:
-            gts = np.array(f["imputed_par_gts"])
+            gts = read_imputed_par_gts(f["imputed_par_gts"])
             fids = np.array(f["families"]).astype(str)
             parental_status = np.array(f["parental_status"])
             ped_array = np.array(f["pedigree"]).astype(str)
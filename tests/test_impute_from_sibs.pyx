@@ -32,6 +32,81 @@ class TestSibImpute(unittest.TestCase):
             else:
                 self.assertEqual(inferred_ibd1, 0, msg="inferred IBD is not 0")
 
+    def test_get_IBD_type_from_index(self):
+        ibd_dict = {
+            (b"jack", b"jim"):[30, 40, 2, 10, 20, 1, 45, 45, 1],
+        }
+        cdef int[:, :] segments = np.array([[10, 20, 1], [30, 40, 2], [45, 45, 1]], dtype=np.dtype("i"))
+        cdef int cursor = 0
+        #forward, backward and random order of locations should all match get_IBD_type
+        locations = list(range(50)) + list(range(50))[::-1] + list(np.random.RandomState(0).randint(0, 50, 100))
+        for loc in locations:
+            expected = get_IBD_type(b"jack", b"jim", loc, ibd_dict)
+            result = get_IBD_type_from_index(loc, segments, 0, 3, &cursor)
+            self.assertEqual(result, expected, msg="wrong IBD type at "+str(loc))
+
+        cursor = 1
+        for loc in range(50):
+            result = get_IBD_type_from_index(loc, segments, 1, 1, &cursor)
+            self.assertEqual(result, 0, msg="pair without segments is not IBD0")
+
+    def test_build_ibd_index(self):
+        fams = [[b"a", b"b", b"c"], [b"d"], [b"e", b"f"]]
+        ibd = {
+            ("b", "a"):[30, 40, 2, 10, 20, 1],
+            ("a", "c"):[5, 6, 1],
+            ("e", "f"):[1, 2, 2],
+        }
+        fam_pair_offsets, pair_segment_offsets, segments, fam_breakpoint_offsets, breakpoints = build_ibd_index(fams, ibd)
+        self.assertEqual(fam_pair_offsets.tolist(), [0, 3, 3, 4])
+        self.assertEqual(pair_segment_offsets.tolist(), [0, 2, 3, 3, 4])
+        self.assertEqual(segments.tolist(), [[10, 20, 1], [30, 40, 2], [5, 6, 1], [1, 2, 2]])
+        self.assertEqual(fam_breakpoint_offsets.tolist(), [0, 6, 6, 8])
+        self.assertEqual(breakpoints.tolist(), [5, 7, 10, 21, 30, 41, 1, 3])
+
+    def test_build_ibd_index_from_grouped_segments(self):
+        fams = [[b"a", b"b", b"c"], [b"d"], [b"e", b"f"]]
+        ibd = {
+            ("b", "a"):[30, 40, 2, 10, 20, 1],
+            ("a", "c"):[5, 6, 1],
+            ("e", "f"):[1, 2, 2],
+        }
+        grouped_ibd = (np.array([["b", "a"], ["a", "c"], ["e", "f"]]),
+                       np.array([0, 2, 3, 4], dtype=np.dtype("i")),
+                       np.array([[30, 40, 2], [10, 20, 1], [5, 6, 1], [1, 2, 2]], dtype=np.dtype("i")))
+        expected = build_ibd_index(fams, ibd)
+        result = build_ibd_index(fams, grouped_ibd)
+        for expected_array, result_array in zip(expected, result):
+            self.assertEqual(result_array.tolist(), expected_array.tolist())
+
+    def test_build_ibd_index_from_unsorted_segments(self):
+        fams = [[b"jack", b"jim"]]
+        ibd_dict = {
+            (b"jack", b"jim"):[45, 45, 1, 30, 40, 2, 10, 20, 1],
+        }
+        grouped_ibd = (np.array([["jim", "jack"]]),
+                       np.array([0, 3], dtype=np.dtype("i")),
+                       np.array([[45, 45, 1], [30, 40, 2], [10, 20, 1]], dtype=np.dtype("i")))
+        cdef int[:, :] segments
+        cdef int cursor
+        for ibd in [{("jack", "jim"):ibd_dict[(b"jack", b"jim")]}, grouped_ibd]:
+            fam_pair_offsets, pair_segment_offsets, segments_array, fam_breakpoint_offsets, breakpoints = build_ibd_index(fams, ibd)
+            self.assertEqual(segments_array.tolist(), [[10, 20, 1], [30, 40, 2], [45, 45, 1]])
+            segments = segments_array
+            cursor = 0
+            for loc in list(range(50)) + list(np.random.RandomState(0).randint(0, 50, 100)):
+                expected = get_IBD_type(b"jack", b"jim", loc, ibd_dict)
+                result = get_IBD_type_from_index(loc, segments, 0, 3, &cursor)
+                self.assertEqual(result, expected, msg="wrong IBD type at "+str(loc))
+
+    def test_build_ibd_index_rejects_overlapping_segments(self):
+        fams = [[b"a", b"b", b"c"]]
+        for pair_segments in [[10, 20, 1, 30, 40, 2, 20, 25, 1], [30, 40, 2, 10, 30, 1]]:
+            with self.assertRaises(ValueError):
+                build_ibd_index(fams, {("a", "c"):pair_segments})
+        #segments of different pairs may overlap and adjacent segments of a pair are allowed
+        build_ibd_index(fams, {("a", "c"):[10, 20, 1, 21, 30, 2], ("a", "b"):[10, 20, 1]})
+
     def test_dict_to_cmap(self):
         the_dict = {
             ("A","B"):[1,2,3,4],
@@ -49,7 +124,7 @@ class TestSibImpute(unittest.TestCase):
         self.assertEqual(expected_result, result, msg="dict translation is not working")
 
     def test_impute_snp_from_offsprings(self):
-        bed = np.array([[0.],[1.],[2.]])
+        bed = np.array([[0],[1],[2]], dtype=np.int8)
         snp_ibd0 = np.ones((10,2)).astype("i")
         snp_ibd1 = np.ones((10,2)).astype("i")
         snp_ibd2 = np.ones((10,2)).astype("i")
@@ -81,7 +156,7 @@ class TestSibImpute(unittest.TestCase):
                     self.assertAlmostEqual(result, (sibsum/2. + 2*f)/2, 4, msg = "problem with type2")
 
     def test_impute_snp_from_parent_offsprings(self):
-        bed = np.array([[0.],[1.],[2.]])
+        bed = np.array([[0],[1],[2]], dtype=np.int8)
         snp_ibd0 = np.ones((10,2)).astype("i")
         snp_ibd1 = np.ones((10,2)).astype("i")
         snp_ibd2 = np.ones((10,2)).astype("i")
@@ -159,4 +234,83 @@ class TestSibImpute(unittest.TestCase):
                     expected = expected_result_IBD2[par].get((i, j), None)
                     if expected is not None:
                         self.assertAlmostEqual(result, expected, 4, msg = "problem with type2, with parent = "+str(par)+", and sibs = "+str([i,j])+", expected,result = "+str((expected, result)))
+
+        missing_parent_bed = np.array([[MISSING_GENOTYPE],[1],[1]], dtype=np.int8)
+        snp_ibd1[0] = [1, 2]
+        result = impute_snp_from_parent_offsprings(snp, 0, snp_ibd0, snp_ibd1, snp_ibd2, f, missing_parent_bed, 0, 1, 0)
+        self.assertTrue(np.isnan(result), msg = "missing parent is not imputed as nan")
     
+
+    def test_report_progress(self):
+        reports = []
+        progress = report_progress("1", 250, 10, 100, 5., reports.append)
+        self.assertEqual(reports, [progress])
+        self.assertAlmostEqual(progress["progress"], 25)
+        self.assertAlmostEqual(progress["families_per_second"], 0.5)
+        self.assertAlmostEqual(progress["snps_per_second"], 5)
+        self.assertAlmostEqual(progress["eta"], 15)
+        progress = report_progress("1", 0, 10, 100, 0.)
+        self.assertTrue(np.isnan(progress["eta"]))
+
+    def test_fill_parent_offsprings_table(self):
+        cdef float[:] table = np.zeros(PARENT_OFFSPRINGS_TABLE_SIZE, dtype=np.float32)
+        f = 0.3
+        fill_parent_offsprings_table(f, &table[0])
+        self.assertAlmostEqual(table[parent_offsprings_table_index(1, 1, 2, 2)], 2)
+        self.assertAlmostEqual(table[parent_offsprings_table_index(1, 0, 0, 0)], 0.5*f*(1-f)/((1-f)**2 + 0.5*f*(1-f)), 5)
+        self.assertAlmostEqual(table[parent_offsprings_table_index(2, 2, 2, 2)], (f*(1-f) + 2*f**2)/(f*(1-f) + f**2), 5)
+        #sibs that can not be children of the parent and ibd2 sibs with different genotypes
+        self.assertTrue(np.isnan(table[parent_offsprings_table_index(1, 0, 0, 2)]))
+        self.assertTrue(np.isnan(table[parent_offsprings_table_index(1, 2, 0, 1)]))
+        self.assertTrue(np.isnan(table[parent_offsprings_table_index(2, 1, 0, 1)]))
+
+    def test_impute_single_parent_tables_and_branches(self):
+        sibships, iid_to_bed_index, gts, ibd, pos = simulate_single_parent_fams(20, 200)
+        _, tables_result = impute(sibships.copy(), iid_to_bed_index, gts, ibd, pos, {}, "1", threads=2, snp_tile_size=64)
+        _, branches_result = impute(sibships.copy(), iid_to_bed_index, gts, ibd, pos, {}, "1", threads=2, snp_tile_size=64, single_parent_tables=False)
+        self.assertFalse(np.all(np.isnan(tables_result)))
+        np.testing.assert_array_equal(tables_result, branches_result)
+
+    def test_impute_reports_progress_from_all_threads(self):
+        import threading
+        sibships, iid_to_bed_index, gts, ibd, pos = simulate_single_parent_fams(200, 200)
+        reports = []
+        def callback(progress):
+            reports.append((threading.get_ident(), progress["progress"]))
+        impute(sibships, iid_to_bed_index, gts, ibd, pos, {}, "1", threads=4, snp_tile_size=8, progress_interval=0, progress_callback=callback)
+        #besides the final report, there are reports during the imputation and they are not only made by the first thread
+        self.assertEqual(reports[-1][1], 100)
+        self.assertTrue(any(progress < 100 for _, progress in reports[:-1]))
+        self.assertGreater(len(set(thread for thread, _ in reports[:-1])), 1)
+
+def simulate_single_parent_fams(number_of_fams, number_of_snps):
+    """Simulates families of three sibs and their genotyped father in the format impute expects
+
+    Returns:
+        tuple(pandas.Dataframe, dict, numpy.array, tuple, numpy.array)
+            sibships, iid_to_bed_index, gts, ibd index and pos respectively.
+    """
+    import pandas as pd
+    rng = np.random.RandomState(0)
+    fams = [[("{}_{}".format(fam, sib)).encode("ASCII") for sib in range(3)] for fam in range(number_of_fams)]
+    fathers = [("{}_P".format(fam)).encode("ASCII") for fam in range(number_of_fams)]
+    iids = [iid for fam in fams for iid in fam] + fathers
+    iid_to_bed_index = {iid:index for index, iid in enumerate(iids)}
+    gts = rng.binomial(2, 0.3, (len(iids), number_of_snps)).astype(np.int8)
+    gts[rng.random_sample(gts.shape) < 0.05] = MISSING_GENOTYPE
+    pos = np.arange(number_of_snps)*10
+    ibd = {}
+    for fam in fams:
+        ibd[(fam[0].decode("ASCII"), fam[1].decode("ASCII"))] = [0, 5*number_of_snps-1, 1, 5*number_of_snps, 10*number_of_snps-1, 2]
+        ibd[(fam[0].decode("ASCII"), fam[2].decode("ASCII"))] = [number_of_snps, 5*number_of_snps, 1]
+    ibd = build_ibd_index(fams, ibd)
+    sibships = pd.DataFrame({"FID":[("F{}".format(fam)).encode("ASCII") for fam in range(number_of_fams)],
+                             "FATHER_ID":fathers,
+                             "MOTHER_ID":[b"0"]*number_of_fams,
+                             "IID":fams,
+                             "sib_count":[3]*number_of_fams,
+                             "has_father":True,
+                             "has_mother":False,
+                             "single_parent":True,
+                             })
+    return sibships, iid_to_bed_index, gts, ibd, pos
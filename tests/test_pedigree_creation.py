@@ -1,7 +1,9 @@
 import unittest
 import subprocess
 import pandas as pd
-from sibreg.bin.preprocess_data import create_pedigree, add_control
+from sibreg.bin.preprocess_data import create_pedigree, add_control, Pedigree, find_clusters, recurcive_append, BedGenotypeReader, read_gts, prepare_ibd, write_ibd_cache, read_ibd_cache
+from pysnptools.snpreader import Bed
+import numpy as np
 import networkx as nx
 
 
@@ -46,6 +48,64 @@ class TestPedigree(unittest.TestCase):
         equality = nx.is_isomorphic(result_graph, expected_graph, node_match)
         self.assertTrue(equality)
     
+    def test_create_pedigree_merges_sibships(self):
+        kinship = pd.DataFrame({"FID1":["a", "c", "b"], "ID1":["a", "c", "b"], "FID2":["b", "d", "c"], "ID2":["b", "d", "c"], "InfType":["FS", "FS", "FS"]})
+        kinship.to_csv("outputs/tmp/test_merge_sibships.king", sep = "\t", index = False)
+        agesex = pd.DataFrame({"FID":["a", "b", "c", "d"], "IID":["a", "b", "c", "d"], "sex":["F", "M", "F", "M"], "age":[10, 11, 12, 13]})
+        agesex.to_csv("outputs/tmp/test_merge_sibships.agesex", sep = " ", index = False)
+        result = create_pedigree("outputs/tmp/test_merge_sibships.king",
+                                 "outputs/tmp/test_merge_sibships.agesex",
+        )
+        self.assertEqual(result["FID"].nunique(), 1)
+        self.assertEqual(result["FATHER_ID"].nunique(), 1)
+        self.assertEqual(result["MOTHER_ID"].nunique(), 1)
+
+    def test_pedigree_codes(self):
+        pedigree = pd.read_csv("test_data/sample.ped", sep = " ").astype(str)
+        coded_pedigree = Pedigree.from_dataframe(pedigree)
+        self.assertTrue(coded_pedigree.to_dataframe().equals(pedigree[['FID' , 'IID', 'FATHER_ID' , 'MOTHER_ID']]))
+        self.assertEqual(coded_pedigree.has_father().tolist(), pedigree["FATHER_ID"].isin(pedigree["IID"]).tolist())
+        self.assertEqual(coded_pedigree.codes(pedigree["IID"]).tolist(), coded_pedigree.iids.tolist())
+        self.assertEqual(coded_pedigree.codes(["not in pedigree"]).tolist(), [-1])
+        self.assertEqual(coded_pedigree.rows(pedigree["IID"].values[::-1]).tolist(), list(range(pedigree.shape[0]))[::-1])
+        self.assertEqual(coded_pedigree.rows([pedigree["FID"].values[0]+"not an iid"]).tolist(), [-1])
+
+    def test_find_clusters(self):
+        clusters = find_clusters(6, np.array([[0, 3], [4, 3], [1, 5]]))
+        self.assertEqual(clusters.tolist(), [0, 1, 2, 0, 0, 1])
+        graph = {0:{1}, 1:{2}, 2:{0}, 3:{0}}
+        recurcive_append(graph, 0, 3)
+        self.assertEqual(graph, {0:{1, 3}, 1:{2, 3}, 2:{0, 3}, 3:{0, 3}})
+
+    def test_bed_genotype_reader(self):
+        bed = Bed("test_data/sample1.bed", count_A1 = True)
+        iid_indices = np.arange(0, bed.iid_count, 3)
+        reader = BedGenotypeReader("test_data/sample1.bed", iid_indices, bed.iid_count, bed.sid_count, 10, 500, snps_per_block = 100)
+        expected = read_gts(bed[iid_indices, 10:500])
+        self.assertTrue(np.array_equal(read_gts(reader), expected))
+        self.assertTrue(np.array_equal(read_gts(reader, 50, 150), expected[:, 50:150]))
+
+    def test_ibd_of_non_numeric_chromosomes(self):
+        bim = pd.DataFrame({"Chr":["1", "1", "X", "X"],
+                            "id":["rs1", "rs2", "rs3", "rs4"],
+                            "coordinate":[10, 20, 30, 40]})
+        ibd = pd.DataFrame({"ID1":["a", "a", "c"],
+                            "ID2":["b", "b", "d"],
+                            "IBDType":["IBD1", "IBD2", "IBD1"],
+                            "Chr":["1", "X", "X"],
+                            "StartSNP":["rs1", "rs3", "rs3"],
+                            "StopSNP":["rs2", "rs4", "rs3"]})
+        pair_ids, pair_segment_offsets, segments = prepare_ibd(ibd, bim, np.array(["X"]))
+        self.assertEqual(pair_ids.tolist(), [["a", "b"], ["c", "d"]])
+        self.assertEqual(pair_segment_offsets.tolist(), [0, 1, 2])
+        self.assertEqual(segments.tolist(), [[30, 40, 2], [30, 30, 1]])
+        write_ibd_cache(ibd, bim, "outputs/tmp/test_ibd_cache")
+        for chromosomes in [["X"], ["1", "X"]]:
+            expected = prepare_ibd(ibd, bim, np.array(chromosomes))
+            result = read_ibd_cache("outputs/tmp/test_ibd_cache", np.array(chromosomes))
+            for expected_array, result_array in zip(expected, result):
+                self.assertEqual(np.asarray(result_array).tolist(), expected_array.tolist())
+
     def test_add_control(self):
         pedigree = pd.read_csv("test_data/sample.ped", sep = " ").sort_values(by=['FID', "IID"]).astype(str)
         controlled_pedigree = add_control(pedigree).astype(str)
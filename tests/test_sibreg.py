@@ -1,6 +1,7 @@
 import unittest
 import numpy as np
 from numpy import testing
+from scipy.optimize import fmin_l_bfgs_b
 from sibreg import sibreg
 
 def random_design(labels):
@@ -53,6 +54,72 @@ class test_regrnd_functions(unittest.TestCase):
             alpha_mle = m.alpha_mle(tau,sigma2)
             testing.assert_almost_equal(alpha_mle, safe_alpha, decimal=5)
 
+    def test_sigma_inv_root(self):
+        sigma2 = float(1)
+        sigmau = float(5.5)
+        n = 10 ** 2
+        for i in range(0, 10):
+            alpha = np.random.randn((2))
+            tau = sigma2 / sigmau
+            m = sibreg.simulate(n, alpha, sigma2, tau)
+            Sigma_inv_root = m.sigma_inv_root(tau, sigma2)
+            for label in Sigma_inv_root.keys():
+                Sigma = Sigma_make(m.labels[m.labels == label], sigma2, tau)
+                testing.assert_almost_equal(Sigma_inv_root[label].dot(Sigma).dot(Sigma_inv_root[label].T), np.identity(Sigma.shape[0]), decimal=5)
+
+    def test_whiten(self):
+        sigma2 = float(1)
+        sigmau = float(5.5)
+        n = 10 ** 2
+        for i in range(0, 10):
+            alpha = np.random.randn((2))
+            tau = sigma2 / sigmau
+            m = sibreg.simulate(n, alpha, sigma2, tau)
+            X_T_X, X_T_y = m.alpha_mle(tau, sigma2, xtx_out = True)
+            X = m.whiten(m.X, tau, sigma2)
+            y = m.whiten(m.y, tau, sigma2)
+            testing.assert_almost_equal(X.T.dot(X), X_T_X, decimal=5)
+            testing.assert_almost_equal(X.T.dot(y), X_T_y, decimal=5)
+
+    def test_fit_snps(self):
+        sigma2 = float(1)
+        sigmau = float(5.5)
+        n = 10 ** 2
+        tau = sigma2 / sigmau
+        for i in range(0, 10):
+            alpha = np.random.randn((2))
+            m = sibreg.simulate(n, alpha, sigma2, tau)
+            G = np.random.binomial(2, 0.5, (n, 2, 20)).astype(float)
+            X_T_X, X_T_y, alpha_snps, alpha_cov = m.fit_snps(G, tau, sigma2)
+            for snp in range(0, G.shape[2]):
+                m_snp = sibreg.model(m.y, np.hstack((m.X, G[:, :, snp])), m.labels)
+                safe_alpha = safe_alpha_mle(m_snp.y, m_snp.X, Sigma_make(m.labels, sigma2, tau))
+                testing.assert_almost_equal(alpha_snps[snp], safe_alpha, decimal=5)
+                X_T_X_snp, X_T_y_snp = m_snp.alpha_mle(tau, sigma2, xtx_out = True)
+                testing.assert_almost_equal(X_T_X[snp], X_T_X_snp, decimal=5)
+                testing.assert_almost_equal(X_T_y[snp], X_T_y_snp, decimal=5)
+                testing.assert_almost_equal(alpha_cov[snp], np.linalg.inv(X_T_X_snp), decimal=5)
+
+    def test_fit_snps_missing(self):
+        sigma2 = float(1)
+        sigmau = float(5.5)
+        n = 10 ** 2
+        tau = sigma2 / sigmau
+        for i in range(0, 10):
+            alpha = np.random.randn((2))
+            m = sibreg.simulate(n, alpha, sigma2, tau)
+            G = np.random.binomial(2, 0.5, (n, 2, 20)).astype(float)
+            G[np.random.rand(n, 2, 20) < 0.1] = np.nan
+            X_T_X, X_T_y, alpha_snps, alpha_cov = m.fit_snps(G, tau, sigma2)
+            for snp in range(0, G.shape[2]):
+                not_nans = np.logical_not(np.any(np.isnan(G[:, :, snp]), axis=1))
+                m_snp = sibreg.model(m.y[not_nans], np.hstack((m.X[not_nans], G[not_nans, :, snp])), m.labels[not_nans])
+                safe_alpha = safe_alpha_mle(m_snp.y, m_snp.X, Sigma_make(m_snp.labels, sigma2, tau))
+                testing.assert_almost_equal(alpha_snps[snp], safe_alpha, decimal=5)
+                X_T_X_snp, X_T_y_snp = m_snp.alpha_mle(tau, sigma2, xtx_out = True)
+                testing.assert_almost_equal(X_T_X[snp], X_T_X_snp, decimal=5)
+                testing.assert_almost_equal(X_T_y[snp], X_T_y_snp, decimal=5)
+
     def test_likelihood(self):
         sigma2 = float(1)
         sigmau = float(5.5)
@@ -106,6 +173,48 @@ class test_regrnd_functions(unittest.TestCase):
             num_grad = (likelihood(tau + 10**(-6)) - likelihood(tau - 10**(-6))) / (2 * 10 ** (-6))
             testing.assert_almost_equal(grad[1], num_grad, decimal=5)
 
+    def test_large_mean(self):
+        # The phenotype mean is large relative to the residual scale
+        sigma2 = float(1)
+        tau = float(1)
+        mean = 10 ** 8
+        n = 200
+        random = np.random.RandomState(0)
+        for i in range(0, 5):
+            labels = random.choice(n // 10, n)
+            X = np.hstack((np.ones((n, 1)), random.randn(n, 1)))
+            y = X.dot(np.array([mean, 1]))+np.sqrt(sigma2 / tau)*random.randn(n // 10)[labels]+np.sqrt(sigma2)*random.randn(n)
+            m = sibreg.model(y, X, labels)
+            # The likelihood is invariant to shifting y by a multiple of the intercept, so the dense reference uses
+            # the centred phenotype, where it is accurate
+            def safe_loss(pars):
+                return safe_likelihood(y-mean, X, Sigma_make(labels, pars[0], pars[1]))/float(n)
+            lik, grad = m.likelihood_and_gradient(sigma2, tau)
+            testing.assert_allclose(lik, safe_loss([sigma2, tau]), rtol=10 ** (-6))
+            for j in range(0, 2):
+                step = np.zeros(2)
+                step[j] = 10 ** (-6) * [sigma2, tau][j]
+                num_grad = (safe_loss(np.array([sigma2, tau])+step)-safe_loss(np.array([sigma2, tau])-step))/(2*step[j])
+                testing.assert_allclose(grad[j], num_grad, rtol=10 ** (-3))
+            optim = m.optimize_model(np.array([sigma2, tau]))
+            safe_optim = fmin_l_bfgs_b(func=safe_loss, x0=np.array([sigma2, tau]), approx_grad=True,
+                                       bounds=[(0.00001, None), (0.00001, None)])
+            testing.assert_allclose([optim['sigma2'], optim['tau']], safe_optim[0], rtol=10 ** (-2))
+
+    def test_find_par_gts(self):
+        # FID, IID, FATHER_ID, MOTHER_ID, has_father, has_mother as read from the imputed parental file
+        ped = np.array([['family_10', 'sib_1', 'father_10', 'mother_10', 'True', 'False'],
+                        ['family_10', 'sib_2', 'father_10', 'mother_10', 'True', 'False'],
+                        ['family_10', 'father_10', '0', '0', 'False', 'False'],
+                        ['family_2', 'sib_3', 'father_2', 'mother_2', 'False', 'False']])
+        pheno_ids = np.array(['sib_1', 'sib_3', 'not_in_ped'])
+        gts_id_dict = {'sib_1':0, 'father_10':1, 'sib_3':2, 'not_in_ped':3}
+        par_status, gt_indices, fam_labels = sibreg.find_par_gts(pheno_ids, ped, gts_id_dict, fams = np.array(['family_2', 'family_10']))
+        # family labels are not truncated
+        self.assertEqual(fam_labels[:2].tolist(), ['family_10', 'family_2'])
+        self.assertEqual(fam_labels[2], '')
+        self.assertEqual(par_status.tolist(), [[0, 1], [1, 1], [-1, -1]])
+        self.assertEqual(gt_indices.tolist(), [[0, 1, 1], [2, 0, 0], [3, -1, -1]])
 
 if  __name__=='__main__':
     unittest.main()
\ No newline at end of file